@@ -0,0 +1,95 @@
+"""
+Benchmark the whole pipeline end to end on synthetic day files.
+
+Times process_day on a single file, then process, generate_flowmap_data and
+generate_index on the whole synthetic period, reporting wall time, throughput
+and peak RSS of each stage.
+
+    python benchmarks/bench_pipeline.py --days 28 --zones 2000 --json bench.json
+"""
+import datetime
+import gzip
+import json
+import pathlib
+import resource
+import tempfile
+import time
+
+import click
+import pandas as pd
+
+from synthetic import generate
+
+from utils import PATHS
+import process
+import flowmap
+import generate_index
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process and its finished children, in MiB"""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+
+def count_rows(fpath) -> int:
+    with gzip.open(fpath, 'rb') as f:
+        return sum(1 for _ in f) - 1
+
+
+def write_reference(days: int = 7):
+    """Use the first week of the generated flows as February reference of generate_index"""
+    flows = pd.read_csv(PATHS.processed / 'flowmap_flows_location.csv', sep=';', encoding='latin1')
+    first = sorted(flows['time'].unique())[:days]
+    flows[flows['time'].isin(first)].to_csv(
+        PATHS.processed_root / 'ref_flowmap_flows_location.csv', index=False, sep=';', encoding='latin1')
+
+
+def timed(name: str, fn, units: float, unit: str) -> dict:
+    tic = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - tic
+    return {'stage': name, 'seconds': round(elapsed, 4), 'throughput': round(units / elapsed, 2),
+            'unit': f'{unit}/s', 'peak_rss_mb': round(peak_rss_mb(), 1)}
+
+
+@click.command()
+@click.option('--days', default=14, help="Number of synthetic days.")
+@click.option('--zones', default=1000, help="Number of synthetic zones.")
+@click.option('--location', '-l', default='municipios', help="'municipios' or 'distritos'.")
+@click.option('--executor', '-e', default='thread', help="Pool used by process.")
+@click.option('--workers', '-w', default=4, help="Number of workers of process.")
+@click.option('--json', 'json_path', default=None, help="Write the results to this JSON file.")
+def main(days, zones, location, executor, workers, json_path):
+    with tempfile.TemporaryDirectory() as tmp:
+        PATHS.data = pathlib.Path(tmp)
+        print(f'Generating {days} days with {zones} zones ...')
+        # Start before the May reference week of generate_index so it is covered
+        start = datetime.date(2020, 5, 4) - datetime.timedelta(days=max(days - 7, 0))
+        files = generate(PATHS.data, days=days, zones=zones, start=start, location=location)
+        rows = count_rows(files[0])
+
+        results = [
+            timed('process_day', lambda: process.process_day(files[0]), rows, 'rows'),
+            timed('process', lambda: process.process(exp='maestra1', res=location,
+                                                     executor=executor, workers=workers), days, 'days'),
+            timed('generate_flowmap_data', flowmap.generate_flowmap_data, days, 'days'),
+        ]
+        write_reference()
+        results.append(timed('generate_index', generate_index.generate_index, days, 'days'))
+
+    total = sum(r['seconds'] for r in results[1:])
+    print(f'\n{"stage":<22} {"seconds":>9} {"throughput":>20} {"peak RSS MiB":>13}')
+    for r in results:
+        print(f'{r["stage"]:<22} {r["seconds"]:>9.3f} {r["throughput"]:>12.1f} {r["unit"]:<7} {r["peak_rss_mb"]:>13.1f}')
+    print(f'{"pipeline":<22} {total:>9.3f} {days / total:>12.1f} {"days/s":<7}')
+
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump({'days': days, 'zones': zones, 'location': location, 'executor': executor,
+                       'workers': workers, 'rows_per_day': rows, 'stages': results}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""
+Benchmark process with different executors and number of workers on synthetic day files.
+
+    python benchmarks/bench_process.py --days 32 --zones 2000 --workers 1,2,4,8
+"""
+import pathlib
+import tempfile
+import time
+
+import click
+
+from synthetic import generate
+
+from utils import PATHS
+import process
+
+
+@click.command()
+@click.option('--days', default=16, help="Number of synthetic days.")
+@click.option('--zones', default=1000, help="Number of synthetic zones.")
+@click.option('--workers', default='1,2,4', help="Comma separated number of workers to test.")
+@click.option('--executor', 'executors', default=['thread', 'process'], multiple=True, help="Executors to test.")
+def main(days, zones, workers, executors):
+    with tempfile.TemporaryDirectory() as tmp:
+        PATHS.data = pathlib.Path(tmp)
+        print(f'Generating {days} days with {zones} zones ...')
+        files = generate(PATHS.data, days=days, zones=zones)
+
+        print(f'{"executor":>10} {"workers":>8} {"seconds":>8} {"days/s":>8}')
+        for executor in executors:
+            for n in (int(w) for w in workers.split(',')):
+                tic = time.perf_counter()
+                process.process(files, executor=executor, workers=n)
+                elapsed = time.perf_counter() - tic
+                print(f'{executor:>10} {n:>8} {elapsed:>8.2f} {days / elapsed:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
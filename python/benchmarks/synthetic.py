@@ -0,0 +1,151 @@
+"""
+Generate synthetic MITMA day files to benchmark the pipeline.
+
+Files follow the layout of the opendata-movilidad daily files: '|' separated,
+'.' as thousands separator, latin1 encoded and gzip compressed, with one row per
+origin, destination, hour (periodo) and distance band (distancia).
+"""
+import datetime
+import gzip
+import os
+import pathlib
+import shutil
+import sys
+
+import click
+import numpy as np
+import pandas as pd
+
+SRC = pathlib.Path(__file__).resolve().parents[1] / 'src'
+sys.path.insert(0, str(SRC))
+
+from utils import PATHS
+
+COLUMNS = ['fecha', 'origen', 'destino', 'actividad_origen', 'actividad_destino',
+           'residencia', 'edad', 'periodo', 'distancia', 'viajes', 'viajes_km']
+ACTIVITIES = np.array(['casa', 'trabajo_estudio', 'frecuente', 'no_frecuente'])
+DISTANCES = np.array(['0005-002', '002-005', '005-010', '010-050', '050-100', '100+'])
+# Mean length in km of the trips of each distance band
+DISTANCE_KM = np.array([1.2, 3.5, 7.5, 25.0, 75.0, 250.0])
+# INE code map of the project, copied to the synthetic data folders
+INE_CODES = PATHS.raw / 'codigos_ine' / '20_cod_prov.xls'
+
+
+def zone_codes(zones: int, location: str = 'municipios', seed: int = 0) -> np.ndarray:
+    """Generate zone codes spread over the 52 provinces
+
+    Args:
+        zones (int): number of zones
+        location (str, optional): 'municipios' (5 digits) or 'distritos' (7 digits). Defaults to 'municipios'.
+        seed (int, optional): seed of the random generator. Defaults to 0.
+
+    Returns:
+        np.ndarray: array of zone codes as strings
+    """
+    rng = np.random.default_rng(seed)
+    provinces = np.arange(zones) % 52 + 1
+    municipalities = np.arange(zones) // 52 + 1
+    codes = np.array([f'{p:02d}{m:03d}' for p, m in zip(provinces, municipalities)])
+    if location == 'distritos':
+        codes = np.char.add(codes, np.array([f'{d:02d}' for d in rng.integers(1, 10, zones)]))
+    # Some zones are aggregations of small municipalities
+    aggregated = rng.random(zones) < 0.1
+    codes[aggregated] = np.char.add(codes[aggregated], '_AM')
+    return codes
+
+
+def _thousands(values: np.ndarray) -> pd.Series:
+    return pd.Series(values).map('{:,}'.format).str.replace(',', '.', regex=False)
+
+
+def write_day(fpath, date: datetime.date, codes: np.ndarray, destinations: int = 10,
+              periods: int = 4, rng=None):
+    """Write the synthetic file of a given day
+
+    Args:
+        fpath (Path): path of the gzip file to write
+        date (datetime.date): day of the file
+        codes (np.ndarray): zone codes
+        destinations (int, optional): destinations of each origin. Defaults to 10.
+        periods (int, optional): hours with trips of each origin-destination pair. Defaults to 4.
+        rng (np.random.Generator, optional): random generator. Defaults to a new one.
+
+    Returns:
+        int: number of rows written
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    n_rows = len(codes) * destinations * periods
+    origin = np.repeat(codes, destinations * periods)
+    dest = np.repeat(rng.choice(codes, len(codes) * destinations), periods)
+    distance = rng.integers(0, len(DISTANCES), n_rows)
+    trips = rng.integers(1, 20000, n_rows)
+    trips_km = (trips * DISTANCE_KM[distance]).astype('int64')
+
+    df = pd.DataFrame({
+        'fecha': f'{date:%Y%m%d}',
+        'origen': origin,
+        'destino': dest,
+        'actividad_origen': rng.choice(ACTIVITIES, n_rows),
+        'actividad_destino': rng.choice(ACTIVITIES, n_rows),
+        'residencia': pd.Series(origin).str.slice(0, 2),
+        'edad': 'NA',
+        'periodo': [f'{p:02d}' for p in rng.integers(0, 24, n_rows)],
+        'distancia': DISTANCES[distance],
+        'viajes': _thousands(trips),
+        'viajes_km': _thousands(trips_km),
+    }, columns=COLUMNS)
+
+    with gzip.open(fpath, 'wt', encoding='latin1', compresslevel=1) as f:
+        df.to_csv(f, sep='|', index=False)
+    return n_rows
+
+
+def generate(data_dir, days: int = 7, zones: int = 500, start: datetime.date = datetime.date(2020, 2, 21),
+             maestra_version: str = 'maestra1', location: str = 'municipios',
+             destinations: int = 10, periods: int = 4, seed: int = 0) -> list:
+    """Generate a synthetic data folder with raw day files and the INE code map
+
+    Args:
+        data_dir (Path): data folder, raw files are written in data_dir / 'raw'
+        days (int, optional): number of days. Defaults to 7.
+        zones (int, optional): number of zones. Defaults to 500.
+        start (datetime.date, optional): first day. Defaults to 2020-02-21.
+        maestra_version (str, optional): version of maestra. Defaults to 'maestra1'.
+        location (str, optional): 'municipios' or 'distritos'. Defaults to 'municipios'.
+        destinations (int, optional): destinations of each origin. Defaults to 10.
+        periods (int, optional): hours with trips of each origin-destination pair. Defaults to 4.
+        seed (int, optional): seed of the random generator. Defaults to 0.
+
+    Returns:
+        list: paths to the generated files
+    """
+    data_dir = pathlib.Path(data_dir)
+    raw_dir = data_dir / 'raw' / maestra_version / location
+    raw_dir.exists() or os.makedirs(raw_dir)
+    ine_dir = data_dir / 'raw' / 'codigos_ine'
+    ine_dir.exists() or os.makedirs(ine_dir)
+    shutil.copy(INE_CODES, ine_dir)
+
+    rng = np.random.default_rng(seed)
+    codes = zone_codes(zones, location, seed)
+    files = []
+    for d in pd.date_range(start, periods=days, freq='d'):
+        fpath = raw_dir / f'{d:%Y%m%d}_maestra_{maestra_version[-1]}_mitma_{location[:-1]}.txt.gz'
+        write_day(fpath, d, codes, destinations, periods, rng)
+        files.append(fpath)
+    return files
+
+
+@click.command()
+@click.argument('data_dir')
+@click.option('--days', default=7, help="Number of synthetic days.")
+@click.option('--zones', default=500, help="Number of synthetic zones.")
+@click.option('--start', default='2020-02-21', help="First day.")
+@click.option('--location', '-l', default='municipios', help="'municipios' or 'distritos'.")
+def main(data_dir, days, zones, start, location):
+    """Generate a synthetic data folder in DATA_DIR"""
+    generate(data_dir, days=days, zones=zones, start=datetime.date.fromisoformat(start), location=location)
+
+
+if __name__ == '__main__':
+    main()
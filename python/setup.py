@@ -1,10 +1,18 @@
+import pathlib
+
 from setuptools import find_packages, setup
 
+# Modules of src import each other by name, so they are also installed as top level modules
+MODULES = sorted(f.stem for f in (pathlib.Path(__file__).parent / 'src').glob('*.py') if f.stem != '__init__')
+
 setup(
     name='src',
     packages=find_packages(),
+    package_dir={'': 'src', 'src': 'src'},
+    py_modules=MODULES,
     version='0.1.0',
     description='Data processing tool to analyze mobility data facilited by MITMA',
     author='Jaime Pizarroso Gonzalo',
     license='MIT',
+    entry_points={'console_scripts': ['mitma=cli:mitma']},
 )
@@ -0,0 +1,134 @@
+"""
+Batch.py file download and process every dataset of opendata-movilidad in one job.
+
+Each combination of maestra version and location is run in its own process,
+concurrently, sharing a budget of workers. Outputs of each dataset are written
+in its own processed subfolder, e.g. processed/maestra2_distritos/, so
+datasets never overwrite each other.
+"""
+import datetime
+import itertools
+from functools import partial
+from multiprocessing import Pool
+
+import click
+
+from utils import PATHS, MAESTRA_VALID_VALUES, LOCATION_VALID_VALUES, dataset_name
+import download
+import process
+
+STEPS_VALID_VALUES = ('download', 'process')
+
+
+def run_dataset(dataset: tuple,
+                steps: tuple = STEPS_VALID_VALUES,
+                workers: int = 1,
+                update: bool = True,
+                force: bool = False,
+                start: datetime.date = datetime.date(2020, 2, 21),
+                end: datetime.date = None,
+                chunksize: int = None,
+                data=None) -> dict:
+    """Download and process a single dataset, writing its outputs in its processed subfolder
+
+    Args:
+        dataset (tuple): maestra version and location
+        steps (tuple, optional): Steps to run. Defaults to STEPS_VALID_VALUES.
+        workers (int, optional): Workers of the dataset. Defaults to 1.
+        update (bool, optional): Only download and process new or changed days. Defaults to True.
+        force (bool, optional): Refresh downloaded files and reprocess every file. Defaults to False.
+        start (datetime.date, optional): First day to download. Defaults to 2020-02-21.
+        end (datetime.date, optional): Last day to download, also in update mode.
+            Defaults to 2021-05-09, or today in update mode.
+        chunksize (int, optional): Stream day files in chunks of this many rows. Defaults to None.
+        data (Path, optional): Data folder. Defaults to PATHS.data of the parent process.
+
+    Returns:
+        dict: dataset name, number of files downloaded and days processed
+    """
+    maestra_version, location = dataset
+    if data is not None:
+        PATHS.data = data
+    PATHS.dataset = dataset_name(maestra_version, location)
+
+    summary = {'dataset': PATHS.dataset, 'downloaded': 0, 'processed': 0}
+    if 'download' in steps:
+        files = download.download.callback(maestra_version=maestra_version, location=location,
+                                           update=update, force=force, workers=workers,
+                                           start=start, end=end)
+        summary['downloaded'] = len(files)
+    if 'process' in steps:
+        # Pool processes cannot start processes of their own, day files are read in threads
+        dates = process.process(exp=maestra_version, res=location, update=update, force=force,
+                                executor='thread', workers=workers, chunksize=chunksize)
+        summary['processed'] = len(dates)
+    return summary
+
+
+def batch(maestra_versions: tuple = MAESTRA_VALID_VALUES,
+          locations: tuple = LOCATION_VALID_VALUES,
+          steps: tuple = STEPS_VALID_VALUES,
+          workers: int = 4,
+          update: bool = True,
+          force: bool = False,
+          start: datetime.date = datetime.date(2020, 2, 21),
+          end: datetime.date = None,
+          chunksize: int = None) -> list:
+    """Download and process every combination of maestra versions and locations concurrently
+
+    Args:
+        maestra_versions (tuple, optional): Versions of maestra. Defaults to MAESTRA_VALID_VALUES.
+        locations (tuple, optional): Locations of data. Defaults to LOCATION_VALID_VALUES.
+        steps (tuple, optional): Steps to run, 'download' and/or 'process'. Defaults to STEPS_VALID_VALUES.
+        workers (int, optional): Total number of workers, split among the datasets run
+            at the same time. Defaults to 4.
+        update (bool, optional): Only download and process new or changed days. Defaults to True.
+        force (bool, optional): Refresh downloaded files and reprocess every file. Defaults to False.
+        start (datetime.date, optional): First day to download. Defaults to 2020-02-21.
+        end (datetime.date, optional): Last day to download, also in update mode.
+            Defaults to 2021-05-09, or today in update mode.
+        chunksize (int, optional): Stream day files in chunks of this many rows. Defaults to None.
+
+    Raises:
+        ValueError: maestra versions, locations and steps must be valid values.
+
+    Returns:
+        list: summary of each dataset
+    """
+    for values, valid, name in ((maestra_versions, MAESTRA_VALID_VALUES, 'versions'),
+                                (locations, LOCATION_VALID_VALUES, 'locations'),
+                                (steps, STEPS_VALID_VALUES, 'steps')):
+        if not values or not set(values) <= set(valid):
+            raise ValueError(f'{name} {", ".join(values)} is not a valid input. Valid {name} are: {", ".join(valid)}')
+
+    datasets = list(itertools.product(maestra_versions, locations))
+    jobs = min(len(datasets), workers)
+    run = partial(run_dataset, steps=steps, workers=max(1, workers // jobs), update=update,
+                  force=force, start=start, end=end, chunksize=chunksize, data=PATHS.data)
+    print(f'Running {", ".join(steps)} of {len(datasets)} datasets, {jobs} at a time')
+    with Pool(jobs) as pool:
+        summaries = pool.map(run, datasets, chunksize=1)
+    for summary in summaries:
+        print(f"\t {summary['dataset']}: {summary['downloaded']} files downloaded, "
+              f"{summary['processed']} days processed")
+    return summaries
+
+
+@click.command()
+@click.option('--maestra-version', '-mv', 'maestra_versions', multiple=True, default=MAESTRA_VALID_VALUES,
+              type=click.Choice(MAESTRA_VALID_VALUES), help="Versions of maestra, can be repeated. Defaults to all.")
+@click.option('--location', '-l', 'locations', multiple=True, default=LOCATION_VALID_VALUES,
+              type=click.Choice(LOCATION_VALID_VALUES), help="Locations of data, can be repeated. Defaults to all.")
+@click.option('--step', '-s', 'steps', multiple=True, default=STEPS_VALID_VALUES,
+              type=click.Choice(STEPS_VALID_VALUES), help="Steps to run, can be repeated. Defaults to all.")
+@click.option('--workers', '-w', default=4, help="Total number of workers shared by the datasets.")
+@click.option('--full', is_flag=True, default=False, help="Rebuild the outputs instead of updating them.")
+@click.option('--force', '-f', is_flag=True, default=False, help="Refresh downloaded files and reprocess every file.")
+@click.option('--chunksize', '-c', default=None, type=int, help="Stream day files in chunks of this many rows.")
+def main(maestra_versions, locations, steps, workers, full, force, chunksize):
+    """Download and process every dataset concurrently"""
+    batch(maestra_versions, locations, steps, workers, update=not full, force=force, chunksize=chunksize)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Cli.py file group every step of the project in a single command line tool.
+
+    python cli.py download --update
+    python cli.py process --update
+    python cli.py flowmap --update
+    python cli.py index --update
+    python cli.py all            # every step above, only for new or changed days
+    python cli.py all --dry-run  # print what would be run
+    python cli.py status
+    python cli.py --dataset -mv maestra2 process  # maestra2 municipios in processed/maestra2_municipios
+
+Once installed with pip, the same tool is run as `mitma`.
+
+The module of each step (pandas, requests...) is only imported when that step
+runs, so status, dry runs and help start without loading them.
+"""
+import importlib
+
+import click
+
+from utils import PATHS, MAESTRA_VALID_VALUES, LOCATION_VALID_VALUES, dataset_name
+from manifest import Manifest, STAGES
+import corrections
+import download
+
+# Subcommands imported when run: module, click command and short help
+LAZY_COMMANDS = {
+    'download': ('download', 'download', 'Download day files from opendata-movilidad.'),
+    'process': ('process', 'main', 'Process downloaded files into the province flux store.'),
+    'flowmap': ('flowmap', 'main', 'Generate the flowmap files from the province flux store.'),
+    'index': ('generate_index', 'main', 'Generate the mobility indexes from the OD tensor.'),
+    'batch': ('batch', 'main', 'Download and process every dataset concurrently.'),
+    'serve': ('query', 'main', 'Serve slices of the processed data over HTTP.'),
+}
+
+
+class LazyGroup(click.Group):
+    """Click group importing the module of a subcommand only when it is run"""
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(LAZY_COMMANDS))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in LAZY_COMMANDS:
+            module, command, _ = LAZY_COMMANDS[cmd_name]
+            return getattr(importlib.import_module(module), command)
+        return super().get_command(ctx, cmd_name)
+
+    def format_commands(self, ctx, formatter):
+        # Help of lazy commands is declared here so listing them imports nothing
+        rows = [(name, LAZY_COMMANDS[name][2] if name in LAZY_COMMANDS
+                 else self.commands[name].get_short_help_str()) for name in self.list_commands(ctx)]
+        with formatter.section('Commands'):
+            formatter.write_dl(rows)
+
+
+def pending(maestra_version: str = 'maestra1', location: str = 'municipios') -> dict:
+    """Work pending in each step of a dataset, without running any of them
+
+    Args:
+        maestra_version (str, optional): Version of maestra of the data. Defaults to 'maestra1'.
+        location (str, optional): Locations of the data. Defaults to 'municipios'.
+
+    Returns:
+        dict: raw day files, days to download in update mode, files new or changed since
+            they were processed, and dates pending in each stage of the manifest
+    """
+    raw_dir = PATHS.raw / maestra_version / location
+    files = corrections.day_files(raw_dir, maestra_version, location) if raw_dir.exists() else []
+    manifest = Manifest()
+    status = {'raw files': files,
+              'download': download.download_dates(raw_dir, update=True),
+              'process': manifest.changed(files)}
+    for stage in STAGES:
+        status[stage] = manifest.stale(stage)
+    return status
+
+
+def _span(items: list) -> str:
+    """Number of items and the first and last ones"""
+    return f'{len(items)}' + (f' ({items[0]} - {items[-1]})' if items else '')
+
+
+def print_pending(status: dict):
+    """Print the work returned by pending"""
+    rows = [('raw files', [f.name[:8] for f in status['raw files']]),
+            ('days to download', status['download']),
+            ('files to process', [f.name[:8] for f in status['process']])]
+    rows += [(f'{stage} days', status[stage]) for stage in STAGES]
+    for label, items in rows:
+        print(f'\t {label + ":":22} {_span(items)}')
+
+
+@click.group(cls=LazyGroup)
+@click.option('--data', default=None, type=click.Path(file_okay=False), help="Data folder. Defaults to python/data.")
+@click.option('--dataset', is_flag=True, default=False,
+              help="Use the processed subfolder of the dataset, as written by batch.")
+@click.option('--maestra-version', '-mv', default='maestra1', type=click.Choice(MAESTRA_VALID_VALUES),
+              help="Version of maestra of the dataset, default of every step.")
+@click.option('--location', '-l', default='municipios', type=click.Choice(LOCATION_VALID_VALUES),
+              help="Locations of the dataset, default of every step.")
+@click.pass_context
+def mitma(ctx, data, dataset, maestra_version, location):
+    """Download and process opendata-movilidad data"""
+    if data is not None:
+        PATHS.data = data
+    if dataset:
+        PATHS.dataset = dataset_name(maestra_version, location)
+    ctx.obj = {'maestra_version': maestra_version, 'location': location}
+    # Steps reading a dataset default to the one of the group, so they read and write the same dataset
+    ctx.default_map = {'download': {'maestra_version': maestra_version, 'location': location},
+                       'process': {'exp': maestra_version, 'res': location}}
+
+
+@mitma.command()
+@click.pass_obj
+def status(obj):
+    """Print the work pending in each step."""
+    print(f"{obj['maestra_version']}/{obj['location']}, outputs in {PATHS.processed}")
+    print_pending(pending(obj['maestra_version'], obj['location']))
+
+
+@mitma.command(name='all')
+@click.option('--full', is_flag=True, default=False,
+              help="Rebuild every output in a single process instead of updating them.")
+@click.option('--skip-download', is_flag=True, default=False, help="Only process files already downloaded.")
+@click.option('--workers', '-w', default=4, help="Number of files downloaded or processed in parallel.")
+@click.option('--chunksize', '-c', default=None, type=int, help="Stream day files in chunks of this many rows.")
+@click.option('--export-csv', is_flag=True, default=False,
+              help="Also export province_flux.csv and mobility_index.csv for the R dashboard.")
+@click.option('--dry-run', is_flag=True, default=False, help="Print the work pending without running it.")
+@click.pass_obj
+def run_all(obj, full, skip_download, workers, chunksize, export_csv, dry_run):
+    """Download new days and update every output."""
+    maestra_version, location = obj['maestra_version'], obj['location']
+    if dry_run:
+        print(f'{maestra_version}/{location}, outputs in {PATHS.processed}' + (', full rebuild' if full else ''))
+        print_pending(pending(maestra_version, location))
+        return
+
+    if not skip_download:
+        download.download.callback(maestra_version=maestra_version, location=location,
+                                   update=True, force=False, workers=workers)
+    if full:
+        import pipeline
+        pipeline.run_pipeline(exp=maestra_version, res=location, workers=workers, chunksize=chunksize,
+                              export_csv=export_csv)
+        return
+    import process
+    import flowmap
+    import generate_index
+    process.process(exp=maestra_version, res=location, update=True, workers=workers, chunksize=chunksize,
+                    export_csv=export_csv)
+    flowmap.generate_flowmap_data(update=True)
+    generate_index.generate_index(update=True, export_csv=export_csv)
+
+
+if __name__ == '__main__':
+    mitma()
@@ -0,0 +1,114 @@
+"""
+Corrections.py file record known errors of the opendata-movilidad files and apply them when reading.
+
+Corrections are declared in CORRECTIONS instead of rewriting raw files. A
+missing day is declared as an alias: its file is read from the file of
+another day, replacing its date, so no corrected copy is ever written:
+
+    raw/maestra1/municipios/20200712_maestra_1_mitma_municipio.txt.gz
+        -> read from 20200705_maestra_1_mitma_municipio.txt.gz with fecha 20200712
+
+A day published afterwards by the server takes precedence over its alias.
+"""
+import datetime
+
+# Each correction aliases a day of a maestra version and location to the file of another day
+CORRECTIONS = [
+    {'maestra_version': 'maestra1', 'location': 'municipios',
+     'date': datetime.date(2020, 7, 12), 'source': datetime.date(2020, 7, 5),
+     'reason': '2020-07-12 is missing in the server, trips of the previous Sunday are used'},
+]
+
+
+def file_name(date: datetime.date, maestra_version: str, location: str) -> str:
+    """Name of the file of a day in the server and in the raw folder
+
+    Args:
+        date (datetime.date): day of the file
+        maestra_version (str): version of maestra
+        location (str): locations of the data
+
+    Returns:
+        str: name of the file
+    """
+    return f'{date:%Y%m%d}_maestra_{maestra_version[-1]}_mitma_{location[:-1]}.txt.gz'
+
+
+def aliases(maestra_version: str, location: str) -> dict:
+    """Days of a maestra version and location read from the file of another day
+
+    Args:
+        maestra_version (str): version of maestra
+        location (str): locations of the data
+
+    Returns:
+        dict: aliased datetime.date to the datetime.date of the file read
+    """
+    return {c['date']: c['source'] for c in CORRECTIONS
+            if c['maestra_version'] == maestra_version and c['location'] == location}
+
+
+def _parse(fpath) -> tuple:
+    """Date, maestra version and location of a raw file path"""
+    date = datetime.datetime.strptime(fpath.name[:8], '%Y%m%d').date()
+    return date, fpath.parent.parent.name, fpath.parent.name
+
+
+def day_files(raw_dir, maestra_version: str, location: str) -> list:
+    """List the day files of a raw folder, adding the aliased days whose source file exists
+
+    Aliased days are returned as the path their file would have, which does not exist.
+
+    Args:
+        raw_dir (Path): folder of the raw files
+        maestra_version (str): version of maestra
+        location (str): locations of the data
+
+    Returns:
+        list: sorted paths to the day files
+    """
+    files = {f.name: f for f in raw_dir.glob('*.txt.gz')}
+    for date, source in aliases(maestra_version, location).items():
+        name = file_name(date, maestra_version, location)
+        if name not in files and file_name(source, maestra_version, location) in files:
+            files[name] = raw_dir / name
+    return [files[name] for name in sorted(files)]
+
+
+def resolve(fpath) -> tuple:
+    """File to read for a day file and the date to set to its rows
+
+    Args:
+        fpath (Path): path to a day file, existing or aliased
+
+    Returns:
+        tuple: path to the file to read and YYYYMMDD integer date to set, None if
+            the file is read as is
+    """
+    if fpath.exists():
+        return fpath, None
+    date, maestra_version, location = _parse(fpath)
+    source = aliases(maestra_version, location).get(date)
+    if source is None:
+        return fpath, None
+    return fpath.with_name(file_name(source, maestra_version, location)), int(f'{date:%Y%m%d}')
+
+
+def source(fpath):
+    """Path to the file read for a day file, itself unless it is an aliased day"""
+    return resolve(fpath)[0]
+
+
+def apply(df, date: int):
+    """Apply the corrections of a day file to rows read from it
+
+    Args:
+        df (pd.DataFrame): rows read with a 'fecha' column
+        date (int): YYYYMMDD date returned by resolve, None to leave the rows as read
+
+    Returns:
+        pd.DataFrame: corrected rows
+    """
+    if date is not None:
+        df['fecha'] = df['fecha'].dtype.type(date)
+    return df
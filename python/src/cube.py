@@ -0,0 +1,176 @@
+"""
+Cube.py file manage the hour and distance cube of trips between provinces.
+
+Trips are pre-aggregated at (date, hour, origin, destination, distance band),
+keeping the summed trips and trip-km, and stored as one Parquet file per day:
+
+    processed/od_cube/month=2020-06/20200601.parquet
+
+Hourly or distance analyses, and the province daily flux itself, are rolled
+up from the cube without reading the raw files again.
+"""
+import pandas as pd
+
+from utils import ints_to_days, cod_map as ine_cod_map
+import store
+
+CUBE_NAME = 'od_cube'
+CUBE_KEYS = ['date', 'hour', 'origin', 'dest', 'distance']
+CUBE_VALUES = ['trips', 'trips_km']
+# Distance bands of the opendata-movilidad files, position is the code stored
+DISTANCE_BANDS = ['0005-002', '002-005', '005-010', '010-050', '050-100', '100+']
+DISTANCE_DTYPE = pd.CategoricalDtype(DISTANCE_BANDS, ordered=True)
+
+
+def clear(root=None):
+    """Remove every day of the cube
+
+    Args:
+        root (Path, optional): Folder containing the cube. Defaults to PATHS.processed.
+    """
+    store.clear(root, CUBE_NAME)
+
+
+def list_dates(root=None) -> list:
+    """List the days of the cube
+
+    Args:
+        root (Path, optional): Folder containing the cube. Defaults to PATHS.processed.
+
+    Returns:
+        list: sorted list of datetime.date stored
+    """
+    return store.list_dates(root, CUBE_NAME)
+
+
+def arrays_to_cube(dates, origins, destinations, hours, distances, trips, trips_km) -> pd.DataFrame:
+    """Build the cube dataframe from the arrays returned by process.aggregate_day
+
+    Args:
+        dates (np.ndarray): dates as YYYYMMDD integers
+        origins (np.ndarray): integer origin province codes
+        destinations (np.ndarray): integer destination province codes
+        hours (np.ndarray): hour of the trips
+        distances (np.ndarray): position of the distance band in DISTANCE_BANDS, -1 if unknown
+        trips (np.ndarray): trips
+        trips_km (np.ndarray): trip-km
+
+    Returns:
+        pd.DataFrame: dataframe with CUBE_KEYS and CUBE_VALUES columns
+    """
+    return pd.DataFrame({
+        'date': ints_to_days(dates),
+        'hour': hours.astype('int8'),
+        'origin': origins.astype('int8'),
+        'dest': destinations.astype('int8'),
+        'distance': pd.Categorical.from_codes(distances, dtype=DISTANCE_DTYPE),
+        'trips': trips,
+        'trips_km': trips_km,
+    })
+
+
+def write_days(cube: pd.DataFrame, root=None) -> list:
+    """Write a partition file for each day of the cube, replacing existing ones
+
+    Args:
+        cube (pd.DataFrame): cube with CUBE_KEYS and CUBE_VALUES columns
+        root (Path, optional): Folder containing the cube. Defaults to PATHS.processed.
+
+    Returns:
+        list: paths to the written partition files
+    """
+    files = []
+    for date, day in cube[CUBE_KEYS + CUBE_VALUES].groupby('date', sort=True):
+        fpath = store.day_path(date, root, CUBE_NAME)
+        store.write_partition(day, fpath)
+        files.append(fpath)
+    return files
+
+
+def read_cube(start=None, end=None, dates=None, hours=None, distances=None, root=None) -> pd.DataFrame:
+    """Read the cube, filtering hours and distance bands while reading
+
+    Args:
+        start (datetime.date, optional): First day to read. Defaults to first day stored.
+        end (datetime.date, optional): Last day to read. Defaults to last day stored.
+        dates (list, optional): Only read these days. Defaults to every day between start and end.
+        hours (list, optional): Only read these hours. Defaults to every hour.
+        distances (list, optional): Only read these distance bands. Defaults to every band.
+        root (Path, optional): Folder containing the cube. Defaults to PATHS.processed.
+
+    Raises:
+        ValueError: distances must be valid distance bands.
+        FileNotFoundError: Error if the cube has no data for the requested period
+
+    Returns:
+        pd.DataFrame: cube sorted by date
+    """
+    if distances is not None and not set(distances) <= set(DISTANCE_BANDS):
+        raise ValueError(f'distances {distances} is not a valid input. Valid distances are: {", ".join(DISTANCE_BANDS)}')
+    dates = store.select_dates(list_dates(root), start, end, dates)
+    if not dates:
+        raise FileNotFoundError(f'No cube stored in {store.store_dir(root, CUBE_NAME)} for the period {start} - {end}')
+
+    filters = []
+    if hours is not None:
+        filters.append(('hour', 'in', [int(h) for h in hours]))
+    if distances is not None:
+        filters.append(('distance', 'in', list(distances)))
+    cube = pd.concat([pd.read_parquet(store.day_path(d, root, CUBE_NAME), filters=filters or None)
+                      for d in dates], ignore_index=True)
+    cube['distance'] = cube['distance'].astype('string').astype(DISTANCE_DTYPE)
+    return cube
+
+
+def rollup(by=('date', 'origin', 'dest'), start=None, end=None, dates=None,
+           hours=None, distances=None, root=None) -> pd.DataFrame:
+    """Sum trips and trip-km of the cube over the keys not in `by`
+
+    Args:
+        by (tuple, optional): Keys kept, a subset of CUBE_KEYS. Defaults to ('date', 'origin', 'dest').
+        start (datetime.date, optional): First day. Defaults to first day stored.
+        end (datetime.date, optional): Last day. Defaults to last day stored.
+        dates (list, optional): Only these days. Defaults to every day between start and end.
+        hours (list, optional): Only these hours. Defaults to every hour.
+        distances (list, optional): Only these distance bands. Defaults to every band.
+        root (Path, optional): Folder containing the cube. Defaults to PATHS.processed.
+
+    Raises:
+        ValueError: by must only contain keys of the cube.
+
+    Returns:
+        pd.DataFrame: dataframe with the `by` columns, trips and trips_km
+    """
+    by = list(by)
+    if not set(by) <= set(CUBE_KEYS):
+        raise ValueError(f'by {by} is not a valid input. Valid keys are: {", ".join(CUBE_KEYS)}')
+    cube = read_cube(start, end, dates, hours, distances, root)
+    # Trips of unknown distance bands are kept in their own NaN group, so totals match the cube
+    return cube.groupby(by, sort=True, observed=True, dropna=False)[CUBE_VALUES].sum().reset_index()
+
+
+def province_flux(cod_map: dict = None, start=None, end=None, dates=None,
+                  hours=None, distances=None, root=None) -> pd.DataFrame:
+    """Daily trips between provinces derived from the cube, as in the province flux store
+
+    Args:
+        cod_map (dict, optional): INE code to province name. Defaults to the INE code map in the raw folder.
+        start (datetime.date, optional): First day. Defaults to first day stored.
+        end (datetime.date, optional): Last day. Defaults to last day stored.
+        dates (list, optional): Only these days. Defaults to every day between start and end.
+        hours (list, optional): Only trips of these hours. Defaults to every hour.
+        distances (list, optional): Only trips of these distance bands. Defaults to every band.
+        root (Path, optional): Folder containing the cube. Defaults to PATHS.processed.
+
+    Returns:
+        pd.DataFrame: province flux with store.FLUX_COLUMNS
+    """
+    if cod_map is None:
+        cod_map = ine_cod_map()
+    flux = rollup(('date', 'origin', 'dest'), start, end, dates, hours, distances, root)
+    flux = flux.rename(columns={'trips': 'flux'})
+    flux['province id origin'] = flux['origin'].map('{:02d}'.format)
+    flux['province id destination'] = flux['dest'].map('{:02d}'.format)
+    flux['province origin'] = flux['province id origin'].map(cod_map)
+    flux['province destination'] = flux['province id destination'].map(cod_map)
+    return flux[store.FLUX_COLUMNS]
@@ -1,37 +1,59 @@
 """
 Download.py file download data from the opendata server.
+
+requests, tqdm and urllib3 are imported when files are downloaded, so
+commands only planning downloads start fast.
 """
-import pandas as pd
 import os
+import time
 import datetime
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from utils import PATHS, BASE_URL, MAESTRA_VALID_VALUES, LOCATION_VALID_VALUES, check_dirs
-from requests import Session
-from tqdm import tqdm
-from urllib3.exceptions import InsecureRequestWarning
-from urllib3 import disable_warnings
+import instrument
+import corrections
+from raw_store import RawStore, validate_gzip
 
 import click
 
+# Client errors not solved by retrying the request, 404 and 416 are handled by fetch_file
+PERMANENT_ERRORS = (400, 401, 403, 405, 410, 451)
+# Last day downloaded when not updating
+LAST_DAY = datetime.date(2021, 5, 9)
+
 @click.command()
 @click.option('--maestra-version', '-mv', default='maestra1', help="Version of maestra from where to download.")
 @click.option('--location', '-l', default='municipios', help="Locations of data.")
 @click.option('--update', '-u', is_flag=True, default='False', help="Update current files without overwriting.")
-@click.option('--force', '-f', is_flag=True, default='False', help="Force to redownload data even if it is already downloaded.")
+@click.option('--force', '-f', is_flag=True, default='False', help="Refresh downloaded data, only transferring files changed in the server.")
+@click.option('--workers', '-w', default=8, help="Number of files downloaded concurrently.")
+@click.option('--retries', '-r', default=3, help="Number of retries for each file before giving up.")
+@click.option('--profile', default=None, type=click.Choice(instrument.PROFILE_VALID_VALUES), help="Profile the run.")
+@instrument.instrumented('download')
 def download(maestra_version:str='maestra1', 
             location:str='municipios', 
             update:bool=False, 
             force:bool=False,
+            workers:int=8,
+            retries:int=3,
             start:datetime.date=datetime.date(2020, 2, 21),
-            end:datetime.date=datetime.date(2021, 5, 9)) -> list:  
+            end:datetime.date=None,
+            base_url:str=BASE_URL) -> list:  
     """Download files from opendata-movilidad
 
     Args:
         maestra_version (str, optional): Version of maestra from where to download. Valid versions are 'maestra1' and 'maestra2'. Defaults to 'maestra1'.
         location (str, optional): Locations of data. Valid locations are 'distritos' and 'municipios'. Defaults to 'municipios'.
-        update (bool, optional): Only download data not already downloaded. Defaults to False.
-        force (bool, optional): Force to redownload data even if it is already downloaded. Defaults to False.
+        update (bool, optional): Only download data not already downloaded, including gaps between downloaded days. Defaults to False.
+        force (bool, optional): Refresh data already downloaded, with conditional requests so only
+            files changed in the server are transferred again. Defaults to False.
+        workers (int, optional): Number of files downloaded concurrently. Defaults to 8.
+        retries (int, optional): Number of retries for each file before giving up. Defaults to 3.
+        start (datetime.date, optional): First day, if not updating or nothing is downloaded. Defaults to 2020-02-21.
+        end (datetime.date, optional): Last day. Defaults to 2021-05-09, or today when updating.
+        base_url (str, optional): Server from where to download the files. Defaults to BASE_URL.
+        profile (str, optional): Profile the run with 'cprofile' or 'pyinstrument'. Defaults to None.
 
     Raises:
         ValueError: maestra_version must be one of the valid versions.
@@ -47,6 +69,12 @@ def download(maestra_version:str='maestra1',
     if location not in LOCATION_VALID_VALUES:
         raise ValueError(f'locations {location} is not a valid input. Valid locations are: {", ".join(LOCATION_VALID_VALUES)} ')
     
+    from requests import Session
+    from requests.adapters import HTTPAdapter
+    from tqdm import tqdm
+    from urllib3.exceptions import InsecureRequestWarning
+    from urllib3 import disable_warnings
+
     # Avoid printing warnings due to unverified url
     disable_warnings(InsecureRequestWarning)
 
@@ -54,84 +82,192 @@ def download(maestra_version:str='maestra1',
     files = []
     raw_dir = PATHS.raw / f'{maestra_version}' / f'{location}'
     raw_dir.exists() or os.makedirs(raw_dir)
+    raw = RawStore(raw_dir)
 
     # Generate time range
-    lsfiles = sorted(os.listdir(raw_dir))
-    if update:
-        start = datetime.datetime.strptime(lsfiles[-1][:8], '%Y%m%d').date()
-        start += datetime.timedelta(days=1)
-        end = datetime.datetime.today().date()
-    dates = pd.date_range(start, end, freq='d')
-
-    if dates.empty:
+    dates = download_dates(raw_dir, update, force, start, end)
+    if not dates:
         print('Already up-to-date')
         return []
 
-    # Download files
-    print(f'Downloading files for the period {start} - {end}')
-    s = Session()
-    for d in tqdm(dates):
-        url = f'{BASE_URL}/{maestra_version}-mitma-{location}/ficheros-diarios/{d:%Y}-{d:%m}/{d:%Y%m%d}_maestra_{maestra_version[-1]}_mitma_{location[:-1]}.txt.gz'
+    # Select files to download, aliased days are also requested as the server may publish them later
+    aliases = corrections.aliases(maestra_version, location)
+    todo = []
+    for d in dates:
+        url = f'{base_url}/{maestra_version}-mitma-{location}/ficheros-diarios/{d:%Y}-{d:%m}/{corrections.file_name(d, maestra_version, location)}'
 
         aux = urllib.parse.urlparse(url)
         fpath = os.path.basename(aux.path)
         fpath = raw_dir / fpath
 
-        if fpath.exists() and not force:
+        # Files not in the raw store (e.g. downloaded by a previous version) are validated once
+        if not force and fpath.exists() and raw.check([fpath])[0]:
             print(f"\t {os.path.basename(url)} already downloaded, not overwriting it."
-                " To overwrite it use (force=True)")
+                " To refresh it use (force=True)")
             continue
+        todo.append((d, url, fpath))
 
-        try:
-            resp = s.get(url, verify=False)
-            if resp.status_code == 404:
-                print(f'{d.date()} not available yet')
-                continue
-            with open(fpath, 'wb') as f:
-                f.write(resp.content)
-            files.append(fpath)
-
-        except Exception as e:
-            print(f'Error downloading {url} with error {e}')
-    # Fix error in original dataset
+    # Download files concurrently sharing a pool of connections
+    print(f'Downloading files for the period {dates[0]} - {dates[-1]}')
+    s = Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
     try:
-        fix_1207()
-    except:
-        print('No fixes needed as 07-2020 is not in downloaded files')
-    return files
+        with instrument.stage('fetch files') as stage, ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(fetch_file, s, url, fpath, retries, force, raw=raw): (d, url, fpath)
+                       for d, url, fpath in todo}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                d, url, fpath = futures[future]
+                try:
+                    status = future.result()
+                    if status == 'downloaded':
+                        files.append(fpath)
+                        stage.add('bytes_written', instrument.file_size(fpath))
+                    elif status == 'missing' and d in aliases:
+                        print(f"\t {d} not available, read from {aliases[d]}, see corrections.py")
+                    elif status == 'missing':
+                        print(f'{d} not available yet')
+                except Exception as e:
+                    print(f'Error downloading {url} with error {e}')
+    finally:
+        raw.save()
+    return sorted(files)
+
+def date_range(start: datetime.date, end: datetime.date) -> list:
+    """Every day between start and end, both included"""
+    return [start + datetime.timedelta(days=i) for i in range((end - start).days + 1)]
 
-def fix_1207():
+def download_dates(raw_dir,
+                   update: bool = False,
+                   force: bool = False,
+                   start: datetime.date = datetime.date(2020, 2, 21),
+                   end: datetime.date = None) -> list:
+    """Days to download into a raw folder
+
+    Args:
+        raw_dir (Path): folder of the raw files
+        update (bool, optional): Download from the first day downloaded until end, skipping
+            the days already downloaded. Defaults to False.
+        force (bool, optional): In update mode, also download the days already downloaded. Defaults to False.
+        start (datetime.date, optional): First day, if not updating or nothing is downloaded. Defaults to 2020-02-21.
+        end (datetime.date, optional): Last day, never after today when updating.
+            Defaults to 2021-05-09, or today when updating.
+
+    Returns:
+        list: datetime.date to download
     """
-    Fix error in original dataset (see README)
+    if not update:
+        return date_range(start, LAST_DAY if end is None else end)
+    # Fill gaps between downloaded days and download the new ones
+    lsfiles = sorted(f for f in os.listdir(raw_dir) if f.endswith('.txt.gz')) if raw_dir.exists() else []
+    if lsfiles:
+        start = datetime.datetime.strptime(lsfiles[0][:8], '%Y%m%d').date()
+    today = datetime.datetime.today().date()
+    end = today if end is None else min(end, today)
+    downloaded = {f[:8] for f in lsfiles}
+    return [d for d in date_range(start, end) if f'{d:%Y%m%d}' not in downloaded or force]
+
+def _expected_size(resp) -> int:
+    """Total size in bytes of the file sent in a response, None if unknown"""
+    if resp.headers.get('Content-Encoding'):
+        # Length of the encoded content, not of the file written
+        return None
+    if resp.status_code == 206:
+        total = resp.headers.get('Content-Range', '').rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+    length = resp.headers.get('Content-Length')
+    return int(length) if length is not None and length.isdigit() else None
+
+def fetch_file(session,
+               url:str,
+               fpath,
+               retries:int=3,
+               restart:bool=False,
+               backoff:float=1.0,
+               chunk_size:int=1 << 20,
+               raw:RawStore=None) -> str:
+    """Download a single file streaming it to a temporary '.part' file
+
+    The file is only stored once it has been completely downloaded and
+    validated as a gzip file, so an interrupted download or an error page never
+    looks like a downloaded day. If a '.part' file is found the download is
+    resumed with an HTTP Range request. If the file is already in the raw store,
+    a conditional request is sent so an unchanged file is not transferred again.
+
+    Args:
+        session (requests.Session): session used to download the file
+        url (str): url of the file
+        fpath (Path): final path of the downloaded file
+        retries (int, optional): Number of retries before giving up. Defaults to 3.
+        restart (bool, optional): Discard any partial download of the file. Defaults to False.
+        backoff (float, optional): Seconds to wait before the first retry, doubled on each retry. Defaults to 1.0.
+        chunk_size (int, optional): Size in bytes of the chunks written to disk. Defaults to 1 MiB.
+        raw (RawStore, optional): Store of the raw files. Defaults to the store of the folder of fpath.
+
+    Raises:
+        Exception: Error if the file could not be downloaded after all the retries,
+            or at once if the server answers with an error page or a client error
+
+    Returns:
+        str: 'downloaded', 'not modified' if the file has not changed in the server,
+            or 'missing' if it is not available in the server
     """
-    raw_dir = PATHS.raw / 'maestra1' / 'municipios'
-    src = raw_dir / '20200705_maestra_1_mitma_municipio.txt.gz'
-    dst = raw_dir / '20200712_maestra_1_mitma_municipio.txt.gz'
-
-    df = pd.read_csv(src,
-                    sep='|',
-                    thousands='.',
-                    dtype={'origen': 'string', 'destino': 'string'},
-                    compression='gzip')
-
-    # Replace date
-    df['fecha'] = '20200712'
-
-    # Apply thousands separator
-    def add_sep(x):
-        x = str(x)
-        if len(x) > 3:
-            return f'{str(x)[:-3]}.{str(x)[-3:]}'
-        else:
-            return x
-
-    df['viajes'] = df['viajes'].apply(add_sep)
-    df['viajes_km'] = df['viajes_km'].apply(add_sep)
-
-    df.to_csv(dst,
-            sep='|',
-            compression='gzip',
-            index=False)
-    
+    from requests import RequestException
+
+    raw = RawStore(fpath.parent) if raw is None else raw
+    tic = time.perf_counter()
+    part = fpath.with_name(fpath.name + '.part')
+    if restart and part.exists():
+        os.remove(part)
+    conditional = raw.conditional_headers(fpath)
+    resp_headers = {}
+
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        offset = part.stat().st_size if part.exists() else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else conditional
+        try:
+            with session.get(url, headers=headers, stream=True, verify=False, timeout=60) as resp:
+                if resp.status_code in (404, 304):
+                    status = 'missing' if resp.status_code == 404 else 'not modified'
+                    instrument.record_file(file=fpath.name, status=resp.status_code, attempts=attempt + 1,
+                                           seconds=round(time.perf_counter() - tic, 4))
+                    return status
+                if resp.status_code != 416:
+                    if 'html' in resp.headers.get('Content-Type', '') or resp.status_code in PERMANENT_ERRORS:
+                        # Error pages and client errors are not solved by retrying
+                        raise Exception(f'unexpected response {resp.status_code} '
+                                        f'{resp.headers.get("Content-Type")}, not retrying')
+                    resp.raise_for_status()
+                    if resp.status_code not in (200, 206):
+                        raise RequestException(f'unexpected response {resp.status_code} '
+                                               f'{resp.headers.get("Content-Type")}')
+                    # Server may ignore the Range header and send the whole file
+                    mode = 'ab' if resp.status_code == 206 else 'wb'
+                    with open(part, mode) as f:
+                        for chunk in resp.iter_content(chunk_size=chunk_size):
+                            f.write(chunk)
+                    resp_headers = resp.headers
+                    expected = _expected_size(resp)
+                    if expected is not None and part.stat().st_size != expected:
+                        raise RequestException(f'incomplete download, {part.stat().st_size} of {expected} bytes')
+            # 416: partial file already holds the whole content
+            if not validate_gzip(part):
+                os.remove(part)
+                raise RequestException('downloaded file is not a valid gzip file')
+            break
+        except RequestException as e:
+            error = e
+    else:
+        raise Exception(f'{retries + 1} attempts failed, last error: {error}')
+
+    raw.add(fpath, part, url, resp_headers)
+    instrument.record_file(file=fpath.name, attempts=attempt + 1, resumed_from=offset,
+                           bytes_written=instrument.file_size(fpath),
+                           seconds=round(time.perf_counter() - tic, 4))
+    return 'downloaded'
+
 if __name__ == '__main__':
     download()
\ No newline at end of file
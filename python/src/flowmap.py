@@ -2,97 +2,277 @@
 Generate the files for flowmap of existing processed files
 """
 
-import requests
+import numpy as np
 import pandas as pd
 
-from utils import PATHS
-
-import plotly.express as px
-
-def generate_flowmap_data():
-
-    flows = pd.read_csv(PATHS.processed / "province_flux.csv", sep=";", encoding='latin1')
-
-    # Load coordinates of places
-    f = PATHS.processed / "flowmap_coord.csv"
-    if not f.exists():
-        lat, lon = [], []
-        names = sorted(set(flows['province origin']))
-        for province in names:
-            url = 'https://nominatim.openstreetmap.org/search'
-            if province in ['Ceuta', 'Melilla']:
-                params = {'city': province, 'country': 'spain', 'format': 'json'}
-            else:
-                params = {'county': correct_provinces_name(province), 'country': 'spain', 'format': 'json'}
-            r = requests.get(url, params=params)
-            r = r.json()[0]
-            lat.append(r['lat'])
-            lon.append(r['lon'])
-
-        coord = pd.DataFrame({'name': names, 'lat': lat, 'lon': lon})
-        coord.to_csv(
-            PATHS.processed / "flowmap_coord.csv",
-            index=False, 
-            encoding='latin1', 
-            sep=";"
-        )
-    else:
-        coord = pd.read_csv(f, encoding='latin1', sep=";")
-
-    # Save locations
-    locations = flows.groupby(['province origin', 'province id origin']).size().reset_index()
-    locations = locations.drop(0, axis=1)
-    locations = locations.rename(columns={"province origin": "name", "province id origin": "id"})
-    locations = locations.merge(coord)
-    locations = locations[['id', 'name', 'lat', 'lon']]
-
-    locations.to_csv(
-        PATHS.processed / "flowmap_locations.csv",
-        index=False, sep=";", 
-        encoding='latin1'
-    )
-
-    # Save flows
-    flows = flows.rename(columns={"province id origin": "origin",
-                                "province id destination": "dest",
-                                "flux": "count",
-                                "date": "time"})
-    flows = flows.drop(['province origin', 'province destination'], axis=1)
-
-    flows.to_csv(
-        PATHS.processed / "flowmap_flows.csv",
-        index=False, encoding='latin1', sep=";"
-    )
-    
-    # Merge both dataframes to have names of locations associated to flows
-    flows_locations = pd.merge(flows, locations, left_on='origin', right_on='id')
-    flows_locations = flows_locations.drop(columns='id')
-    flows_locations = flows_locations.rename(columns={'name':'origin_name','lat':'orig_lat','lon':'orig_lon'})
-    flows_locations = pd.merge(flows_locations, locations, left_on='dest', right_on='id')
-    flows_locations = flows_locations.drop(columns='id')
-    flows_locations = flows_locations.rename(columns={'name':'dest_name','lat':'dest_lat','lon':'dest_lon'})
-    
-    flows_locations.to_csv(
-        PATHS.processed / "flowmap_flows_location.csv",
-        index=False, encoding='latin1', sep=";"
-    )
-
-def correct_provinces_name(province:str) -> str:
-    """Correct name of the province in order to obtain correct latitude and longitude
+from utils import PATHS, province_names
+import store
+import zones
+import sparse_od
+from manifest import Manifest
+from geo import CoordinateCache, zone_centroids
+import instrument
+
+import click
+
+# wide: flows with codes, and flows with names and coordinates of locations (csv)
+# codes: flows with integer codes and locations table only (csv)
+# parquet: flows with integer codes and locations table only (parquet)
+# Each output writes its own files and has its own stale dates in the manifest
+OUTPUT_VALID_VALUES = ('wide', 'codes', 'parquet')
+# Provinces are read from the province flux store, finer zones from their sparse OD matrices
+LEVEL_VALID_VALUES = ('province',) + zones.LEVELS[:2]
+
+def stage_name(output: str = 'wide') -> str:
+    """Stage of the manifest tracking the dates pending in the files of an output"""
+    return f'flowmap:{output}'
+
+def flowmap_path(table: str, output: str = 'wide', level: str = 'province'):
+    """Path to a flowmap file
+
+    Wide files keep the names read by the R dashboard, e.g. flowmap_flows.csv,
+    codes files add the name of the output, e.g. flowmap_codes_flows.csv, and
+    parquet files their extension, e.g. flowmap_municipality_locations.parquet.
+
+    Args:
+        table (str): 'flows', 'locations' or 'flows_location'
+        output (str, optional): Output of the file, one of OUTPUT_VALID_VALUES. Defaults to 'wide'.
+        level (str, optional): Zone level of the file, one of LEVEL_VALID_VALUES. Defaults to 'province'.
+
+    Returns:
+        Path: path to the file in the processed folder
+    """
+    ext = 'parquet' if output == 'parquet' else 'csv'
+    prefix = 'flowmap' if level == 'province' else f'flowmap_{level}'
+    if output == 'codes':
+        prefix = f'{prefix}_codes'
+    return PATHS.processed / f'{prefix}_{table}.{ext}'
+
+def materialize_locations(flows: pd.DataFrame, locations: pd.DataFrame) -> pd.DataFrame:
+    """Add names and coordinates of origin and destination locations to flows
+
+    Locations are looked up by position with a hash index on their id, so flow
+    rows are not widened by merges and names are kept as categoricals.
+
+    Args:
+        flows (pd.DataFrame): flows with 'origin' and 'dest' ids
+        locations (pd.DataFrame): locations with 'id', 'name', 'lat' and 'lon' columns
+
+    Returns:
+        pd.DataFrame: flows with origin_name, orig_lat, orig_lon, dest_name, dest_lat and dest_lon columns
+    """
+    ids = pd.Index(locations['id'].astype(str))
+    names = pd.Categorical(locations['name'])
+    lat = locations['lat'].to_numpy()
+    lon = locations['lon'].to_numpy()
+
+    flows = flows.copy()
+    for col, prefix, name_col in (('origin', 'orig', 'origin_name'), ('dest', 'dest', 'dest_name')):
+        pos = ids.get_indexer(flows[col].astype(str))
+        if (pos < 0).any():
+            # Same behaviour as an inner merge, flows of unknown locations are dropped
+            flows, pos = flows[pos >= 0], pos[pos >= 0]
+        flows[name_col] = pd.Categorical.from_codes(names.codes[pos], names.categories)
+        flows[f'{prefix}_lat'] = lat[pos]
+        flows[f'{prefix}_lon'] = lon[pos]
+    return flows
+
+def flowmap_tables(flux: pd.DataFrame, output: str = 'wide', previous: pd.DataFrame = None) -> dict:
+    """Build the flowmap tables from the province flux, without writing them
+
+    Args:
+        flux (pd.DataFrame): province flux with store.FLUX_COLUMNS
+        output (str, optional): Tables to build, one of OUTPUT_VALID_VALUES. 'wide' keeps
+            string location ids and also builds the flows with names and coordinates of
+            their locations. Defaults to 'wide'.
+        previous (pd.DataFrame, optional): Locations of other days, kept in the locations
+            table besides the ones of flux. Defaults to None.
+
+    Raises:
+        ValueError: output must be one of the valid outputs.
+
+    Returns:
+        dict: 'locations' and 'flows' tables, and 'flows_location' if output is 'wide'
+    """
+    if output not in OUTPUT_VALID_VALUES:
+        raise ValueError(f'output {output} is not a valid input. Valid outputs are: {", ".join(OUTPUT_VALID_VALUES)}')
+    with instrument.stage('locations') as stage:
+        locations = flux.groupby(['province origin', 'province id origin'], observed=True).size().reset_index()
+        locations = locations.drop(0, axis=1)
+        locations = locations.rename(columns={"province origin": "name", "province id origin": "id"})
+        locations = locations.merge(CoordinateCache().lookup(locations['id']), on='id')
+        locations = locations[['id', 'name', 'lat', 'lon']]
+        locations['id'] = locations['id'].astype(str if output == 'wide' else 'int8')
+        if previous is not None:
+            previous = previous.astype({'id': locations['id'].dtype})
+            locations = pd.concat([previous, locations.astype({'name': 'string'})])
+            # Same order as the locations of a full run
+            locations = locations.drop_duplicates('id', keep='last').sort_values(['name', 'id'])
+        stage['rows_out'] = len(locations)
+
+    with instrument.stage('flows', rows_in=len(flux)):
+        flows = flux.rename(columns={"province id origin": "origin",
+                                     "province id destination": "dest",
+                                     "flux": "count",
+                                     "date": "time"})
+        flows = flows.drop(['province origin', 'province destination'], axis=1)
+        if output != 'wide':
+            flows['origin'] = flows['origin'].astype('int8')
+            flows['dest'] = flows['dest'].astype('int8')
+    tables = {'locations': locations, 'flows': flows}
+
+    if output == 'wide':
+        # Names and coordinates of locations are only materialized for the dashboard file
+        with instrument.stage('flows location', rows_in=len(flows)) as stage:
+            tables['flows_location'] = materialize_locations(flows, locations)
+            stage['rows_out'] = len(tables['flows_location'])
+    return tables
+
+def zone_flowmap_tables(level: str, start=None, end=None, top_k: int = None,
+                        per_origin: bool = False, min_flux: float = None) -> dict:
+    """Build the flowmap tables of a zone level from its sparse OD matrices
+
+    Flows are filtered on the matrices of each day, so only the flows kept
+    become rows. Zones are placed at their centroid from geo.zone_centroids.
+    Zones without centroid are placed at the centroid of their province, with
+    a warning, so their flows are only meaningful between provinces.
 
     Args:
-        province (str): name of the province, spanish encoded
+        level (str): 'district' or 'municipality'
+        start (datetime.date, optional): First day of the flows. Defaults to first day stored.
+        end (datetime.date, optional): Last day of the flows. Defaults to last day stored.
+        top_k (int, optional): Keep the top_k largest flows of each day. Defaults to None, keeping every flow.
+        per_origin (bool, optional): Keep the top_k largest flows of each origin instead. Defaults to False.
+        min_flux (float, optional): Only keep flows with at least these trips. Defaults to None.
 
     Returns:
-        str: correct name of the province for openstreetmap website
+        dict: 'locations' table with id, code, name, lat and lon of the zones in the flows,
+            and whether they are placed at their province centroid, and 'flows' table
+            with integer zone ids
+    """
+    with instrument.stage(f'read {level} od matrices') as stage:
+        flows = sparse_od.flows(level, start, end, k=top_k, per_origin=per_origin, min_flux=min_flux)
+        stage['rows_out'] = len(flows)
+
+    with instrument.stage('locations') as stage:
+        ids = pd.unique(pd.concat([flows['origin'], flows['dest']]))
+        ids.sort()
+        codes = sparse_od.zone_index(level)[ids]
+        province = zones.ZoneHierarchy.province(codes)
+        provinces = zones.CODE_LABELS[province]
+        coords = CoordinateCache().lookup(provinces)
+        lat, lon = coords['lat'].to_numpy(), coords['lon'].to_numpy()
+        fallback = np.ones(len(codes), dtype=bool)
+        centroids = zone_centroids(level)
+        if centroids is not None:
+            pos = pd.Index(centroids['id'].astype(str)).get_indexer(codes)
+            fallback = pos < 0
+            lat = np.where(fallback, lat, centroids['lat'].to_numpy()[pos])
+            lon = np.where(fallback, lon, centroids['lon'].to_numpy()[pos])
+        if fallback.any():
+            print(f'Warning: {fallback.sum()} of {len(codes)} {level} zones have no centroid and are placed '
+                  f'at the centroid of their province, add them to raw/zonificacion/centroides_{level}.csv')
+        locations = pd.DataFrame({'id': ids.astype('int32'), 'code': codes.to_numpy(dtype=object),
+                                  'name': province_names()[province],
+                                  'lat': lat, 'lon': lon, 'province_centroid': fallback})
+        stage['rows_out'] = len(locations)
+    return {'locations': locations, 'flows': flows}
+
+def write_flowmap(tables: dict, output: str = 'wide', dates=None, level: str = 'province'):
+    """Write the flowmap tables built by flowmap_tables
+
+    Args:
+        tables (dict): tables returned by flowmap_tables
+        output (str, optional): Output the tables were built for, selecting the format
+            of the files. Defaults to 'wide'.
+        dates (list, optional): Days of the flows. If given, only these days are replaced
+            in existing files. Defaults to None, writing whole files.
+        level (str, optional): Zone level of the tables, see flowmap_path. Defaults to 'province'.
+    """
+    for table in ('locations', 'flows', 'flows_location'):
+        if table not in tables:
+            continue
+        fpath = flowmap_path(table, output, level)
+        with instrument.stage(f'write {table.replace("_", " ")}', rows_in=len(tables[table])) as stage:
+            # Locations are always written whole, they include the locations of other days
+            store.write_table(tables[table], fpath, None if table == 'locations' else dates)
+            stage['bytes_written'] = instrument.file_size(fpath)
+
+@instrument.instrumented('flowmap')
+def generate_flowmap_data(start=None, end=None, update=False, output='wide', level='province',
+                          top_k=None, per_origin=False, min_flux=None):
+    """Generate flowmap files from the province flux store, or from the sparse OD matrices of a zone level
+
+    Args:
+        start (datetime.date, optional): First day of the flows. Defaults to first day stored.
+        end (datetime.date, optional): Last day of the flows. Defaults to last day stored.
+        update (bool, optional): Only regenerate the days processed since the last run,
+            according to the manifest. Defaults to False.
+        output (str, optional): Files to write, one of OUTPUT_VALID_VALUES. 'wide' writes
+            flowmap_flows_location.csv for the R dashboard, 'codes' and 'parquet' only write
+            flows with integer location codes and the locations table. Defaults to 'wide'.
+        level (str, optional): Zone level of the flows, one of LEVEL_VALID_VALUES. District and
+            municipality flows are read from the matrices written by process with sparse=True
+            and written to the files of the level, see flowmap_path. Defaults to 'province'.
+        top_k (int, optional): For zone levels, keep the top_k largest flows of each day. Defaults to None.
+        per_origin (bool, optional): For zone levels, keep the top_k largest flows of each origin. Defaults to False.
+        min_flux (float, optional): For zone levels, only keep flows with at least these trips. Defaults to None.
+        profile (str, optional): Profile the run with 'cprofile' or 'pyinstrument'. Defaults to None.
+
+    Raises:
+        ValueError: output must be one of the valid outputs.
+        ValueError: level must be one of the valid levels.
+        ValueError: zone levels are only written in full as 'codes' or 'parquet' outputs,
+            and filters only apply to zone levels.
     """
-    if ("/" in province):
-        return province.split("/")[0]
-    elif (province == "Coruña, A"):
-        return "A Coruna"
-    elif ("," in province):
-        return province.split(", ")[1] + " " + province.split(", ")[0]
-    return province
+    if output not in OUTPUT_VALID_VALUES:
+        raise ValueError(f'output {output} is not a valid input. Valid outputs are: {", ".join(OUTPUT_VALID_VALUES)}')
+    if level not in LEVEL_VALID_VALUES:
+        raise ValueError(f'level {level} is not a valid input. Valid levels are: {", ".join(LEVEL_VALID_VALUES)}')
+    if level != 'province':
+        if output == 'wide' or update:
+            raise ValueError(f'{level} flowmaps are only written in full with codes or parquet outputs')
+        write_flowmap(zone_flowmap_tables(level, start, end, top_k, per_origin, min_flux), output, level=level)
+        return
+    if top_k is not None or min_flux is not None:
+        raise ValueError('top_k and min_flux are only valid with district or municipality levels')
+
+    manifest = Manifest()
+    dates = None
+    tables = ('flows', 'locations', 'flows_location') if output == 'wide' else ('flows', 'locations')
+    if update and all(flowmap_path(table, output).exists() for table in tables):
+        dates = manifest.stale(stage_name(output))
+        if not dates:
+            print('Already up-to-date')
+            return
+    with instrument.stage('read store') as stage:
+        flux = store.read_flux(start=start, end=end, dates=dates)
+        stage['rows_out'] = len(flux)
+
+    # Keep locations not present in the updated days
+    previous = None if dates is None else store.read_table(flowmap_path('locations', output))
+    write_flowmap(flowmap_tables(flux, output, previous), output, dates)
+
+    manifest.clear_stale(stage_name(output))
+    manifest.save()
+
+@click.command()
+@click.option('--start', '-s', default=None, type=click.DateTime(formats=['%Y-%m-%d']), help="First day of the flows.")
+@click.option('--end', '-e', default=None, type=click.DateTime(formats=['%Y-%m-%d']), help="Last day of the flows.")
+@click.option('--update', '-u', is_flag=True, default=False, help="Only regenerate the days processed since the last run.")
+@click.option('--output', '-o', default='wide', type=click.Choice(OUTPUT_VALID_VALUES), help="Files to write.")
+@click.option('--level', '-lv', default='province', type=click.Choice(LEVEL_VALID_VALUES), help="Zone level of the flows.")
+@click.option('--top-k', '-k', default=None, type=int, help="Only keep the k largest flows of each day of a zone level.")
+@click.option('--per-origin', is_flag=True, default=False, help="Keep the k largest flows of each origin instead.")
+@click.option('--min-flux', default=None, type=float, help="Only keep flows of a zone level with at least these trips.")
+@click.option('--profile', default=None, type=click.Choice(instrument.PROFILE_VALID_VALUES), help="Profile the run.")
+def main(start, end, update, output, level, top_k, per_origin, min_flux, profile):
+    """Generate the flowmap files from the province flux store"""
+    generate_flowmap_data(start=None if start is None else start.date(),
+                          end=None if end is None else end.date(),
+                          update=update, output=output, level=level, top_k=top_k,
+                          per_origin=per_origin, min_flux=min_flux, profile=profile)
 
 if __name__ == '__main__':
-    generate_flowmap_data() 
+    main()
+
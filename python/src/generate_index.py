@@ -1,126 +1,629 @@
 """
 Generate input and output mobility index for each province based on flows
+
+Indexes are stored in a file per month, so updating some days only rewrites
+the months containing them:
+
+    processed/mobility_index/month=2020-06/20200601.parquet
+
+mobility_index.csv, read by the R dashboard, is exported from the whole store
+when requested.
+
+Indexes of each day only depend on the flows of that day, its rolling window
+and the baselines, so with sharded=True the days are split by the month
+partitions of the store and each shard is computed in a pool of processes,
+reading only its days from the OD tensor. Shards are written to
+
+    processed/mobility_index_shards/month=2020-06/20200601.parquet
+
+and concatenated into the index files at the end.
 """
+import datetime
+import time
+from functools import partial
+from multiprocessing import Pool
+
 import pandas as pd
-from utils import PATHS
+from utils import PATHS, N_CODES, to_days, weekday, isin_days, read_reference, province_names, province_ccaa, ccaa_names
+import store
+from od_tensor import ODTensor
+from manifest import Manifest, file_hash
+import instrument
 import numpy as np
 
-def generate_index():
-    flows = pd.read_csv(PATHS.processed / 'flowmap_flows_location.csv', encoding='latin1', sep=';')
-    indexes = flows.drop(columns=['origin', 'dest','orig_lat', 'orig_lon', 'dest_lat', 'dest_lon']).groupby(by=['time','origin_name','dest_name'], as_index=False).sum(numeric_only=True)
-    
-    ## INTERNAL INDEX
-    internal_indexes = indexes[indexes['origin_name'] == indexes['dest_name']]
-    internal_indexes = internal_indexes.drop(columns=['dest_name'])
-    internal_indexes.reset_index(drop=True, inplace=True)
-    
-    # OUTWARD INDEX
-    outward_indexes = indexes[indexes['origin_name'] != indexes['dest_name']]
-    outward_indexes.reset_index(drop=True, inplace=True)
-    outward_indexes = outward_indexes.groupby(by=['time','origin_name'], as_index=False).sum(numeric_only=True)
-    
-    # INWARD INDEX
-    inward_indexes = indexes[indexes['origin_name'] != indexes['dest_name']]
-    inward_indexes.reset_index(drop=True, inplace=True)
-    inward_indexes = inward_indexes.groupby(by=['time','dest_name'], as_index=False).sum(numeric_only=True) 
-    
-    # INDEX NAME
-    internal_indexes['index'] = 'INTERNAL'
-    outward_indexes['index'] = 'OUTWARD'
-    inward_indexes['index'] = 'INWARD'
-    
-    # Include whole spain
-    spain_internal_index = internal_indexes.groupby(by=['time','index'], as_index=False).sum(numeric_only=True)
-    spain_outward_index = outward_indexes.groupby(by=['time','index'], as_index=False).sum(numeric_only=True)
-    spain_inward_index = inward_indexes.groupby(by=['time','index'], as_index=False).sum(numeric_only=True)
-    spain_internal_index['origin_name'] = 'Spain (Total)'
-    spain_outward_index['origin_name'] = 'Spain (Total)'
-    spain_inward_index['origin_name'] = 'Spain (Total)'
-    internal_indexes = pd.concat([internal_indexes, spain_internal_index], axis=0)
-    outward_indexes = pd.concat([outward_indexes, spain_outward_index], axis=0)
-    inward_indexes = pd.concat([inward_indexes, spain_inward_index], axis=0)
-    internal_indexes['time'] = pd.to_datetime(internal_indexes['time'])
-    outward_indexes['time'] = pd.to_datetime(outward_indexes['time'])
-    inward_indexes['time'] = pd.to_datetime(inward_indexes['time'])
-    internal_indexes['weekday'] = np.array([i.weekday() for i in internal_indexes['time']])
-    outward_indexes['weekday'] = np.array([i.weekday() for i in outward_indexes['time']])
-    inward_indexes['weekday'] = np.array([i.weekday() for i in inward_indexes['time']])
-    index = pd.concat([internal_indexes, outward_indexes, inward_indexes], axis=0)
-    
-    # Create reference indexes
-    internal_indexes['time'] = pd.to_datetime(internal_indexes['time'])
-    outward_indexes['time'] = pd.to_datetime(outward_indexes['time'])
-    inward_indexes['time'] = pd.to_datetime(inward_indexes['time'])
-    # Create range of reference for MAY
-    ref2_date_range = pd.date_range("2020-05-04", periods=7, freq="d")
-    mask_inward = (inward_indexes['time'] >= ref2_date_range[0]) & (inward_indexes['time'] <= ref2_date_range[-1])
-    mask_outward = (outward_indexes['time'] >= ref2_date_range[0]) & (outward_indexes['time'] <= ref2_date_range[-1])
-    mask_internal = (internal_indexes['time'] >= ref2_date_range[0]) & (internal_indexes['time'] <= ref2_date_range[-1])
-    ref2_internal_indexes = internal_indexes.loc[mask_internal]
-    ref2_outward_indexes = outward_indexes.loc[mask_outward]
-    ref2_inward_indexes = inward_indexes.loc[mask_inward]
-    ref2_index = pd.concat([ref2_internal_indexes, ref2_outward_indexes, ref2_inward_indexes], axis=0)
-    
-    # Read references for FEB
-    ref_flows = pd.read_csv(PATHS.processed / 'ref_flowmap_flows_location.csv', encoding='latin1', sep=';')
-    ref_indexes = ref_flows.drop(columns=['origin', 'dest','orig_lat', 'orig_lon', 'dest_lat', 'dest_lon']).groupby(by=['time','origin_name','dest_name'], as_index=False).sum(numeric_only=True)
-    ref_internal_indexes = ref_indexes[ref_indexes['origin_name'] == ref_indexes['dest_name']]
-    ref_internal_indexes = ref_internal_indexes.drop(columns=['dest_name'])
-    ref_internal_indexes.reset_index(drop=True, inplace=True)
-    ref_outward_indexes = ref_indexes[ref_indexes['origin_name'] != ref_indexes['dest_name']]
-    ref_outward_indexes.reset_index(drop=True, inplace=True)
-    ref_outward_indexes = ref_outward_indexes.groupby(by=['time','origin_name'], as_index=False).sum(numeric_only=True)
-    ref_inward_indexes = ref_indexes[ref_indexes['origin_name'] != ref_indexes['dest_name']]
-    ref_inward_indexes.reset_index(drop=True, inplace=True)
-    ref_inward_indexes = ref_inward_indexes.groupby(by=['time','dest_name'], as_index=False).sum(numeric_only=True)
-    ref_inward_indexes = ref_inward_indexes.rename(columns={'dest_name': 'origin_name'})
-    ref_internal_indexes['index'] = 'INTERNAL'
-    ref_outward_indexes['index'] = 'OUTWARD'
-    ref_inward_indexes['index'] = 'INWARD'
-    ref_spain_internal_index = ref_internal_indexes.groupby(by=['time','index'], as_index=False).sum(numeric_only=True)
-    ref_spain_outward_index = ref_outward_indexes.groupby(by=['time','index'], as_index=False).sum(numeric_only=True)
-    ref_spain_inward_index = ref_inward_indexes.groupby(by=['time','index'], as_index=False).sum(numeric_only=True)
-    ref_spain_internal_index['origin_name'] = 'Spain (Total)'
-    ref_spain_outward_index['origin_name'] = 'Spain (Total)'
-    ref_spain_inward_index['origin_name'] = 'Spain (Total)'
-    ref_internal_indexes = pd.concat([ref_internal_indexes, ref_spain_internal_index], axis=0)
-    ref_outward_indexes = pd.concat([ref_outward_indexes, ref_spain_outward_index], axis=0)
-    ref_inward_indexes = pd.concat([ref_inward_indexes, ref_spain_inward_index], axis=0)
-    ref_internal_indexes['time'] = pd.to_datetime(ref_internal_indexes['time'])
-    ref_outward_indexes['time'] = pd.to_datetime(ref_outward_indexes['time'])
-    ref_inward_indexes['time'] = pd.to_datetime(ref_inward_indexes['time'])
-    ref_internal_indexes['weekday'] = np.array([i.weekday() for i in ref_internal_indexes['time']])
-    ref_outward_indexes['weekday'] = np.array([i.weekday() for i in ref_outward_indexes['time']])
-    ref_inward_indexes['weekday'] = np.array([i.weekday() for i in ref_inward_indexes['time']])
-    ref_index = pd.concat([ref_internal_indexes, ref_outward_indexes, ref_inward_indexes], axis=0)
-    
-    # Calculate mobility indexes
-    index['INDEX_FEB'] = np.nan
-    index['INDEX_MAY'] = np.nan
-    for i in range(index.shape[0]):
-        origin_name_ind = index['origin_name'].iloc[i]
-        index_ind = index['index'].iloc[i]
-        weekday_ind = index['weekday'].iloc[i]
-        count_ind = index['count'].iloc[i]
-        ref_ind = ref_index.loc[(ref_index['origin_name'] == origin_name_ind) & (ref_index['index'] == index_ind) & (ref_index['weekday'] == weekday_ind),'count']
-        ref2_ind = ref2_index.loc[(ref2_index['origin_name'] == origin_name_ind) & (ref2_index['index'] == index_ind) & (ref2_index['weekday'] == weekday_ind),'count']
-
-        index['INDEX_FEB'].iloc[i] = count_ind / ref_ind
-        index['INDEX_MAY'].iloc[i] = count_ind / ref2_ind
-        
-    # ADD CCAA
-    provinces = pd.read_csv(
-        PATHS.processed / "provincias.csv",
-        encoding='latin1', sep=";"
-        )
-    provinces = provinces.iloc[:,0:2].dropna()
-    index = pd.merge(index, provinces, how='inner', left_on='origin_name', right_on='Provincia').drop(columns=['Provincia'])
-    
+import click
+
+# References of the indexes, each index is the ratio between a count and the mean count
+# of the same province, index type and weekday in its reference: the flows of a csv file
+# in the processed folder shared by every dataset or a window of days of the data
+BASELINES = [
+    {'name': 'INDEX_FEB', 'file': 'ref_flowmap_flows_location.csv'},
+    {'name': 'INDEX_MAY', 'start': datetime.date(2020, 5, 4), 'end': datetime.date(2020, 5, 10)},
+]
+
+# Days of the moving average of the counts and lag of their change (week-over-week)
+ROLLING_DAYS = 7
+ROLLING_COLUMNS = ['COUNT_MA7', 'COUNT_WOW']
+
+# Order in which indexes are stacked in the output
+INDEX_TYPES = ['INTERNAL', 'OUTWARD', 'INWARD']
+SPAIN_NAME = 'Spain (Total)'
+
+# Keys identifying a reference value for a given row of the index table
+BASELINE_KEYS = ['origin_name', 'index', 'weekday']
+
+# Store of the indexes, partitioned by month, and rows of each row group of its files
+INDEX_STORE = 'mobility_index'
+INDEX_ROW_GROUP_SIZE = 5000
+
+# Store of the index tables of each shard, removed once they are merged
+SHARD_STORE = 'mobility_index_shards'
+
+def od_matrix(flows: pd.DataFrame) -> tuple:
+    """Build dense day x origin x destination matrices of trips from a flows table
+
+    Args:
+        flows (pd.DataFrame): flows with 'time', 'origin_name', 'dest_name' and 'count' columns
+
+    Returns:
+        tuple: matrix of trips, matrix with the number of flows rows of each cell,
+            days (pd.DatetimeIndex) and province names (pd.Index) of the matrix axes
+    """
+    day_codes, days = pd.factorize(to_days(flows['time']), sort=True)
+    names = pd.Index(sorted(set(flows['origin_name'].unique()) | set(flows['dest_name'].unique())))
+    origin_codes = names.get_indexer(flows['origin_name'])
+    dest_codes = names.get_indexer(flows['dest_name'])
+
+    shape = (len(days), len(names), len(names))
+    flat = np.ravel_multi_index((day_codes, origin_codes, dest_codes), shape)
+    size = len(days) * len(names) * len(names)
+    trips = np.bincount(flat, weights=flows['count'].to_numpy(dtype='float64'), minlength=size)
+    rows = np.bincount(flat, minlength=size)
+    return trips.reshape(shape), rows.reshape(shape), pd.DatetimeIndex(days), names
+
+def indexes_from_matrix(trips: np.ndarray, rows: np.ndarray, days: pd.DatetimeIndex, names: pd.Index) -> pd.DataFrame:
+    """Compute INTERNAL, OUTWARD and INWARD indexes of each province and of Spain
+
+    Internal trips are the diagonal of each day matrix, outward trips the row
+    sums minus the diagonal and inward trips the column sums minus the diagonal.
+    Only provinces with flows of each kind get a row, as in the flows table.
+
+    Args:
+        trips (np.ndarray): day x origin x destination matrix of trips
+        rows (np.ndarray): day x origin x destination matrix with the number of flows of each cell
+        days (pd.DatetimeIndex): days of the first axis
+        names (pd.Index): province names of the second and third axes
+
+    Returns:
+        pd.DataFrame: indexes with 'time', 'origin_name', 'count', 'index' and 'weekday' columns
+    """
+    internal = trips.diagonal(axis1=1, axis2=2)
+    internal_rows = rows.diagonal(axis1=1, axis2=2)
+    counts = {'INTERNAL': internal,
+              'OUTWARD': trips.sum(axis=2) - internal,
+              'INWARD': trips.sum(axis=1) - internal}
+    present = {'INTERNAL': internal_rows > 0,
+               'OUTWARD': rows.sum(axis=2) - internal_rows > 0,
+               'INWARD': rows.sum(axis=1) - internal_rows > 0}
+
+    n_days, n_names = internal.shape
+    time = np.repeat(days.to_numpy(), n_names)
+    origin_name = np.tile(names.to_numpy(dtype=object), n_days)
+    frames = []
+    for index_type in INDEX_TYPES:
+        mask = present[index_type].ravel()
+        provinces = pd.DataFrame({'time': time[mask],
+                                  'origin_name': origin_name[mask],
+                                  'count': counts[index_type].ravel()[mask]})
+        # Include whole spain
+        spain_mask = present[index_type].any(axis=1)
+        spain = pd.DataFrame({'time': days[spain_mask],
+                              'origin_name': SPAIN_NAME,
+                              'count': (counts[index_type] * present[index_type]).sum(axis=1)[spain_mask]})
+        frame = pd.concat([provinces, spain], axis=0)
+        frame['index'] = index_type
+        frames.append(frame)
+
+    index = pd.concat(frames, axis=0)
+    index['weekday'] = weekday(index['time'])
+    return index
+
+def compute_indexes(flows: pd.DataFrame) -> pd.DataFrame:
+    """Compute mobility indexes of a flows table in a single aggregation pass
+
+    Args:
+        flows (pd.DataFrame): flows with 'time', 'origin_name', 'dest_name' and 'count' columns
+
+    Returns:
+        pd.DataFrame: indexes with 'time', 'origin_name', 'count', 'index' and 'weekday' columns
+    """
+    return indexes_from_matrix(*od_matrix(flows))
+
+def indexes_from_flux(flux: pd.DataFrame) -> pd.DataFrame:
+    """Compute mobility indexes from the province flux, as stored by process
+
+    Args:
+        flux (pd.DataFrame): province flux with store.FLUX_COLUMNS
+
+    Returns:
+        pd.DataFrame: indexes with 'time', 'origin_name', 'count', 'index' and 'weekday' columns
+    """
+    return compute_indexes(pd.DataFrame({'time': flux['date'],
+                                         'origin_name': flux['province origin'].astype(str),
+                                         'dest_name': flux['province destination'].astype(str),
+                                         'count': flux['flux']}))
+
+def indexes_from_tensor(flows: np.ndarray, days: pd.DatetimeIndex, names: list) -> pd.DataFrame:
+    """Compute mobility indexes from a slice of the OD tensor
+
+    Args:
+        flows (np.ndarray): day x origin x destination flows, NaN where there are no flows
+        days (pd.DatetimeIndex): days of the first axis
+        names (list): province names of the second and third axes
+
+    Returns:
+        pd.DataFrame: indexes with 'time', 'origin_name', 'count', 'index' and 'weekday' columns
+    """
+    # Sort provinces by name as in the flows tables
+    order = np.argsort(names)
+    flows = flows[:, order][:, :, order]
+    return indexes_from_matrix(np.nan_to_num(flows), ~np.isnan(flows), days,
+                               pd.Index(np.asarray(names, dtype=object)[order]))
+
+def baseline_days(baseline: dict) -> pd.DatetimeIndex:
+    """Days of the data used by a baseline, empty for baselines read from a file
+
+    Args:
+        baseline (dict): baseline as in BASELINES
+
+    Raises:
+        ValueError: baselines need a name and either a file or a start and end day.
+
+    Returns:
+        pd.DatetimeIndex: days of the window
+    """
+    if 'name' not in baseline or ('file' in baseline) == ('start' in baseline and 'end' in baseline):
+        raise ValueError(f'baseline {baseline} is not a valid input. Valid baselines have a name '
+                         'and either a file or a start and end day')
+    if 'file' in baseline:
+        return pd.DatetimeIndex([])
+    return pd.date_range(baseline['start'], baseline['end'], freq='d')
+
+def read_reference_index(fpath) -> pd.DataFrame:
+    """Compute the indexes of a csv file of reference flows
+
+    Args:
+        fpath (Path): path to a flows csv with 'time', 'origin_name', 'dest_name' and 'count' columns
+
+    Returns:
+        pd.DataFrame: indexes with 'time', 'origin_name', 'count', 'index' and 'weekday' columns
+    """
+    ref_flows = pd.read_csv(fpath, encoding='latin1', sep=';',
+                            usecols=['time', 'origin_name', 'dest_name', 'count'])
+    return compute_indexes(ref_flows)
+
+def baseline_index(baseline: dict, index: pd.DataFrame) -> pd.DataFrame:
+    """Indexes of the reference period of a baseline
+
+    Indexes of baselines read from a file are cached until the file changes.
+
+    Args:
+        baseline (dict): baseline as in BASELINES
+        index (pd.DataFrame): indexes containing every day of the window of the baseline
+
+    Returns:
+        pd.DataFrame: indexes of the reference period
+    """
+    if 'file' in baseline:
+        return read_reference(PATHS.processed_root / baseline['file'], read_reference_index)
+    return index[isin_days(index['time'], baseline_days(baseline))]
+
+def build_baseline(ref_index: pd.DataFrame, name: str) -> pd.DataFrame:
+    """Build the reference table with one count per (origin_name, index, weekday)
+
+    Args:
+        ref_index (pd.DataFrame): indexes of the reference period
+        name (str): name of the reference, used in messages and in the output column
+
+    Returns:
+        pd.DataFrame: reference table keyed by BASELINE_KEYS with a 'ref_{name}' column
+    """
+    duplicated = ref_index.duplicated(subset=BASELINE_KEYS, keep=False)
+    if duplicated.any():
+        n_keys = ref_index.loc[duplicated, BASELINE_KEYS].drop_duplicates().shape[0]
+        print(f'Reference {name} has more than one day for {n_keys} '
+              '(origin, index, weekday) keys, using their mean as reference.')
+    baseline = ref_index.groupby(by=BASELINE_KEYS, as_index=False)['count'].mean()
+    return baseline.rename(columns={'count': f'ref_{name}'})
+
+def add_baseline_index(index: pd.DataFrame, ref_index: pd.DataFrame, name: str) -> pd.DataFrame:
+    """Add a column with the ratio between each count and its weekday reference
+
+    Args:
+        index (pd.DataFrame): indexes with 'count' and BASELINE_KEYS columns
+        ref_index (pd.DataFrame): indexes of the reference period
+        name (str): name of the column to create
+
+    Returns:
+        pd.DataFrame: index with the new column, NaN where there is no reference
+    """
+    baseline = build_baseline(ref_index, name)
+    ref_col = f'ref_{name}'
+    index = index.merge(baseline, how='left', on=BASELINE_KEYS, validate='many_to_one')
+    missing = index[ref_col].isna()
+    if missing.any():
+        n_keys = index.loc[missing, BASELINE_KEYS].drop_duplicates().shape[0]
+        print(f'Reference {name} is missing for {n_keys} (origin, index, weekday) keys, '
+              'their index is left empty.')
+    index[name] = index['count'] / index[ref_col]
+    return index.drop(columns=[ref_col])
+
+def add_rolling_metrics(index: pd.DataFrame) -> pd.DataFrame:
+    """Add the moving average of each count over the last ROLLING_DAYS days and its change
+    with respect to ROLLING_DAYS days before
+
+    Windows are of calendar days, so a day without count leaves empty the metrics
+    of the days whose window contains it.
+
+    Args:
+        index (pd.DataFrame): indexes with 'time', 'origin_name', 'index' and 'count' columns
+
+    Returns:
+        pd.DataFrame: index with ROLLING_COLUMNS
+    """
+    keys = ['origin_name', 'index']
+    counts = index.pivot(index='time', columns=keys, values='count').asfreq('D')
+    metrics = [counts.rolling(ROLLING_DAYS, min_periods=ROLLING_DAYS).mean(),
+               counts / counts.shift(ROLLING_DAYS) - 1]
+    for name, values in zip(ROLLING_COLUMNS, metrics):
+        values = values.rename_axis('time').melt(ignore_index=False, value_name=name).reset_index()
+        index = index.merge(values, how='left', on=['time'] + keys, validate='one_to_one')
+    return index
+
+def rolling_dates(dates: list) -> pd.DatetimeIndex:
+    """Days whose rolling metrics depend on some days
+
+    Args:
+        dates (list): days changed
+
+    Returns:
+        pd.DatetimeIndex: the days and the ROLLING_DAYS days following each of them
+    """
+    days = to_days(dates)
+    return pd.DatetimeIndex(np.unique((days[:, None] + np.arange(ROLLING_DAYS + 1)).ravel()))
+
+def index_config(baselines: list) -> dict:
+    """Settings of generate_index recorded in the manifest, including the hash of the
+    content of each baseline file so editing a reference regenerates every index"""
+    config = []
+    for baseline in baselines:
+        entry = {k: str(v) for k, v in baseline.items()}
+        if 'file' in baseline:
+            fpath = PATHS.processed_root / baseline['file']
+            entry['sha256'] = file_hash(fpath) if fpath.exists() else None
+        config.append(entry)
+    return {'baselines': config, 'rolling_days': ROLLING_DAYS}
+
+def index_table(index: pd.DataFrame, baselines=None, ref_indexes=None) -> pd.DataFrame:
+    """Add the ratio to each baseline, the rolling metrics and the CCAA of each province to indexes
+
+    Args:
+        index (pd.DataFrame): indexes with ROLLING_DAYS days before each day needed, and
+            every day of the windows of the baselines if ref_indexes is not given
+        baselines (list, optional): References of the indexes, as in BASELINES. Defaults to BASELINES.
+        ref_indexes (list, optional): Indexes of the reference period of each baseline,
+            as returned by baseline_indexes. Defaults to None, taking them from index.
+
+    Returns:
+        pd.DataFrame: mobility index table as written to mobility_index.csv
+    """
+    baselines = BASELINES if baselines is None else baselines
+    with instrument.stage('baselines', rows_in=len(index)):
+        if ref_indexes is None:
+            ref_indexes = [baseline_index(baseline, index) for baseline in baselines]
+        for baseline, ref_index in zip(baselines, ref_indexes):
+            index = add_baseline_index(index, ref_index, baseline['name'])
+
+    with instrument.stage('rolling metrics', rows_in=len(index)):
+        index = add_rolling_metrics(index)
+
+    with instrument.stage('ccaa', rows_in=len(index)) as stage:
+        # ADD CCAA, the total of Spain is its own region in the dashboard
+        names = province_names()[:N_CODES]
+        known = pd.notna(names)
+        region = pd.Series(ccaa_names()[province_ccaa()[:N_CODES]][known], index=names[known])
+        region[SPAIN_NAME] = SPAIN_NAME
+        index = index.assign(CCAA=index['origin_name'].map(region).to_numpy())
+        index = index[index['CCAA'].notna()].reset_index(drop=True)
+        stage['rows_out'] = len(index)
+    return index
+
+def baseline_indexes(baselines: list, tensor: ODTensor) -> list:
+    """Indexes of the reference period of each baseline, reading only their windows from the OD tensor
+
+    Args:
+        baselines (list): References of the indexes, as in BASELINES
+        tensor (ODTensor): OD tensor of the province flux
+
+    Returns:
+        list: indexes of the reference period of each baseline
+    """
+    windows = pd.DatetimeIndex(np.unique(np.concatenate([to_days(baseline_days(b)) for b in baselines])))
+    windows = windows[(windows >= tensor.days[0]) & (windows <= tensor.days[-1])]
+    index = indexes_from_tensor(tensor.take(windows), windows, tensor.names)
+    return [baseline_index(baseline, index) for baseline in baselines]
+
+def empty_index(baselines: list) -> pd.DataFrame:
+    """Index table without rows, with the columns of the tables returned by index_table
+
+    Args:
+        baselines (list): References of the indexes, as in BASELINES
+
+    Returns:
+        pd.DataFrame: empty mobility index table
+    """
+    columns = {'time': 'datetime64[ms]', 'origin_name': 'str', 'count': 'float64', 'index': 'str', 'weekday': 'int8'}
+    columns.update({name: 'float64' for name in [b['name'] for b in baselines] + ROLLING_COLUMNS})
+    columns['CCAA'] = 'str'
+    return pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in columns.items()})
+
+def month_shards(dates) -> list:
+    """Split days into the month partitions of the store
+
+    Args:
+        dates (pd.DatetimeIndex): sorted days
+
+    Returns:
+        list: pd.DatetimeIndex of the days of each month
+    """
+    months = dates.to_period('M')
+    return [dates[months == month] for month in months.unique()]
+
+def index_shard(dates, baselines: list, ref_indexes: list, data=None, dataset=None) -> tuple:
+    """Compute the index table of a shard of days and write it to the shard store
+
+    Args:
+        dates (pd.DatetimeIndex): days of the shard
+        baselines (list): References of the indexes, as in BASELINES
+        ref_indexes (list): Indexes of the reference period of each baseline
+        data (Path, optional): Data folder. Defaults to PATHS.data of the parent process.
+        dataset (str, optional): Processed subfolder of the dataset. Defaults to None.
+
+    Returns:
+        tuple: path to the shard file and metrics of the shard
+    """
+    if data is not None:
+        PATHS.data = data
+    PATHS.dataset = dataset
+    tic = time.perf_counter()
+    tensor = ODTensor()
+    # Rolling metrics of the first days need the ROLLING_DAYS days before the shard
+    days = pd.DatetimeIndex(np.unique((to_days(dates)[:, None] - np.arange(ROLLING_DAYS + 1)).ravel()))
+    days = days[days >= tensor.days[0]]
+    flows = tensor.take(days)
+    index = index_table(indexes_from_tensor(flows, days, tensor.names), baselines, ref_indexes)
+    index = index[isin_days(index['time'], dates)]
+
+    fpath = store.day_path(dates[0], name=SHARD_STORE)
+    store.write_partition(index, fpath)
+    return fpath, {'file': fpath.name, 'days': len(dates), 'bytes_read': flows.nbytes,
+                   'rows_out': len(index), 'seconds': round(time.perf_counter() - tic, 4)}
+
+def sharded_index(dates, baselines: list, workers: int = 4) -> pd.DataFrame:
+    """Compute the index table of some days by month shards in a pool of processes
+
+    Args:
+        dates (pd.DatetimeIndex): days of the table, all of them inside the OD tensor
+        baselines (list): References of the indexes, as in BASELINES
+        workers (int, optional): Number of shards computed in parallel. Defaults to 4.
+
+    Returns:
+        pd.DataFrame: mobility index table of the days, sorted by shard
+    """
+    shards = month_shards(dates)
+    if not shards:
+        return empty_index(baselines)
+    with instrument.stage('baselines') as stage:
+        ref_indexes = baseline_indexes(baselines, ODTensor())
+        stage['rows_out'] = sum(len(ref) for ref in ref_indexes)
+
+    store.clear(name=SHARD_STORE)
+    run = partial(index_shard, baselines=baselines, ref_indexes=ref_indexes,
+                  data=PATHS.data, dataset=PATHS.dataset)
+    files = []
+    with instrument.stage('compute shards', rows_in=len(dates)) as stage:
+        # A single worker computes the shards in this process
+        if workers > 1:
+            with Pool(min(workers, len(shards))) as pool:
+                results = pool.map(run, shards, chunksize=1)
+        else:
+            results = map(run, shards)
+        for fpath, metrics in results:
+            files.append(fpath)
+            instrument.record_file(**metrics)
+            for key in ('bytes_read', 'rows_out'):
+                stage.add(key, metrics[key])
+
+    with instrument.stage('merge shards', rows_in=len(files)) as stage:
+        index = pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
+        store.clear(name=SHARD_STORE)
+        stage['rows_out'] = len(index)
+    return index
+
+def month_path(month):
+    """Path to the partition file of the indexes of a month
+
+    Args:
+        month (pd.Period): month of the partition
+
+    Returns:
+        Path: path to the partition file
+    """
+    return store.day_path(month.start_time.date(), name=INDEX_STORE)
+
+def write_index(index: pd.DataFrame, dates=None, export_csv=False):
+    """Write the mobility index table to the month partitions of the index store
+
+    Args:
+        index (pd.DataFrame): table returned by index_table
+        dates (list, optional): Days of the table. If given, only these days are replaced
+            in the partitions of their months, and other months are not read. Defaults to
+            None, replacing the whole store.
+        export_csv (bool, optional): Also export the whole store to mobility_index.csv. Defaults to False.
+    """
+    with instrument.stage('write index', rows_in=len(index)) as stage:
+        if dates is None:
+            store.clear(name=INDEX_STORE)
+        # Sorted by time so queries of a date range only read some row groups
+        index = index.sort_values('time', kind='stable')
+        months = index['time'].dt.to_period('M')
+        updated = set(months)
+        if dates is not None:
+            updated |= set(pd.DatetimeIndex(to_days(dates)).to_period('M'))
+        for month in sorted(updated):
+            fpath = month_path(month)
+            part = index[months == month]
+            if dates is not None and fpath.exists():
+                previous = pd.read_parquet(fpath)
+                previous = previous[~isin_days(previous['time'], dates)]
+                part = pd.concat([previous, part], ignore_index=True).sort_values('time', kind='stable')
+            store.write_partition(part, fpath, row_group_size=INDEX_ROW_GROUP_SIZE)
+            stage.add('bytes_written', instrument.file_size(fpath))
+
+    if export_csv:
+        with instrument.stage('export csv') as stage:
+            export_index_csv()
+            stage['bytes_written'] = instrument.file_size(PATHS.processed / 'mobility_index.csv')
+
+def read_index(start=None, end=None, filters=None) -> pd.DataFrame:
+    """Read the indexes of a date range, only opening the partitions of its months
+
+    Args:
+        start (datetime.date, optional): First day. Defaults to first day computed.
+        end (datetime.date, optional): Last day. Defaults to last day computed.
+        filters (list, optional): Row filters applied while reading each partition, in the
+            format of pyarrow (e.g. [('index', 'in', ['INTERNAL'])]). Defaults to None.
+
+    Raises:
+        FileNotFoundError: Error if generate_index has not been run
+
+    Returns:
+        pd.DataFrame: indexes sorted by time
+    """
+    months = store.list_dates(name=INDEX_STORE)
+    if not months:
+        raise FileNotFoundError(f'No mobility index in {store.store_dir(name=INDEX_STORE)}, run generate_index first')
+    filters = list(filters or [])
+    if start is not None:
+        months = [m for m in months if m >= pd.Timestamp(start).to_period('M').start_time.date()]
+        filters.append(('time', '>=', pd.Timestamp(start)))
+    if end is not None:
+        months = [m for m in months if m <= pd.Timestamp(end).date()]
+        filters.append(('time', '<=', pd.Timestamp(end)))
+    parts = [pd.read_parquet(store.day_path(m, name=INDEX_STORE), filters=filters or None) for m in months]
+    if not parts:
+        # Empty table with the columns of the store
+        return pd.read_parquet(store.day_path(store.list_dates(name=INDEX_STORE)[0], name=INDEX_STORE)).iloc[:0]
+    return pd.concat(parts, ignore_index=True)
+
+def export_index_csv(fpath=None):
+    """Export the whole index store to the csv file read by the R dashboard
+
+    Args:
+        fpath (Path, optional): Path of the csv file. Defaults to PATHS.processed / 'mobility_index.csv'.
+    """
+    fpath = PATHS.processed / 'mobility_index.csv' if fpath is None else fpath
+    store.write_table(read_index(), fpath)
+
+@instrument.instrumented('index')
+def generate_index(update=False, baselines=None, sharded=False, workers=4, export_csv=False):
+    """Generate mobility indexes of each province from the province flux store
+
+    Besides the ratio to each baseline, every row gets the moving average of its count
+    over the last ROLLING_DAYS days and the change of the count with respect to
+    ROLLING_DAYS days before. On update only the days processed since the last run and
+    the days whose rolling metrics depend on them are recomputed, reading ROLLING_DAYS
+    more days before them and the days of the baselines.
+
+    Args:
+        update (bool, optional): Only regenerate the days processed since the last run,
+            according to the manifest. Defaults to False.
+        baselines (list, optional): References of the indexes, as in BASELINES. Defaults to BASELINES.
+        sharded (bool, optional): Compute the indexes by month shards in a pool of processes,
+            so each process only holds the flows of a month. Defaults to False.
+        workers (int, optional): Number of shards computed in parallel if sharded. Defaults to 4.
+        export_csv (bool, optional): Also export the whole index store to mobility_index.csv
+            for the R dashboard. Defaults to False.
+        profile (str, optional): Profile the run with 'cprofile' or 'pyinstrument'. Defaults to None.
+    """
+    baselines = BASELINES if baselines is None else baselines
+    windows = pd.DatetimeIndex(np.concatenate([baseline_days(b).to_numpy() for b in baselines]))
+    config = index_config(baselines)
+
+    manifest = Manifest()
+    dates = None
+    if update and store.list_dates(name=INDEX_STORE):
+        dates = manifest.stale('index')
+        if manifest.config('index') != config:
+            print('Baselines or their files changed since the last run, regenerating every index')
+            dates = None
+        elif not dates:
+            print('Already up-to-date')
+            if export_csv:
+                export_index_csv()
+            return
+        elif isin_days(windows, dates).any():
+            # Changing a reference window changes every index
+            dates = None
+
+    if sharded:
+        tensor = ODTensor()
+        days = tensor.days if dates is None else rolling_dates(dates)
+        if dates is not None:
+            dates = days = days[(days >= tensor.days[0]) & (days <= tensor.days[-1])]
+        write_index(sharded_index(days, baselines, workers), dates, export_csv)
+        manifest.clear_stale('index')
+        manifest.set_config('index', config)
+        manifest.save()
+        return
+
+    # Only the days to regenerate, their rolling windows and the reference windows are needed
+    with instrument.stage('read od tensor') as stage:
+        tensor = ODTensor()
+        if dates is None:
+            days = tensor.days
+            flows = tensor.slice()
+        else:
+            dates = rolling_dates(dates)
+            lookback = to_days(dates)[:, None] - np.arange(ROLLING_DAYS + 1)
+            days = pd.DatetimeIndex(np.union1d(lookback.ravel(), to_days(windows)))
+            dates = dates[(dates >= tensor.days[0]) & (dates <= tensor.days[-1])]
+            days = days[(days >= tensor.days[0]) & (days <= tensor.days[-1])]
+            flows = tensor.take(days)
+        stage['bytes_read'] = flows.nbytes
+    with instrument.stage('compute indexes') as stage:
+        index = indexes_from_tensor(flows, days, tensor.names)
+        stage['rows_out'] = len(index)
+
+    index = index_table(index, baselines)
     # CONCATENATE INTERNAL & OUTWARD & INWARD INDEXES
-    index.to_csv(
-        PATHS.processed / "mobility_index.csv",
-        index=False, encoding='latin1', sep=";"
-    )
+    if dates is not None:
+        index = index[isin_days(index['time'], dates)]
+    write_index(index, dates, export_csv)
+
+    manifest.clear_stale('index')
+    manifest.set_config('index', config)
+    manifest.save()
+
+@click.command()
+@click.option('--update', '-u', is_flag=True, default=False, help="Only regenerate the days processed since the last run.")
+@click.option('--sharded', is_flag=True, default=False, help="Compute the indexes by month shards in a pool of processes.")
+@click.option('--workers', '-w', default=4, help="Number of shards computed in parallel.")
+@click.option('--export-csv', is_flag=True, default=False, help="Also export mobility_index.csv.")
+@click.option('--profile', default=None, type=click.Choice(instrument.PROFILE_VALID_VALUES), help="Profile the run.")
+def main(update, sharded, workers, export_csv, profile):
+    """Generate the mobility indexes from the OD tensor"""
+    generate_index(update=update, sharded=sharded, workers=workers, export_csv=export_csv, profile=profile)
 
 if __name__ == '__main__':
-    generate_index() 
\ No newline at end of file
+    main() 
\ No newline at end of file
@@ -0,0 +1,234 @@
+"""
+Geo.py file provide province coordinates without network access.
+
+Centroids are computed from the province boundaries bundled with the dashboard
+(R/mitma/data/provincias.geojson) and kept in a versioned coordinate cache
+looked up by INE code. The centroids and the CCAA of each province are also
+bundled in raw/codigos_ine, so the pipeline does not need the dashboard folder.
+"""
+import json
+import os
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+from utils import PATHS, CCAA_TABLE
+
+GEOJSON_PATH = pathlib.Path(__file__).resolve().parents[2] / 'R' / 'mitma' / 'data' / 'provincias.geojson'
+CENTROIDS_PATH = PATHS.raw / 'codigos_ine' / 'centroides_prov.csv'
+CACHE_NAME = 'flowmap_coord.json'
+# Centroids of the zones of a level, e.g. computed from the zoning shapefiles of MITMA
+ZONE_CENTROIDS = 'centroides_{level}.csv'
+# Increase when the way coordinates are computed changes to invalidate caches
+CACHE_VERSION = 2
+
+
+def ring_centroid(ring) -> tuple:
+    """Signed area and centroid of a closed ring of (lon, lat) points
+
+    Args:
+        ring (list): list of [lon, lat] points, first and last being equal
+
+    Returns:
+        tuple: signed area, centroid longitude and centroid latitude
+    """
+    xy = np.asarray(ring, dtype='float64')
+    x, y = xy[:-1, 0], xy[:-1, 1]
+    x1, y1 = xy[1:, 0], xy[1:, 1]
+    cross = x * y1 - x1 * y
+    area = cross.sum() / 2
+    if area == 0:
+        return 0.0, x.mean(), y.mean()
+    return area, ((x + x1) * cross).sum() / (6 * area), ((y + y1) * cross).sum() / (6 * area)
+
+
+def point_in_ring(ring, lon: float, lat: float) -> bool:
+    """Check a point is inside a closed ring of (lon, lat) points, by ray casting
+
+    Args:
+        ring (list): list of [lon, lat] points, first and last being equal
+        lon (float): longitude of the point
+        lat (float): latitude of the point
+
+    Returns:
+        bool: True if the point is inside the ring
+    """
+    xy = np.asarray(ring, dtype='float64')
+    x, y = xy[:-1, 0], xy[:-1, 1]
+    x1, y1 = xy[1:, 0], xy[1:, 1]
+    crosses = (y > lat) != (y1 > lat)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x + (lat - y) * (x1 - x) / (y1 - y)
+    return bool(np.count_nonzero(crosses & (lon < x_cross)) % 2)
+
+
+def point_in_polygon(polygon, lon: float, lat: float) -> bool:
+    """Check a point is inside the outer ring of a polygon and outside its holes"""
+    return point_in_ring(polygon[0], lon, lat) and not any(point_in_ring(hole, lon, lat) for hole in polygon[1:])
+
+
+def geometry_centroid(geometry: dict) -> tuple:
+    """Area weighted centroid of a Polygon or MultiPolygon geometry, on land
+
+    The centroid of an archipelago, e.g. Las Palmas or Baleares, may fall in the
+    sea between its islands. In that case the centroid of its largest polygon is
+    returned instead, so the province is drawn on one of its islands.
+
+    Args:
+        geometry (dict): GeoJSON geometry
+
+    Returns:
+        tuple: latitude and longitude of the centroid
+    """
+    polygons = geometry['coordinates']
+    if geometry['type'] == 'Polygon':
+        polygons = [polygons]
+
+    centroids = []
+    for polygon in polygons:
+        total, lon, lat = 0.0, 0.0, 0.0
+        for i, ring in enumerate(polygon):
+            area, x, y = ring_centroid(ring)
+            # Outer ring adds area and holes subtract it, whatever their orientation
+            area = abs(area) if i == 0 else -abs(area)
+            total += area
+            lon += area * x
+            lat += area * y
+        centroids.append((total, lon, lat))
+
+    total = sum(c[0] for c in centroids)
+    lon = sum(c[1] for c in centroids) / total
+    lat = sum(c[2] for c in centroids) / total
+    if len(polygons) > 1 and not any(point_in_polygon(polygon, lon, lat) for polygon in polygons):
+        area, lon, lat = max(centroids, key=lambda c: c[0])
+        lon, lat = lon / area, lat / area
+    return lat, lon
+
+
+def province_centroids(geojson_path=GEOJSON_PATH) -> pd.DataFrame:
+    """Compute the centroid of each province from its boundaries
+
+    Args:
+        geojson_path (Path, optional): Path to the provinces geojson. Defaults to GEOJSON_PATH.
+
+    Returns:
+        pd.DataFrame: dataframe with Codigo, lat and lon columns sorted by Codigo
+    """
+    with open(geojson_path, encoding='utf-8') as f:
+        features = json.load(f)['features']
+    rows = []
+    for feature in features:
+        lat, lon = geometry_centroid(feature['geometry'])
+        rows.append({'Codigo': feature['properties']['codigo'], 'lat': round(lat, 6), 'lon': round(lon, 6)})
+    return pd.DataFrame(rows).sort_values('Codigo').reset_index(drop=True)
+
+
+def province_ccaa_table(geojson_path=GEOJSON_PATH) -> pd.DataFrame:
+    """CCAA of each province, as in the provinces geojson
+
+    Args:
+        geojson_path (Path, optional): Path to the provinces geojson. Defaults to GEOJSON_PATH.
+
+    Returns:
+        pd.DataFrame: dataframe with Codigo, cod_ccaa and CCAA columns sorted by Codigo
+    """
+    with open(geojson_path, encoding='utf-8') as f:
+        features = json.load(f)['features']
+    rows = [{'Codigo': feature['properties']['codigo'], 'cod_ccaa': feature['properties']['cod_ccaa'],
+             'CCAA': feature['properties']['ccaa']} for feature in features]
+    return pd.DataFrame(rows).sort_values('Codigo').reset_index(drop=True)
+
+
+def zone_centroids(level: str, fpath=None) -> pd.DataFrame:
+    """Centroids of the zones of a level, if their table is in the raw folder
+
+    No zone geometry is bundled with the project. The table is read from
+    raw/zonificacion/centroides_<level>.csv, ';' separated with the zone code
+    in 'id' and 'lat' and 'lon' columns.
+
+    Args:
+        level (str): 'district' or 'municipality'
+        fpath (Path, optional): Path to the table. Defaults to the table of the level in the raw folder.
+
+    Returns:
+        pd.DataFrame: dataframe with id, lat and lon columns, None if the table does not exist
+    """
+    fpath = PATHS.raw / 'zonificacion' / ZONE_CENTROIDS.format(level=level) if fpath is None else fpath
+    if not fpath.exists():
+        return None
+    return pd.read_csv(fpath, sep=';', dtype={'id': 'string'}, usecols=['id', 'lat', 'lon'])
+
+
+class CoordinateCache():
+    """Coordinates of provinces looked up by INE code
+
+    The cache is stored as JSON in the processed folder shared by every
+    dataset. It is seeded from the bundled centroids table, or from the geojson
+    if the table is missing, and reseeded whenever CACHE_VERSION changes.
+    """
+    def __init__(self, path=None):
+        self._path = PATHS.processed_root / CACHE_NAME if path is None else path
+        content = {}
+        if self._path.exists():
+            with open(self._path) as f:
+                content = json.load(f)
+        if content.get('version') != CACHE_VERSION:
+            self._coords = self.seed()
+            self.save()
+        else:
+            self._coords = content['coords']
+
+    @staticmethod
+    def seed() -> dict:
+        """Coordinates of the bundled centroids table, computed from the geojson if missing"""
+        if CENTROIDS_PATH.exists():
+            centroids = pd.read_csv(CENTROIDS_PATH, sep=';', dtype={'Codigo': 'string'})
+        else:
+            centroids = province_centroids()
+        return {c: [lat, lon] for c, lat, lon in zip(centroids.Codigo, centroids.lat, centroids.lon)}
+
+    def get(self, code: str) -> tuple:
+        """Latitude and longitude of a province
+
+        Args:
+            code (str): INE code of the province
+
+        Raises:
+            KeyError: Error if the province is not in the cache
+
+        Returns:
+            tuple: latitude and longitude
+        """
+        return tuple(self._coords[f'{int(code):02d}'])
+
+    def set(self, code: str, lat: float, lon: float):
+        """Set the coordinates of a province, call save to persist them"""
+        self._coords[f'{int(code):02d}'] = [lat, lon]
+
+    def lookup(self, codes) -> pd.DataFrame:
+        """Coordinates of several provinces
+
+        Args:
+            codes (iterable): INE codes of the provinces
+
+        Returns:
+            pd.DataFrame: dataframe with id, lat and lon columns
+        """
+        codes = list(codes)
+        coords = np.array([self.get(c) for c in codes], dtype='float64').reshape(-1, 2)
+        return pd.DataFrame({'id': codes, 'lat': coords[:, 0], 'lon': coords[:, 1]})
+
+    def save(self):
+        """Write the cache to disk"""
+        self._path.parent.exists() or os.makedirs(self._path.parent)
+        tmp = self._path.with_name(self._path.name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'coords': self._coords}, f, indent=1, sort_keys=True)
+        os.replace(tmp, self._path)
+
+
+if __name__ == '__main__':
+    # Regenerate the bundled centroids and CCAA tables
+    province_centroids().to_csv(CENTROIDS_PATH, index=False, sep=';')
+    province_ccaa_table().to_csv(CCAA_TABLE, index=False, sep=';')
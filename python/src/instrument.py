@@ -0,0 +1,228 @@
+"""
+Instrument.py file record timings, sizes and memory of each pipeline run.
+
+Entry points open a run with `run(name)` and wrap their steps with `stage(name)`;
+per file metrics are added with `record_file`. When the run finishes a JSON log
+is written to processed/run_logs/ and its stages are appended to
+processed/run_logs/stages.csv. Runs can optionally be profiled with cProfile or,
+if installed, pyinstrument.
+"""
+import contextlib
+import cProfile
+import csv
+import datetime
+import functools
+import json
+import os
+import resource
+import threading
+import time
+
+from utils import PATHS
+
+PROFILE_VALID_VALUES = ('cprofile', 'pyinstrument')
+LOG_DIR_NAME = 'run_logs'
+STAGE_FIELDS = ['run', 'started', 'stage', 'seconds', 'bytes_read', 'bytes_written',
+                'rows_in', 'rows_out', 'max_rss_mb']
+
+_lock = threading.Lock()
+_runs = []
+
+
+def max_rss_mb() -> float:
+    """Memory high-water mark of this process and its finished children, in MiB"""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, children) / 1024, 1)
+
+
+def file_size(fpath) -> int:
+    """Size of a file in bytes, 0 if it does not exist"""
+    try:
+        return os.path.getsize(fpath)
+    except OSError:
+        return 0
+
+
+class RunLog():
+    def __init__(self, name: str):
+        self._name = name
+        self._started = datetime.datetime.now()
+        self._tic = time.perf_counter()
+        self._stages = []
+        self._files = []
+        self._seconds = None
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def stages(self) -> list:
+        return self._stages
+
+    @property
+    def files(self) -> list:
+        return self._files
+
+    def add_stage(self, entry: dict):
+        with _lock:
+            self._stages.append(entry)
+
+    def add_file(self, entry: dict):
+        with _lock:
+            self._files.append(entry)
+
+    def finish(self):
+        self._seconds = round(time.perf_counter() - self._tic, 4)
+
+    def to_dict(self) -> dict:
+        return {
+            'run': self._name,
+            'started': self._started.isoformat(timespec='seconds'),
+            'seconds': self._seconds,
+            'max_rss_mb': max_rss_mb(),
+            'stages': self._stages,
+            'files': self._files,
+        }
+
+    def prefix(self) -> str:
+        return f'{self._started:%Y%m%dT%H%M%S}_{self._name}'
+
+    def save(self, log_dir=None):
+        """Write the JSON log of the run and append its stages to stages.csv
+
+        Args:
+            log_dir (Path, optional): Folder of the logs. Defaults to PATHS.processed / 'run_logs'.
+
+        Returns:
+            Path: path to the JSON log
+        """
+        log_dir = PATHS.processed / LOG_DIR_NAME if log_dir is None else log_dir
+        log_dir.exists() or os.makedirs(log_dir)
+        fpath = log_dir / f'{self.prefix()}.json'
+        with open(fpath, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+        started = self._started.isoformat(timespec='seconds')
+        csv_path = log_dir / 'stages.csv'
+        new = not csv_path.exists()
+        with open(csv_path, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=STAGE_FIELDS, extrasaction='ignore')
+            if new:
+                writer.writeheader()
+            for entry in self._stages:
+                writer.writerow({'run': self._name, 'started': started, **entry})
+        return fpath
+
+
+def current():
+    """Run being instrumented, None if there is none"""
+    return _runs[-1] if _runs else None
+
+
+@contextlib.contextmanager
+def run(name: str, profile=None, log_dir=None):
+    """Instrument a run of a pipeline entry point
+
+    Runs opened while another one is active (e.g. process called by a batch job)
+    are recorded as a stage of the outer run instead of writing their own log.
+
+    Args:
+        name (str): name of the entry point
+        profile (str, optional): Profile the run with 'cprofile' or 'pyinstrument'. Defaults to None.
+        log_dir (Path, optional): Folder of the logs. Defaults to PATHS.processed / 'run_logs'.
+
+    Raises:
+        ValueError: profile must be one of the valid profilers.
+
+    Yields:
+        RunLog: log of the run
+    """
+    if profile is not None and profile not in PROFILE_VALID_VALUES:
+        raise ValueError(f'profile {profile} is not a valid input. Valid profilers are: {", ".join(PROFILE_VALID_VALUES)}')
+    if current() is not None and profile is None:
+        with stage(name):
+            yield current()
+        return
+
+    log = RunLog(name)
+    profiler = None
+    if profile == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profile == 'pyinstrument':
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+
+    _runs.append(log)
+    try:
+        yield log
+    finally:
+        _runs.remove(log)
+        log.finish()
+        fpath = log.save(log_dir)
+        if profile == 'cprofile':
+            profiler.disable()
+            profiler.dump_stats(fpath.with_suffix('.prof'))
+        elif profile == 'pyinstrument':
+            profiler.stop()
+            with open(fpath.with_suffix('.html'), 'w') as f:
+                f.write(profiler.output_html())
+
+
+def instrumented(name: str):
+    """Decorator running an entry point inside an instrumented run
+
+    The decorated function accepts an extra `profile` keyword argument passed to `run`.
+
+    Args:
+        name (str): name of the entry point
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, profile=None, **kwargs):
+            with run(name, profile):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Stage(dict):
+    """Counters of a stage: bytes_read, bytes_written, rows_in and rows_out"""
+    def add(self, key: str, value):
+        self[key] = self.get(key, 0) + value
+
+
+@contextlib.contextmanager
+def stage(name: str, **counters):
+    """Time a stage of the current run
+
+    Args:
+        name (str): name of the stage
+        **counters: initial values of the stage counters
+
+    Yields:
+        Stage: counters of the stage, updated by the caller
+    """
+    counters = Stage(counters)
+    tic = time.perf_counter()
+    try:
+        yield counters
+    finally:
+        log = current()
+        if log is not None:
+            log.add_stage({'stage': name, 'seconds': round(time.perf_counter() - tic, 4),
+                           **counters, 'max_rss_mb': max_rss_mb()})
+
+
+def record_file(**metrics):
+    """Record the metrics of a single file in the current run
+
+    Args:
+        **metrics: metrics of the file, e.g. file, seconds, bytes_read, rows_in, rows_out
+    """
+    log = current()
+    if log is not None:
+        log.add_file(metrics)
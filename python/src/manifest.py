@@ -0,0 +1,180 @@
+"""
+Manifest.py file keep track of the raw files processed and the dates pending in each stage.
+
+For each raw file the manifest records its size, modification time and
+content hash plus the store partition it produced, so only new or changed
+files are reprocessed. Dates touched by process are marked as stale for
+the downstream stages until they are regenerated: each output of flowmap
+(flowmap:wide, flowmap:codes, flowmap:parquet) and index.
+"""
+import datetime
+import hashlib
+import json
+import os
+
+from utils import PATHS
+import corrections
+
+MANIFEST_NAME = 'manifest.json'
+STAGES = ('flowmap:wide', 'flowmap:codes', 'flowmap:parquet', 'index')
+
+
+def file_hash(fpath, chunk_size: int = 1 << 20) -> str:
+    """Compute the sha256 hash of a file
+
+    Args:
+        fpath (Path): path to the file
+        chunk_size (int, optional): Size in bytes of the chunks read. Defaults to 1 MiB.
+
+    Returns:
+        str: hex digest of the file content
+    """
+    h = hashlib.sha256()
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest():
+    def __init__(self, path=None):
+        self._path = PATHS.processed / MANIFEST_NAME if path is None else path
+        if self._path.exists():
+            with open(self._path) as f:
+                content = json.load(f)
+        else:
+            content = {}
+        self._files = content.get('files', {})
+        stale = content.get('stale', {})
+        # Manifests written before flowmap outputs were tracked apart have a single flowmap stage
+        self._stale = {stage: set(stale.get(stage, stale.get(stage.split(':')[0], []))) for stage in STAGES}
+        self._config = content.get('config', {})
+
+    @property
+    def path(self):
+        return self._path
+
+    @staticmethod
+    def key(fpath) -> str:
+        """Key of a raw file in the manifest, its path relative to the raw folder"""
+        try:
+            return fpath.relative_to(PATHS.raw).as_posix()
+        except ValueError:
+            return fpath.as_posix()
+
+    def changed(self, files: list) -> list:
+        """Select the files that are new or whose content has changed
+
+        The hash of a file is only computed when its size or modification
+        time differ from the recorded ones. Aliased days (see corrections)
+        are checked against the file they are read from.
+
+        Args:
+            files (list): paths to raw files
+
+        Returns:
+            list: paths to the new or changed files
+        """
+        changed = []
+        for fpath in files:
+            entry = self._files.get(self.key(fpath))
+            source = corrections.source(fpath)
+            stat = os.stat(source)
+            if entry is None:
+                changed.append(fpath)
+            elif entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+                if entry['sha256'] != file_hash(source):
+                    changed.append(fpath)
+                else:
+                    # Same content rewritten (e.g. forced download), only refresh its stat
+                    entry['size'], entry['mtime'] = stat.st_size, stat.st_mtime
+        return changed
+
+    def record(self, fpath, partition):
+        """Record a processed raw file and the partition it produced
+
+        Args:
+            fpath (Path): path to the raw file
+            partition (Path): path to the store partition written
+        """
+        source = corrections.source(fpath)
+        stat = os.stat(source)
+        try:
+            partition = partition.relative_to(PATHS.processed)
+        except ValueError:
+            pass
+        self._files[self.key(fpath)] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha256': file_hash(source),
+            'partition': partition.as_posix(),
+        }
+
+    def reset(self):
+        """Forget every recorded file, stale date and stage settings"""
+        self._files = {}
+        self._stale = {stage: set() for stage in STAGES}
+        self._config = {}
+
+    def mark_stale(self, dates: list, stages: tuple = STAGES):
+        """Mark dates as pending to be regenerated by the given stages
+
+        Args:
+            dates (list): datetime.date to mark
+            stages (tuple, optional): stages affected. Defaults to STAGES.
+        """
+        for stage in stages:
+            self._stale[stage].update(f'{d:%Y-%m-%d}' for d in dates)
+
+    def stale(self, stage: str) -> list:
+        """Dates pending to be regenerated by a stage
+
+        Args:
+            stage (str): one of STAGES
+
+        Returns:
+            list: sorted list of datetime.date
+        """
+        return sorted(datetime.date.fromisoformat(d) for d in self._stale[stage])
+
+    def clear_stale(self, stage: str):
+        """Mark every date of a stage as regenerated
+
+        Args:
+            stage (str): one of STAGES
+        """
+        self._stale[stage] = set()
+
+    def config(self, stage: str) -> dict:
+        """Settings a stage was last run with, None if they are unknown
+
+        Args:
+            stage (str): one of STAGES
+
+        Returns:
+            dict: settings recorded with set_config
+        """
+        return self._config.get(stage)
+
+    def set_config(self, stage: str, config: dict):
+        """Record the settings a stage was run with, a stage can only update its
+        outputs incrementally while its settings do not change
+
+        Args:
+            stage (str): one of STAGES
+            config (dict): json serializable settings
+        """
+        self._config[stage] = config
+
+    def save(self):
+        """Write the manifest to disk"""
+        content = {
+            'files': self._files,
+            'stale': {stage: sorted(dates) for stage, dates in self._stale.items()},
+            'config': self._config,
+        }
+        self._path.parent.exists() or os.makedirs(self._path.parent)
+        tmp = self._path.with_name(self._path.name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(content, f, indent=1, sort_keys=True)
+        os.replace(tmp, self._path)
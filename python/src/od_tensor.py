@@ -0,0 +1,217 @@
+"""
+Od_tensor.py file manage the dense origin-destination tensor of province flows.
+
+Flows are stored as a days x 52 x 52 float array in a .npy file, with a JSON
+sidecar mapping the first axis to dates and the other two to INE codes:
+
+    processed/province_od.npy
+    processed/province_od.json
+
+Days span continuously from the first to the last processed day, so a date
+is mapped to its position with integer arithmetic. Pairs of provinces without
+flows (and missing days) are stored as NaN.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from utils import PATHS, to_days
+
+TENSOR_NAME = 'province_od.npy'
+SIDECAR_NAME = 'province_od.json'
+# INE codes of the provinces, position in the list is the position in the tensor axes
+PROVINCE_CODES = [f'{i:02d}' for i in range(1, 53)]
+
+
+def tensor_path(root=None):
+    """Path to the .npy file of the tensor
+
+    Args:
+        root (Path, optional): Folder containing the tensor. Defaults to PATHS.processed.
+
+    Returns:
+        Path: path to the tensor
+    """
+    root = PATHS.processed if root is None else root
+    return root / TENSOR_NAME
+
+
+def sidecar_path(root=None):
+    """Path to the JSON sidecar of the tensor
+
+    Args:
+        root (Path, optional): Folder containing the tensor. Defaults to PATHS.processed.
+
+    Returns:
+        Path: path to the sidecar
+    """
+    root = PATHS.processed if root is None else root
+    return root / SIDECAR_NAME
+
+
+def clear(root=None):
+    """Remove the tensor and its sidecar
+
+    Args:
+        root (Path, optional): Folder containing the tensor. Defaults to PATHS.processed.
+    """
+    for path in (tensor_path(root), sidecar_path(root)):
+        if path.exists():
+            os.remove(path)
+
+
+class ODTensor():
+    """Memory mapped origin-destination tensor
+
+    Slices by date range or by a single province are views of the memory map,
+    so no data is read from disk until it is used.
+    """
+    def __init__(self, root=None, mode='r'):
+        self._data = np.load(tensor_path(root), mmap_mode=mode)
+        with open(sidecar_path(root)) as f:
+            meta = json.load(f)
+        self._start = np.datetime64(meta['start'], 'D')
+        self._codes = meta['codes']
+        self._names = meta['names']
+
+    @property
+    def data(self) -> np.ndarray:
+        return self._data
+
+    @property
+    def codes(self) -> list:
+        return self._codes
+
+    @property
+    def names(self) -> list:
+        return self._names
+
+    @property
+    def start(self) -> np.datetime64:
+        return self._start
+
+    @property
+    def days(self) -> pd.DatetimeIndex:
+        return pd.DatetimeIndex(self._start + np.arange(self._data.shape[0]))
+
+    def day_index(self, date) -> int:
+        """Position of a date in the first axis"""
+        return int((to_days([date])[0] - self._start).astype(int))
+
+    def _day_slice(self, start=None, end=None) -> slice:
+        i = 0 if start is None else max(self.day_index(start), 0)
+        j = self._data.shape[0] if end is None else max(self.day_index(end) + 1, 0)
+        return slice(i, j)
+
+    def slice(self, start=None, end=None) -> np.ndarray:
+        """Flows between every pair of provinces for a date range, without copying
+
+        Args:
+            start (datetime.date, optional): First day. Defaults to first day of the tensor.
+            end (datetime.date, optional): Last day. Defaults to last day of the tensor.
+
+        Returns:
+            np.ndarray: days x origin x destination view of the tensor
+        """
+        return self._data[self._day_slice(start, end)]
+
+    def origin(self, code: str, start=None, end=None) -> np.ndarray:
+        """Flows from a province for a date range, without copying
+
+        Args:
+            code (str): INE code of the origin province
+            start (datetime.date, optional): First day. Defaults to first day of the tensor.
+            end (datetime.date, optional): Last day. Defaults to last day of the tensor.
+
+        Returns:
+            np.ndarray: days x destination view of the tensor
+        """
+        return self._data[self._day_slice(start, end), self._codes.index(code), :]
+
+    def destination(self, code: str, start=None, end=None) -> np.ndarray:
+        """Flows to a province for a date range, without copying
+
+        Args:
+            code (str): INE code of the destination province
+            start (datetime.date, optional): First day. Defaults to first day of the tensor.
+            end (datetime.date, optional): Last day. Defaults to last day of the tensor.
+
+        Returns:
+            np.ndarray: days x origin view of the tensor
+        """
+        return self._data[self._day_slice(start, end), :, self._codes.index(code)]
+
+    def take(self, dates: list) -> np.ndarray:
+        """Flows of a list of days
+
+        Args:
+            dates (list): days to take, all of them inside the tensor
+
+        Returns:
+            np.ndarray: days x origin x destination copy of the selected days
+        """
+        return self._data[(to_days(dates) - self._start).astype(int)]
+
+
+def _write_sidecar(start, names, root=None):
+    meta = {'start': str(start), 'codes': PROVINCE_CODES, 'names': names}
+    tmp = sidecar_path(root).with_name(SIDECAR_NAME + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=1, ensure_ascii=False)
+    os.replace(tmp, sidecar_path(root))
+
+
+def update(flux: pd.DataFrame, names: np.ndarray, root=None):
+    """Write the days of a province flux table into the tensor
+
+    Days already in the tensor are overwritten in place. If the days fall outside
+    the current range, a larger tensor is written and the previous days copied into it.
+
+    Args:
+        flux (pd.DataFrame): province flux with 'date', 'province id origin',
+            'province id destination' and 'flux' columns
+        names (np.ndarray): province names by integer INE code, see utils.province_names
+        root (Path, optional): Folder containing the tensor. Defaults to PATHS.processed.
+    """
+    dates = to_days(flux['date'])
+    first, last = dates.min(), dates.max()
+
+    previous = None
+    if tensor_path(root).exists():
+        previous = ODTensor(root)
+        prev_first = previous.start
+        prev_last = prev_first + previous.data.shape[0] - 1
+        first, last = min(first, prev_first), max(last, prev_last)
+
+    n_days = int((last - first).astype(int)) + 1
+    shape = (n_days, len(PROVINCE_CODES), len(PROVINCE_CODES))
+    if previous is not None and previous.data.shape == shape and previous.start == first:
+        del previous
+        data = np.load(tensor_path(root), mmap_mode='r+')
+        tmp = None
+    else:
+        tmp = tensor_path(root).with_name(TENSOR_NAME + '.tmp')
+        data = np.lib.format.open_memmap(tmp, mode='w+', dtype='float64', shape=shape)
+        data[:] = np.nan
+        if previous is not None:
+            offset = int((previous.start - first).astype(int))
+            data[offset:offset + previous.data.shape[0]] = previous.data
+            del previous
+
+    # Clear the written days and fill the flows of each pair of provinces
+    day_pos = (dates - first).astype(int)
+    data[np.unique(day_pos)] = np.nan
+    origin = pd.Index(PROVINCE_CODES).get_indexer(flux['province id origin'].astype(str))
+    dest = pd.Index(PROVINCE_CODES).get_indexer(flux['province id destination'].astype(str))
+    valid = (origin >= 0) & (dest >= 0)
+    if not valid.all():
+        print(f'{(~valid).sum()} flows with unknown province codes not written to the OD tensor')
+    data[day_pos[valid], origin[valid], dest[valid]] = flux['flux'].to_numpy(dtype='float64')[valid]
+    data.flush()
+    del data
+
+    if tmp is not None:
+        os.replace(tmp, tensor_path(root))
+    _write_sidecar(first, [names[int(c)] for c in PROVINCE_CODES], root)
@@ -0,0 +1,108 @@
+"""
+Pipeline.py file rebuild the province flux, flowmap and mobility index outputs in a single process.
+
+Tables are passed in memory between the stages, instead of each stage reading
+back the files written by the previous one:
+
+    raw files -> process -> province flux -> flowmap tables
+                                          -> mobility index
+
+Process still writes the province flux store and the OD tensor, from which
+later update runs start. Flowmap and index files are only written for the
+stages exported.
+"""
+import click
+
+import instrument
+import process
+import flowmap
+import generate_index
+from manifest import Manifest
+
+EXPORT_VALID_VALUES = ('flowmap', 'index')
+
+
+@instrument.instrumented('pipeline')
+def run_pipeline(day_files='all',
+                 exp='maestra1',
+                 res='municipios',
+                 executor='thread',
+                 workers=4,
+                 chunksize=None,
+                 output='wide',
+                 baselines=None,
+                 export=EXPORT_VALID_VALUES,
+                 export_csv=False) -> dict:
+    """Process day files and generate the flowmap and index tables from the flux in memory
+
+    Args:
+        day_files (list, str, optional): List of absolute paths to day-tars to process.
+            If 'all' is passed, it will process every file. Defaults to 'all'.
+        exp (str, optional): Version of maestra of the data. Defaults to 'maestra1'.
+        res (str, optional): Locations of the data. Defaults to 'municipios'.
+        executor (str, optional): Process day files in a pool of 'thread' or 'process'. Defaults to 'thread'.
+        workers (int, optional): Number of day files processed in parallel. Defaults to 4.
+        chunksize (int, optional): Stream each day file in chunks of this many rows. Defaults to None.
+        output (str, optional): Flowmap tables to build, one of flowmap.OUTPUT_VALID_VALUES. Defaults to 'wide'.
+        baselines (list, optional): References of the indexes, as in generate_index.BASELINES.
+            Defaults to generate_index.BASELINES.
+        export (tuple, optional): Stages whose files are written, 'flowmap' and/or 'index'.
+            Defaults to EXPORT_VALID_VALUES.
+        export_csv (bool, optional): Also export province_flux.csv, and mobility_index.csv if the index
+            is exported. Defaults to False.
+        profile (str, optional): Profile the run with 'cprofile' or 'pyinstrument'. Defaults to None.
+
+    Raises:
+        ValueError: export must only contain valid stages.
+
+    Returns:
+        dict: 'flux', 'locations', 'flows', 'flows_location' (if output is 'wide') and 'index'
+            tables, empty if no file was processed
+    """
+    if not set(export) <= set(EXPORT_VALID_VALUES):
+        raise ValueError(f'export {", ".join(export)} is not a valid input. Valid exports are: {", ".join(EXPORT_VALID_VALUES)}')
+    baselines = generate_index.BASELINES if baselines is None else baselines
+
+    tables = {}
+    process.process(day_files, exp=exp, res=res, executor=executor, workers=workers,
+                    chunksize=chunksize, export_csv=export_csv, tables=tables)
+    if 'flux' not in tables:
+        return tables
+    tables.update(flowmap.flowmap_tables(tables['flux'], output))
+    with instrument.stage('compute indexes') as stage:
+        index = generate_index.indexes_from_flux(tables['flux'])
+        stage['rows_out'] = len(index)
+    tables['index'] = generate_index.index_table(index, baselines)
+
+    # Files not exported are left pending for the stages in update mode
+    manifest = Manifest()
+    if 'flowmap' in export:
+        flowmap.write_flowmap(tables, output)
+        manifest.clear_stale(flowmap.stage_name(output))
+    if 'index' in export:
+        generate_index.write_index(tables['index'], export_csv=export_csv)
+        manifest.clear_stale('index')
+        manifest.set_config('index', generate_index.index_config(baselines))
+    manifest.save()
+    return tables
+
+
+@click.command()
+@click.option('--maestra-version', '-mv', 'exp', default='maestra1', help="Version of maestra of the data.")
+@click.option('--location', '-l', 'res', default='municipios', help="Locations of data.")
+@click.option('--executor', '-e', default='thread', type=click.Choice(process.EXECUTOR_VALID_VALUES), help="Pool used to process day files.")
+@click.option('--workers', '-w', default=4, help="Number of day files processed in parallel.")
+@click.option('--chunksize', '-c', default=None, type=int, help="Stream day files in chunks of this many rows.")
+@click.option('--output', '-o', default='wide', type=click.Choice(flowmap.OUTPUT_VALID_VALUES), help="Flowmap files to write.")
+@click.option('--export', '-x', 'export', multiple=True, default=EXPORT_VALID_VALUES,
+              type=click.Choice(EXPORT_VALID_VALUES), help="Stages whose files are written, can be repeated. Defaults to all.")
+@click.option('--export-csv', is_flag=True, default=False, help="Also export province_flux.csv and mobility_index.csv.")
+@click.option('--profile', default=None, type=click.Choice(instrument.PROFILE_VALID_VALUES), help="Profile the run.")
+def main(exp, res, executor, workers, chunksize, output, export, export_csv, profile):
+    """Rebuild the flux store, flowmap and index files passing tables in memory"""
+    run_pipeline(exp=exp, res=res, executor=executor, workers=workers, chunksize=chunksize,
+                 output=output, export=export, export_csv=export_csv, profile=profile)
+
+
+if __name__ == '__main__':
+    main()
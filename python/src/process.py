@@ -1,103 +1,364 @@
 """
 Process data downloaded from opendata mitma
 """
-import datetime
+from functools import partial
+from multiprocessing import Pool
 from multiprocessing.pool import ThreadPool
-import os
+import time
 
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-from utils import PATHS
+from utils import PATHS, ints_to_days, province_names
+import store
+import od_tensor
+import cube as od_cube
+import zones
+import sparse_od
+import corrections
+from raw_store import RawStore
+import instrument
+from manifest import Manifest
 
-def process_day(tarfile):
-    """Process data for a given day
+import click
 
-    Args:
-        tarfile (Path): path to the stored data for the given day
+EXECUTOR_VALID_VALUES = ('thread', 'process')
 
-    Raises:
-        Exception: Error if read_csv cannot read tarfile
+# Lookup table from integer province code to its two digits INE code
+PROVINCE_CODES = np.array([f'{i:02d}' for i in range(100)])
+
+def _zone_ids(df: pd.DataFrame) -> tuple:
+    """Factorize origin and destination zone codes of a chunk, sharing the same unique codes"""
+    ids, codes = pd.factorize(pd.concat([df['origen'], df['destino']], ignore_index=True))
+    return ids[:len(df)], ids[len(df):], pd.Index(codes)
+
+
+def _relabel(agg: pd.Series, labels: np.ndarray) -> pd.Series:
+    """Replace the integer origin and destination of an aggregate by their zone codes"""
+    index = agg.index
+    agg.index = pd.MultiIndex.from_arrays([index.get_level_values(0),
+                                           labels[index.get_level_values(1)],
+                                           labels[index.get_level_values(2)]])
+    return agg
+
+
+def _aggregate_chunk(df: pd.DataFrame, cube: bool = False, levels: tuple = ()) -> tuple:
+    """Aggregate trips of a chunk of a day file by date and origin and destination provinces,
+    and also by hour and distance band if cube is True, and by the zones of each level.
+    Also returns the number of rows skipped and the codes of the zones without province"""
+    # Zone codes are only sliced once per unique code, rows are mapped by integer indexing
+    origin_ids, dest_ids, codes = _zone_ids(df)
+    province = zones.ZoneHierarchy.province(codes)
+    unknown = province < 0
+    skipped = (0, set())
+    if unknown.any():
+        # Trips of zones without province, e.g. foreign zones, can't be placed in any level
+        keep = ~(unknown[origin_ids] | unknown[dest_ids])
+        skipped = (int((~keep).sum()), set(codes[unknown].astype(str)))
+        df, origin_ids, dest_ids = df[keep], origin_ids[keep], dest_ids[keep]
+    keys = [df['fecha'], province[origin_ids], province[dest_ids]]
+    values = ['viajes']
+    if cube:
+        distance = pd.Categorical(df['distancia'], dtype=od_cube.DISTANCE_DTYPE).codes
+        keys += [df['periodo'], distance]
+        values.append('viajes_km')
+
+    # Aggregate across the remaining columns, accumulating in double precision
+    trips = df[values].astype('float64')
+    agg = trips.groupby(keys, sort=True).sum()
+
+    level_aggs = {}
+    for level in levels:
+        labels, level_codes = pd.factorize(zones.hierarchy().labels(codes, level))
+        level_agg = trips['viajes'].groupby([df['fecha'], labels[origin_ids], labels[dest_ids]]).sum()
+        level_aggs[level] = _relabel(level_agg, level_codes)
+    return agg, level_aggs, skipped
+
+
+def _aggregate_file(tarfile, chunksize=None, cube=False, levels=()) -> tuple:
+    """Aggregate a day file, see aggregate_day
 
     Returns:
-        pd.DataFrame: Dataframe containing data for given day
+        tuple: arrays returned by aggregate_day, dict with the arrays of dates, origin zones,
+            destination zones and trips of each level, and number of rows read
     """
+    dtype = {'fecha': 'int32', 'origen': 'string', 'destino': 'string', 'viajes': 'float32'}
+    if cube:
+        dtype.update({'periodo': 'int8', 'distancia': 'string', 'viajes_km': 'float32'})
+    # Known errors of the source files are corrected while reading
+    source, date = corrections.resolve(tarfile)
     try:
-        df = pd.read_csv(tarfile,
-                        sep='|',
-                        thousands='.',
-                        dtype={'origen': 'string', 'destino': 'string'},
-                        compression='gzip', 
-                        encoding='latin1')
+        reader = pd.read_csv(source,
+                            sep='|',
+                            thousands='.',
+                            usecols=list(dtype),
+                            dtype=dtype,
+                            compression='gzip', 
+                            encoding='latin1',
+                            chunksize=chunksize)
+        chunks = [reader] if chunksize is None else reader
+
+        agg = None
+        level_aggs = {}
+        rows_in = 0
+        rows_skipped, unknown = 0, set()
+        for chunk in chunks:
+            rows_in += len(chunk)
+            chunk = corrections.apply(chunk, date)
+            chunk_agg, chunk_levels, (chunk_skipped, chunk_unknown) = _aggregate_chunk(chunk, cube, levels)
+            rows_skipped += chunk_skipped
+            unknown |= chunk_unknown
+            agg = chunk_agg if agg is None else agg.add(chunk_agg, fill_value=0)
+            for level, level_agg in chunk_levels.items():
+                previous = level_aggs.get(level)
+                level_aggs[level] = level_agg if previous is None else previous.add(level_agg, fill_value=0)
     except Exception as e:
         print(f'Error processing {tarfile}')
         raise Exception(e)
+    if rows_skipped:
+        print(f'Warning: skipped {rows_skipped} rows of {tarfile.name} from or to zones without '
+              f'province code: {", ".join(sorted(unknown))}')
 
-    df['fecha'] = pd.to_datetime(df.fecha, format='%Y%m%d')
-    df['fecha'] = df['fecha'].dt.date
+    index = agg.index
+    arrays = (index.get_level_values(0).to_numpy(dtype='int32'),
+              index.get_level_values(1).to_numpy(dtype='int8'),
+              index.get_level_values(2).to_numpy(dtype='int8'))
+    if cube:
+        arrays += (index.get_level_values(3).to_numpy(dtype='int8'),
+                   index.get_level_values(4).to_numpy(dtype='int8'))
+    arrays += tuple(agg[col].to_numpy() for col in agg.columns)
 
-    # Aggregate data inside same province
-    df['origen'] = df['origen'].transform(lambda x: x[:2])
-    df['destino'] = df['destino'].transform(lambda x: x[:2])
+    level_arrays = {}
+    for level, level_agg in level_aggs.items():
+        index = level_agg.index
+        level_arrays[level] = (index.get_level_values(0).to_numpy(dtype='int32'),
+                               index.get_level_values(1).to_numpy(dtype=object),
+                               index.get_level_values(2).to_numpy(dtype=object),
+                               level_agg.to_numpy())
+    return arrays, level_arrays, rows_in
 
-    # Aggregate across hours and distances
-    df = df.groupby(['fecha', 'origen', 'destino']).sum(numeric_only=True).reset_index()
-    df = df.drop(columns=['periodo', 'viajes_km'])
 
-    return df
+def aggregate_day(tarfile, chunksize=None, stats=None, cube=False) -> tuple:
+    """Aggregate the trips of a given day between provinces
 
+    Zone codes are factorized and the province of each unique code is
+    looked up in the zone hierarchy, so rows are mapped to integer provinces
+    by array indexing. Only the aggregated arrays are returned so they are
+    cheap to send between processes.
+
+    If chunksize is given the file is streamed in chunks of that many rows
+    with narrow dtypes, and each chunk is folded into a running aggregate,
+    so memory is bounded by the chunk size and not by the file size.
+
+    Args:
+        tarfile (Path): path to the stored data for the given day
+        chunksize (int, optional): Number of rows read at once. Defaults to None, reading the whole file.
+        stats (dict, optional): If given, the number of rows read is stored in its 'rows_in' key. Defaults to None.
+        cube (bool, optional): Keep hours and distance bands, and sum trip-km too. Defaults to False.
+
+    Raises:
+        Exception: Error if read_csv cannot read tarfile
+
+    Returns:
+        tuple: arrays of dates (YYYYMMDD), origin provinces, destination provinces and trips,
+            with one element for each pair of provinces. If cube is True, arrays of dates,
+            origin provinces, destination provinces, hours, distance band codes, trips and
+            trip-km, with one element for each pair of provinces, hour and distance band.
+    """
+    arrays, _, rows_in = _aggregate_file(tarfile, chunksize, cube)
+    if stats is not None:
+        stats['rows_in'] = rows_in
+    return arrays
+
+
+def _aggregate_day_stats(tarfile, chunksize=None, cube=False, levels=()) -> tuple:
+    """Run _aggregate_file returning also the metrics of the file, to be recorded by the parent"""
+    tic = time.perf_counter()
+    arrays, level_arrays, rows_in = _aggregate_file(tarfile, chunksize, cube, levels)
+    return arrays, level_arrays, {'file': tarfile.name,
+                                  'seconds': round(time.perf_counter() - tic, 4),
+                                  'bytes_read': instrument.file_size(corrections.source(tarfile)),
+                                  'rows_in': rows_in,
+                                  'rows_out': len(arrays[0]),
+                                  'max_rss_mb': instrument.max_rss_mb()}
+
+
+def arrays_to_frame(dates, origins, destinations, trips) -> pd.DataFrame:
+    """Build the dataframe of aggregated trips from the arrays returned by aggregate_day
+
+    Args:
+        dates (np.ndarray): dates as YYYYMMDD integers
+        origins (np.ndarray): integer origin province codes
+        destinations (np.ndarray): integer destination province codes
+        trips (np.ndarray): trips between provinces
 
+    Returns:
+        pd.DataFrame: Dataframe with fecha, origen, destino and viajes columns
+    """
+    return pd.DataFrame({
+        'fecha': ints_to_days(dates),
+        'origen': PROVINCE_CODES[origins],
+        'destino': PROVINCE_CODES[destinations],
+        'viajes': trips,
+    })
+
+
+def process_day(tarfile, chunksize=None):
+    """Process data for a given day
+
+    Args:
+        tarfile (Path): path to the stored data for the given day
+        chunksize (int, optional): Number of rows read at once. Defaults to None, reading the whole file.
+
+    Raises:
+        Exception: Error if read_csv cannot read tarfile
+
+    Returns:
+        pd.DataFrame: Dataframe containing data for given day
+    """
+    return arrays_to_frame(*aggregate_day(tarfile, chunksize))
+
+
+@instrument.instrumented('process')
 def process(day_files='all',
             exp='maestra1',
             res='municipios',
             update=False,
-            force=False):
-    """
-    day_files : list, str
-        List of absolute paths to day-tars to process.
-        If 'all' is passed, it will process every file.
+            force=False,
+            export_csv=False,
+            executor='thread',
+            workers=4,
+            chunksize=None,
+            cube=False,
+            levels=(),
+            sparse=False,
+            tables=None):
+    """Process day files into the province flux store
+
+    Args:
+        day_files (list, str, optional): List of absolute paths to day-tars to process.
+            If 'all' is passed, it will process every file. Defaults to 'all'.
+        exp (str, optional): Version of maestra of the data. Defaults to 'maestra1'.
+        res (str, optional): Locations of the data. Defaults to 'municipios'.
+        update (bool, optional): Only process new or changed files according to the manifest,
+            replacing their days in the store instead of rebuilding it. Defaults to False.
+        force (bool, optional): In update mode, process the files even if they have not changed. Defaults to False.
+        export_csv (bool, optional): Also export the whole store to province_flux.csv. Defaults to False.
+        executor (str, optional): Process day files in a pool of 'thread' or 'process'. Defaults to 'thread'.
+        workers (int, optional): Number of day files processed in parallel. Defaults to 4.
+        chunksize (int, optional): Stream each day file in chunks of this many rows
+            to bound memory of each worker. Defaults to None, reading whole files.
+        cube (bool, optional): Also write the hour and distance cube of the days processed,
+            from which the province flux is rolled up. Pass it in every update run to keep
+            the cube in sync with the store. Defaults to False.
+        levels (tuple, optional): Zone levels written to their own store besides provinces,
+            aggregated in the same pass over each file. Defaults to ().
+        sparse (bool, optional): Also write the daily OD matrix of the finest zone level of
+            the location files (districts or municipalities) as sparse matrices, see
+            sparse_od.py. Requires scipy. Defaults to False.
+        tables (dict, optional): If given, the province flux of the days processed is stored
+            in its 'flux' key, so next stages can use it without reading the store. Defaults to None.
+        profile (str, optional): Profile the run with 'cprofile' or 'pyinstrument'. Defaults to None.
+
+    Raises:
+        ValueError: executor must be one of the valid executors.
+        ValueError: levels must be valid levels of the location files.
+
+    Returns:
+        list: datetime.date of the days written to the store
     """
+    if executor not in EXECUTOR_VALID_VALUES:
+        raise ValueError(f'executor {executor} is not a valid input. Valid executors are: {", ".join(EXECUTOR_VALID_VALUES)}')
+    valid_levels = zones.LOCATION_LEVELS.get(res, zones.LEVELS)
+    if not set(levels) <= set(valid_levels):
+        raise ValueError(f'levels {", ".join(levels)} is not a valid input. Valid levels are: {", ".join(valid_levels)}')
+    # Provinces are always written to the province flux store
+    levels = tuple(level for level in levels if level != 'province')
+    # Matrices are built from the native level, aggregated in the same pass
+    native = valid_levels[0]
+    aggregated = levels + (native,) if sparse and native not in levels else levels
 
     # Prepare files
     raw_dir = PATHS.raw / f'{exp}' / f'{res}'
     if day_files == 'all':
-        day_files = sorted(os.listdir(raw_dir))
-        day_files = [raw_dir / d for d in day_files]
+        day_files = corrections.day_files(raw_dir, exp, res)
     if not day_files:
         print('No files to process.')
-        return
-
-    # Load INE code_map to add names to the tables
-    cod_path = PATHS.raw / 'codigos_ine' / '20_cod_prov.xls'
-    cod_map = pd.read_excel(cod_path, dtype={'Codigo': 'string'})
-    cod_map = dict(zip(cod_map.Codigo, cod_map.Literal))
-
-    # Load existing files
-    if update and (PATHS.processed / "province_flux.csv").exists():
-        previous_df = pd.read_csv(PATHS.processed / "province_flux.csv")
-
-        # Compare dates
-        last = datetime.datetime.strptime(previous_df['date'].iloc[-1], '%Y-%m-%d')
-        first = datetime.datetime.strptime(day_files[0].name[:8], '%Y%m%d')
-
-        if last + datetime.timedelta(days=1) != first and not force:
-            raise Exception(f'The last day ({last.date()}) saved and the first day ({first.date()}) '
-                            'of the update are not consecutive. '
-                            'You will probably be safer rerunning the download  '
-                            'and running the whole processing from scratch (update=False). '
-                            'You can use force=True if you want to append the data '
-                            'nevertheless.')
-    else:
-        previous_df = pd.DataFrame([])
+        return []
+
+    # Select new or changed files
+    manifest = Manifest()
+    if update and not force:
+        day_files = manifest.changed(day_files)
+        if not day_files:
+            print('Already up-to-date')
+            manifest.save()
+            return []
+    elif not update:
+        store.clear()
+        od_tensor.clear()
+        od_cube.clear()
+        zones.clear()
+        sparse_od.clear()
+        manifest.reset()
+
+    # Skip corrupt files instead of failing while reading them
+    with instrument.stage('check raw files') as stage:
+        raw = RawStore(raw_dir)
+        _, corrupt = raw.check(sorted({corrections.source(f) for f in day_files}))
+        raw.save()
+        stage['rows_in'] = len(day_files)
+    if corrupt:
+        print(f'Skipping {len(corrupt)} corrupt files, download them again: '
+              f'{", ".join(f.name for f in corrupt)}')
+        corrupt = set(corrupt)
+        day_files = [f for f in day_files if corrections.source(f) not in corrupt]
+        if not day_files:
+            manifest.save()
+            return []
+
+    # Load the province names to add them to the tables, parsed once and cached
+    with instrument.stage('read code map') as stage:
+        names = province_names()
+        stage['rows_out'] = int(pd.notna(names).sum())
 
     # Parallelize the processing for speed
     print('Processing data ...')
-    thread_num = 4
+    pool_class = ThreadPool if executor == 'thread' else Pool
     results = []
-    out = ThreadPool(thread_num).imap(process_day, day_files)
-    for r in tqdm(out, total=len(day_files)):
-        results.append(r)
-    full_df = pd.concat(results).reset_index()
+    level_results = []
+    with instrument.stage('aggregate day files') as stage, pool_class(workers) as pool:
+        out = pool.imap(partial(_aggregate_day_stats, chunksize=chunksize, cube=cube, levels=aggregated), day_files)
+        for r, level_r, metrics in tqdm(out, total=len(day_files)):
+            results.append(r)
+            level_results.append(level_r)
+            instrument.record_file(**metrics)
+            for key in ('bytes_read', 'rows_in', 'rows_out'):
+                stage.add(key, metrics[key])
+    arrays = [np.concatenate(a) for a in zip(*results)]
+    if cube:
+        cube_df = od_cube.arrays_to_cube(*arrays)
+        with instrument.stage('write cube', rows_in=len(cube_df)) as stage:
+            written = od_cube.write_days(cube_df)
+            stage['bytes_written'] = sum(instrument.file_size(f) for f in written)
+        # Roll up hours and distances so raw files are only read once
+        daily = pd.Series(arrays[5]).groupby(arrays[:3], sort=True).sum()
+        arrays = [daily.index.get_level_values(i).to_numpy() for i in range(3)] + [daily.to_numpy()]
+    full_df = arrays_to_frame(*arrays)
+
+    for level in aggregated:
+        dates, origins, destinations, trips = (np.concatenate(a) for a in zip(*(r[level] for r in level_results)))
+        level_df = pd.DataFrame({'date': ints_to_days(dates),
+                                 'origin': origins, 'dest': destinations, 'flux': trips})
+        if level in levels:
+            with instrument.stage(f'write {level} flux', rows_in=len(level_df)) as stage:
+                written = zones.write_days(level_df, level)
+                stage['bytes_written'] = sum(instrument.file_size(f) for f in written)
+        if sparse and level == native:
+            with instrument.stage(f'write {level} od matrices', rows_in=len(level_df)) as stage:
+                written = sparse_od.write_days(level_df, level)
+                stage['bytes_written'] = sum(instrument.file_size(f) for f in written)
 
     # Clean and add id codes
     full_df = full_df.rename(columns={'fecha': 'date',
@@ -105,21 +366,57 @@ def process(day_files='all',
                                     'destino': 'province id destination',
                                     'viajes': 'flux'})
 
-    full_df['province origin'] = full_df['province id origin'].map(cod_map)
-    full_df['province destination'] = full_df['province id destination'].map(cod_map)
+    full_df['province origin'] = names[arrays[1]]
+    full_df['province destination'] = names[arrays[2]]
     full_df = full_df[['date', 'province origin', 'province id origin',
                     'province destination', 'province id destination', 'flux']]
 
-    # Append and save
-    full_df = pd.concat([previous_df, full_df])
+    # Save new days, previous ones are left untouched
+    with instrument.stage('write store', rows_in=len(full_df)) as stage:
+        written = store.write_days(full_df)
+        stage['bytes_written'] = sum(instrument.file_size(f) for f in written)
+    if tables is not None:
+        tables['flux'] = full_df
+    with instrument.stage('write od tensor', rows_in=len(full_df)) as stage:
+        od_tensor.update(full_df, names)
+        stage['bytes_written'] = instrument.file_size(od_tensor.tensor_path())
+
+    # Record processed files and mark their days as pending for next stages
+    dates = []
+    for fpath, r in zip(day_files, results):
+        for date in ints_to_days(np.unique(r[0])).tolist():
+            manifest.record(fpath, store.day_path(date))
+            dates.append(date)
+    dates = sorted(set(dates))
+    manifest.mark_stale(dates)
+    manifest.save()
+
+    if export_csv:
+        with instrument.stage('export csv') as stage:
+            store.export_csv()
+            stage['bytes_written'] = instrument.file_size(PATHS.processed / 'province_flux.csv')
+
+    return dates
 
-    full_df.to_csv(
-        PATHS.processed / "province_flux.csv",
-        index=False,
-        sep=";", 
-        encoding='latin1'
-    )
+@click.command()
+@click.option('--maestra-version', '-mv', 'exp', default='maestra1', help="Version of maestra of the data.")
+@click.option('--location', '-l', 'res', default='municipios', help="Locations of data.")
+@click.option('--update', '-u', is_flag=True, default=False, help="Only process new or changed files.")
+@click.option('--force', '-f', is_flag=True, default=False, help="In update mode, process files even if they have not changed.")
+@click.option('--export-csv', is_flag=True, default=False, help="Also export province_flux.csv.")
+@click.option('--executor', '-e', default='thread', type=click.Choice(EXECUTOR_VALID_VALUES), help="Pool used to process day files.")
+@click.option('--workers', '-w', default=4, help="Number of day files processed in parallel.")
+@click.option('--chunksize', '-c', default=None, type=int, help="Stream day files in chunks of this many rows.")
+@click.option('--cube', is_flag=True, default=False, help="Also write the hour and distance cube.")
+@click.option('--level', '-lv', 'levels', multiple=True, type=click.Choice(zones.LEVELS), help="Also aggregate to this zone level, can be repeated.")
+@click.option('--sparse', is_flag=True, default=False, help="Also write sparse daily OD matrices of the finest zones.")
+@click.option('--profile', default=None, type=click.Choice(instrument.PROFILE_VALID_VALUES), help="Profile the run.")
+def main(exp, res, update, force, export_csv, executor, workers, chunksize, cube, levels, sparse, profile):
+    """Process downloaded files into the province flux store"""
+    process(exp=exp, res=res, update=update, force=force,
+            export_csv=export_csv, executor=executor, workers=workers,
+            chunksize=chunksize, cube=cube, levels=levels, sparse=sparse, profile=profile)
 
 
 if __name__ == '__main__':
-    process()
\ No newline at end of file
+    main()
@@ -0,0 +1,265 @@
+"""
+Query.py file serve slices of the processed data to dashboard back-ends.
+
+Queries only open the partitions and row groups of the requested dates, and
+provinces, CCAA and index types are filtered while reading (predicate
+pushdown), so the memory used depends on the slice requested and not on the
+length of the history. A small HTTP server returns the slices as JSON or as
+an Arrow IPC stream:
+
+    python query.py --port 8000
+    GET /flux?start=2020-05-01&end=2020-05-31&province=28
+    GET /index?start=2020-05-01&ccaa=Galicia&index=INTERNAL&format=arrow
+    GET /flows?start=2020-05-04&end=2020-05-10&province=Madrid&province=Toledo
+"""
+import json
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+import pandas as pd
+import pyarrow as pa
+
+from utils import N_CODES, cod_map, province_ccaa, ccaa_names
+import store
+from flowmap import materialize_locations
+from geo import CoordinateCache
+from generate_index import read_index
+
+DIRECTION_VALID_VALUES = ('both', 'origin', 'destination')
+FORMAT_VALID_VALUES = ('json', 'arrow')
+
+
+def ccaa_codes(ccaa=None) -> list:
+    """Integer codes of CCAA given by their codes or names
+
+    Args:
+        ccaa (list, optional): codes or names of CCAA, as in utils.ccaa_names. Defaults to None.
+
+    Raises:
+        ValueError: ccaa must be known codes or names.
+
+    Returns:
+        list: integer CCAA codes
+    """
+    names = ccaa_names()
+    lookup = {}
+    for code, name in enumerate(names):
+        if name is not None:
+            lookup[name] = lookup[f'{code:02d}'] = code
+    codes = []
+    for region in ccaa or []:
+        if region not in lookup:
+            raise ValueError(f'ccaa {region} is not a valid input. '
+                             f'Valid CCAA are: {", ".join(n for n in names if n is not None)}')
+        codes.append(lookup[region])
+    return codes
+
+
+def province_codes(provinces=None, ccaa=None) -> list:
+    """INE codes of a selection of provinces and CCAA
+
+    Args:
+        provinces (list, optional): INE codes or names of provinces. Defaults to None.
+        ccaa (list, optional): codes or names of CCAA, whose provinces are selected. Defaults to None.
+
+    Raises:
+        ValueError: provinces and ccaa must be known codes or names.
+
+    Returns:
+        list: sorted INE codes, None if nothing is selected
+    """
+    if not provinces and not ccaa:
+        return None
+    codes = set()
+    names = {name: code for code, name in cod_map().items()}
+    for province in provinces or []:
+        code = province if province in names.values() else names.get(province)
+        if code is None:
+            raise ValueError(f'province {province} is not a valid input. Valid provinces are INE codes or names')
+        codes.add(code)
+
+    for code in ccaa_codes(ccaa):
+        codes.update(f'{p:02d}' for p in (province_ccaa()[:N_CODES] == code).nonzero()[0])
+    return sorted(codes)
+
+
+def flux(start=None, end=None, provinces=None, ccaa=None, direction='both', columns=None) -> pd.DataFrame:
+    """Province flux of a date range, involving some provinces
+
+    Args:
+        start (datetime.date, optional): First day. Defaults to first day stored.
+        end (datetime.date, optional): Last day. Defaults to last day stored.
+        provinces (list, optional): INE codes or names of provinces. Defaults to every province.
+        ccaa (list, optional): codes or names of CCAA. Defaults to every CCAA.
+        direction (str, optional): Select flows whose 'origin', 'destination' or either of
+            them ('both') is one of the provinces. Defaults to 'both'.
+        columns (list, optional): Columns to read. Defaults to store.FLUX_COLUMNS.
+
+    Raises:
+        ValueError: direction must be one of the valid directions.
+        FileNotFoundError: Error if there is no data stored for the requested period
+
+    Returns:
+        pd.DataFrame: province flux sorted by date
+    """
+    if direction not in DIRECTION_VALID_VALUES:
+        raise ValueError(f'direction {direction} is not a valid input. Valid directions are: {", ".join(DIRECTION_VALID_VALUES)}')
+    codes = province_codes(provinces, ccaa)
+    filters = None
+    if codes is not None:
+        origin = [('province id origin', 'in', codes)]
+        dest = [('province id destination', 'in', codes)]
+        filters = {'origin': origin, 'destination': dest, 'both': [origin, dest]}[direction]
+    return store.read_flux(columns=columns, start=start, end=end, filters=filters)
+
+
+def flows(start=None, end=None, provinces=None, ccaa=None, direction='both') -> pd.DataFrame:
+    """Flows of a date range with names and coordinates of their locations,
+    as in flowmap_flows_location.csv
+
+    Args:
+        start (datetime.date, optional): First day. Defaults to first day stored.
+        end (datetime.date, optional): Last day. Defaults to last day stored.
+        provinces (list, optional): INE codes or names of provinces. Defaults to every province.
+        ccaa (list, optional): codes or names of CCAA. Defaults to every CCAA.
+        direction (str, optional): Select flows whose 'origin', 'destination' or either of
+            them ('both') is one of the provinces. Defaults to 'both'.
+
+    Returns:
+        pd.DataFrame: flows with origin, dest, count, time and the names and coordinates of their locations
+    """
+    df = flux(start, end, provinces, ccaa, direction)
+    locations = pd.DataFrame({'id': pd.concat([df['province id origin'], df['province id destination']]).astype(str),
+                              'name': pd.concat([df['province origin'], df['province destination']]).astype(str)})
+    locations = locations.drop_duplicates('id')
+    locations = locations.merge(CoordinateCache().lookup(locations['id']), on='id')
+    df = df.rename(columns={'province id origin': 'origin', 'province id destination': 'dest',
+                            'flux': 'count', 'date': 'time'})
+    df = df[['origin', 'dest', 'count', 'time']]
+    return materialize_locations(df, locations)
+
+
+def index(start=None, end=None, provinces=None, ccaa=None, index_types=None) -> pd.DataFrame:
+    """Mobility indexes of a date range, of some provinces, CCAA and index types
+
+    Args:
+        start (datetime.date, optional): First day. Defaults to first day computed.
+        end (datetime.date, optional): Last day. Defaults to last day computed.
+        provinces (list, optional): names of provinces, as in origin_name, or INE codes. Defaults to every province.
+        ccaa (list, optional): codes or names of CCAA, as in flux. Defaults to every CCAA.
+        index_types (list, optional): 'INTERNAL', 'OUTWARD' and/or 'INWARD'. Defaults to every type.
+
+    Raises:
+        ValueError: ccaa must be known codes or names.
+        FileNotFoundError: Error if generate_index has not been run
+
+    Returns:
+        pd.DataFrame: indexes sorted by time
+    """
+    filters = []
+    if provinces:
+        names = cod_map()
+        filters.append(('origin_name', 'in', [names.get(p, p) for p in provinces]))
+    if ccaa:
+        # The CCAA column of the index is filled from the same lookup arrays
+        filters.append(('CCAA', 'in', list(ccaa_names()[ccaa_codes(ccaa)])))
+    if index_types:
+        filters.append(('index', 'in', list(index_types)))
+    return read_index(start, end, filters)
+
+
+# Query functions served by the HTTP server, with the parameters they read
+ENDPOINTS = {
+    'flux': (flux, ('start', 'end', 'province', 'ccaa', 'direction')),
+    'flows': (flows, ('start', 'end', 'province', 'ccaa', 'direction')),
+    'index': (index, ('start', 'end', 'province', 'ccaa', 'index')),
+}
+# Query string parameter to keyword argument, parameters in LIST_PARAMETERS can be repeated
+PARAMETER_NAMES = {'province': 'provinces', 'index': 'index_types'}
+LIST_PARAMETERS = ('province', 'ccaa', 'index')
+
+
+def to_json(df: pd.DataFrame) -> bytes:
+    """Serialize a slice as a JSON list of records, with dates as YYYY-MM-DD"""
+    df = df.copy()
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = df[col].dt.strftime('%Y-%m-%d')
+    return df.to_json(orient='records').encode('utf-8')
+
+
+def to_arrow(df: pd.DataFrame) -> bytes:
+    """Serialize a slice as an Arrow IPC stream"""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """Answer GET /flux, /flows and /index requests with the slice requested"""
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        endpoint = ENDPOINTS.get(url.path.strip('/'))
+        if endpoint is None:
+            return self._send_error(404, f'Unknown endpoint {url.path}. Valid endpoints are: {", ".join(ENDPOINTS)}')
+        fmt = params.get('format', ['json'])[0]
+        if fmt not in FORMAT_VALID_VALUES:
+            return self._send_error(400, f'format {fmt} is not a valid input. Valid formats are: {", ".join(FORMAT_VALID_VALUES)}')
+
+        query, names = endpoint
+        kwargs = {PARAMETER_NAMES.get(name, name): params[name] if name in LIST_PARAMETERS else params[name][0]
+                  for name in names if name in params}
+        try:
+            df = query(**kwargs)
+        except FileNotFoundError as e:
+            return self._send_error(404, str(e))
+        except ValueError as e:
+            return self._send_error(400, str(e))
+
+        if fmt == 'arrow':
+            self._send(200, to_arrow(df), 'application/vnd.apache.arrow.stream')
+        else:
+            self._send(200, to_json(df), 'application/json')
+
+    def _send(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: int, message: str):
+        self._send(status, json.dumps({'error': message}).encode('utf-8'), 'application/json')
+
+
+def serve(host: str = '127.0.0.1', port: int = 8000):
+    """Serve the queries over HTTP until interrupted
+
+    Args:
+        host (str, optional): Address to listen on. Defaults to '127.0.0.1'.
+        port (int, optional): Port to listen on. Defaults to 8000.
+    """
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    print(f'Serving {", ".join(ENDPOINTS)} on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1', help="Address to listen on.")
+@click.option('--port', '-p', default=8000, help="Port to listen on.")
+def main(host, port):
+    """Serve slices of the processed data over HTTP"""
+    serve(host, port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""
+Raw_store.py file keep the raw files downloaded in a content-addressed store.
+
+Each downloaded file is validated (complete gzip stream with the header of the
+opendata-movilidad files) and stored by the sha256 of its content:
+
+    raw/objects/3f/3fa2...c1.txt.gz
+
+The day file read by process, e.g. raw/maestra1/municipios/20200601_...txt.gz,
+is a hard link to its object. An index in the folder of each dataset
+(e.g. raw/maestra1/municipios/raw_index.json) records for each day file its
+hash, size, modification time and the ETag and Last-Modified headers of the
+server, used to send conditional requests on refresh. Objects are shared by
+every dataset, so datasets can be downloaded concurrently.
+"""
+import gzip
+import json
+import os
+import shutil
+import threading
+import zlib
+
+from utils import PATHS
+from manifest import file_hash
+
+INDEX_NAME = 'raw_index.json'
+OBJECTS_NAME = 'objects'
+# First bytes of a gzip file and of the decompressed opendata-movilidad files
+GZIP_MAGIC = b'\x1f\x8b'
+HEADER_PREFIX = b'fecha|'
+
+
+def validate_gzip(fpath, chunk_size: int = 1 << 20) -> bool:
+    """Check a file is a complete gzip stream of an opendata-movilidad file
+
+    Error pages saved as .txt.gz and truncated downloads are detected by
+    decompressing the whole file without parsing it.
+
+    Args:
+        fpath (Path): path to the file
+        chunk_size (int, optional): Size in bytes of the chunks decompressed. Defaults to 1 MiB.
+
+    Returns:
+        bool: True if the file is valid
+    """
+    try:
+        with open(fpath, 'rb') as f:
+            if f.read(2) != GZIP_MAGIC:
+                return False
+        with gzip.open(fpath, 'rb') as f:
+            if not f.read(len(HEADER_PREFIX)) == HEADER_PREFIX:
+                return False
+            while f.read(chunk_size):
+                pass
+    except (OSError, EOFError, zlib.error):
+        return False
+    return True
+
+
+class RawStore():
+    """Index of the day files of a raw folder, stored as content-addressed objects"""
+    def __init__(self, raw_dir=None):
+        raw_dir = PATHS.raw if raw_dir is None else raw_dir
+        self._path = raw_dir / INDEX_NAME
+        if self._path.exists():
+            with open(self._path) as f:
+                self._files = json.load(f)
+        else:
+            self._files = {}
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def objects_dir(self):
+        return PATHS.raw / OBJECTS_NAME
+
+    def key(self, fpath) -> str:
+        """Key of a day file in the index, its path relative to the folder of the index"""
+        try:
+            return fpath.relative_to(self._path.parent).as_posix()
+        except ValueError:
+            return fpath.as_posix()
+
+    def entry(self, fpath) -> dict:
+        """Recorded metadata of a day file, None if it is not in the index"""
+        return self._files.get(self.key(fpath))
+
+    def is_valid(self, fpath) -> bool:
+        """Check a day file exists and is the file validated when it was stored
+
+        Args:
+            fpath (Path): path to the day file
+
+        Returns:
+            bool: True if the size and modification time of the file are the recorded ones
+        """
+        entry = self.entry(fpath)
+        if entry is None or not fpath.exists():
+            return False
+        stat = os.stat(fpath)
+        return entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime
+
+    def conditional_headers(self, fpath) -> dict:
+        """Headers of a conditional request returning 304 if the file has not changed in the server
+
+        Args:
+            fpath (Path): path to the day file
+
+        Returns:
+            dict: If-None-Match and If-Modified-Since headers, empty if the file is not valid
+        """
+        if not self.is_valid(fpath):
+            return {}
+        entry = self.entry(fpath)
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def object_path(self, sha256: str):
+        """Path of the object with a given hash"""
+        return self.objects_dir / sha256[:2] / f'{sha256}.txt.gz'
+
+    def add(self, fpath, src, url: str = None, headers: dict = None):
+        """Store a downloaded file as an object and link its day file to it
+
+        Args:
+            fpath (Path): path to the day file
+            src (Path): path to the downloaded file, already validated with validate_gzip,
+                moved into the store
+            url (str, optional): url of the file. Defaults to None.
+            headers (dict, optional): response headers of the download. Defaults to None.
+        """
+        headers = {} if headers is None else headers
+        sha256 = file_hash(src)
+        obj = self.object_path(sha256)
+        obj.parent.exists() or os.makedirs(obj.parent)
+        if obj.exists():
+            os.remove(src)
+        else:
+            os.replace(src, obj)
+
+        with self._lock:
+            previous = self.entry(fpath)
+            tmp = fpath.with_name(fpath.name + '.tmp')
+            try:
+                os.link(obj, tmp)
+            except OSError:
+                # File systems without hard links keep a copy
+                shutil.copy2(obj, tmp)
+            os.replace(tmp, fpath)
+            if previous is not None and previous['sha256'] != sha256:
+                self._remove_unused(previous['sha256'])
+
+            stat = os.stat(fpath)
+            self._files[self.key(fpath)] = {
+                'sha256': sha256,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'url': url,
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+            }
+
+    def _remove_unused(self, sha256: str):
+        obj = self.object_path(sha256)
+        if obj.exists() and os.stat(obj).st_nlink == 1:
+            os.remove(obj)
+
+    def check(self, files: list) -> tuple:
+        """Split day files into valid and corrupt ones
+
+        Files stored by download are trusted while unchanged. Other files are
+        validated and, if valid, recorded so they are only validated once.
+
+        Args:
+            files (list): paths to day files
+
+        Returns:
+            tuple: lists of valid and of corrupt files
+        """
+        valid, corrupt = [], []
+        for fpath in files:
+            if self.is_valid(fpath):
+                valid.append(fpath)
+            elif fpath.exists() and validate_gzip(fpath):
+                stat = os.stat(fpath)
+                self._files[self.key(fpath)] = {'sha256': file_hash(fpath), 'size': stat.st_size,
+                                                'mtime': stat.st_mtime, 'url': None,
+                                                'etag': None, 'last_modified': None}
+                valid.append(fpath)
+            else:
+                corrupt.append(fpath)
+        return valid, corrupt
+
+    def save(self):
+        """Write the index to disk"""
+        self._path.parent.exists() or os.makedirs(self._path.parent)
+        tmp = self._path.with_name(self._path.name + '.tmp')
+        with self._lock, open(tmp, 'w') as f:
+            json.dump(self._files, f, indent=1, sort_keys=True)
+        os.replace(tmp, self._path)
@@ -0,0 +1,258 @@
+"""
+Sparse_od.py file store the daily OD matrix at the native zone resolution of the data.
+
+Most pairs of districts or municipalities have no trips on a given day, so each
+day is stored as a sparse CSR matrix instead of a dense zones x zones array or
+one row per pair:
+
+    processed/municipality_od/month=2020-06/20200601.npz
+    processed/municipality_od_zones.json
+
+Rows and columns of the matrices are positions in the zone index of the level.
+Zones seen for the first time are appended to the index, so matrices of days
+already stored keep their positions and are padded with empty rows and columns
+when read.
+
+Flowmaps of fine grained zones only render the largest flows, so the matrices
+can be filtered with top_k and threshold before any flow row is built.
+
+scipy is imported when matrices are built or read, so the rest of the pipeline
+does not need it.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import store
+from zones import LEVELS, LEVEL_COLUMNS
+
+FLOW_COLUMNS = ['origin', 'dest', 'count', 'time']
+
+
+def store_name(level: str) -> str:
+    """Name of the store of the OD matrices of a level"""
+    return f'{level}_od'
+
+
+def zones_path(level: str, root=None):
+    """Path to the zone index of the matrices of a level"""
+    return store.store_dir(root, f'{store_name(level)}_zones.json')
+
+
+def zone_index(level: str, root=None) -> pd.Index:
+    """Zone codes of the rows and columns of the matrices of a level
+
+    Args:
+        level (str): one of zones.LEVELS
+        root (Path, optional): Folder containing the store. Defaults to PATHS.processed.
+
+    Returns:
+        pd.Index: zone code of each position, empty if nothing is stored
+    """
+    fpath = zones_path(level, root)
+    if not fpath.exists():
+        return pd.Index([], dtype=object)
+    with open(fpath, encoding='utf-8') as f:
+        return pd.Index(json.load(f), dtype=object)
+
+
+def update_zone_index(codes, level: str, root=None) -> pd.Index:
+    """Append new zone codes to the zone index of a level
+
+    Args:
+        codes (array-like): zone codes to index
+        level (str): one of zones.LEVELS
+        root (Path, optional): Folder containing the store. Defaults to PATHS.processed.
+
+    Returns:
+        pd.Index: updated zone index
+    """
+    index = zone_index(level, root)
+    new = pd.Index(pd.unique(np.asarray(codes, dtype=object))).difference(index)
+    if len(new):
+        index = index.append(pd.Index(sorted(new), dtype=object))
+        fpath = zones_path(level, root)
+        fpath.parent.exists() or os.makedirs(fpath.parent)
+        tmp = fpath.with_name(fpath.name + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(index.tolist(), f)
+        os.replace(tmp, fpath)
+    return index
+
+
+def write_days(flux: pd.DataFrame, level: str, root=None) -> list:
+    """Write the OD matrix of each day of the flux of a level, replacing existing ones
+
+    Args:
+        flux (pd.DataFrame): flux with zones.LEVEL_COLUMNS
+        level (str): one of zones.LEVELS
+        root (Path, optional): Folder containing the store. Defaults to PATHS.processed.
+
+    Returns:
+        list: paths to the written matrix files
+    """
+    from scipy import sparse
+
+    flux = flux[LEVEL_COLUMNS]
+    origin, dest = flux['origin'].to_numpy(dtype=object), flux['dest'].to_numpy(dtype=object)
+    index = update_zone_index(np.concatenate([origin, dest]), level, root)
+    n = len(index)
+    rows = index.get_indexer(origin)
+    cols = index.get_indexer(dest)
+    trips = flux['flux'].to_numpy(dtype='float64')
+    days, day_ids = np.unique(pd.to_datetime(flux['date']).to_numpy(), return_inverse=True)
+
+    files = []
+    for i, date in enumerate(pd.to_datetime(days).date):
+        mask = day_ids == i
+        # Duplicated pairs are summed when converting to CSR
+        matrix = sparse.coo_matrix((trips[mask], (rows[mask], cols[mask])), shape=(n, n)).tocsr()
+        fpath = store.day_path(date, root, store_name(level), ext='npz')
+        fpath.parent.exists() or os.makedirs(fpath.parent)
+        tmp = fpath.with_name(fpath.name + '.tmp')
+        with open(tmp, 'wb') as f:
+            sparse.save_npz(f, matrix)
+        os.replace(tmp, fpath)
+        files.append(fpath)
+    return files
+
+
+def read_day(date, level: str, root=None, size: int = None):
+    """Read the OD matrix of a day
+
+    Args:
+        date (datetime.date): day to read
+        level (str): one of zones.LEVELS
+        root (Path, optional): Folder containing the store. Defaults to PATHS.processed.
+        size (int, optional): Number of zones of the matrix returned, padding matrices
+            written before new zones were indexed. Defaults to the size of the zone index.
+
+    Raises:
+        FileNotFoundError: Error if the day is not stored
+
+    Returns:
+        scipy.sparse.csr_matrix: trips from each zone (rows) to each zone (columns)
+    """
+    from scipy import sparse
+
+    fpath = store.day_path(date, root, store_name(level), ext='npz')
+    if not fpath.exists():
+        raise FileNotFoundError(f'No {level} OD matrix stored in {fpath}')
+    matrix = sparse.load_npz(fpath).tocsr()
+    size = len(zone_index(level, root)) if size is None else size
+    if matrix.shape != (size, size):
+        matrix.resize((size, size))
+    return matrix
+
+
+def top_k(matrix, k: int, per_origin: bool = False):
+    """Keep the k largest flows of a matrix, or of each origin
+
+    Args:
+        matrix (scipy.sparse matrix): OD matrix
+        k (int): number of flows kept
+        per_origin (bool, optional): Keep the k largest flows of each row instead of
+            the k largest of the whole matrix. Defaults to False.
+
+    Returns:
+        scipy.sparse.csr_matrix: matrix with the flows kept
+    """
+    from scipy import sparse
+
+    coo = matrix.tocoo()
+    coo.sum_duplicates()
+    if per_origin:
+        # Sort by row and decreasing trips, then rank flows within their row
+        order = np.lexsort((-coo.data, coo.row))
+        rows = coo.row[order]
+        rank = np.arange(len(rows)) - np.searchsorted(rows, rows, side='left')
+        keep = order[rank < k]
+    elif k < coo.nnz:
+        keep = np.argpartition(-coo.data, k - 1)[:k]
+    else:
+        keep = slice(None)
+    return sparse.csr_matrix((coo.data[keep], (coo.row[keep], coo.col[keep])), shape=coo.shape)
+
+
+def threshold(matrix, min_flux: float):
+    """Keep the flows of a matrix with at least min_flux trips
+
+    Args:
+        matrix (scipy.sparse matrix): OD matrix
+        min_flux (float): minimum number of trips of the flows kept
+
+    Returns:
+        scipy.sparse.csr_matrix: matrix with the flows kept
+    """
+    matrix = matrix.tocsr(copy=True)
+    matrix.data[matrix.data < min_flux] = 0
+    matrix.eliminate_zeros()
+    return matrix
+
+
+def to_flows(matrix, date) -> pd.DataFrame:
+    """Flow rows of the non zero entries of a matrix
+
+    Args:
+        matrix (scipy.sparse matrix): OD matrix
+        date (datetime.date): day of the matrix
+
+    Returns:
+        pd.DataFrame: flows with FLOW_COLUMNS, origin and dest being positions in the zone index
+    """
+    coo = matrix.tocoo()
+    return pd.DataFrame({'origin': coo.row.astype('int32'),
+                         'dest': coo.col.astype('int32'),
+                         'count': coo.data,
+                         'time': pd.Timestamp(date)})[FLOW_COLUMNS]
+
+
+def flows(level: str, start=None, end=None, dates=None, k: int = None, per_origin: bool = False,
+          min_flux: float = None, root=None) -> pd.DataFrame:
+    """Flows of a date range at a zone level, filtered on the matrices before building rows
+
+    Args:
+        level (str): one of zones.LEVELS
+        start (datetime.date, optional): First day. Defaults to first day stored.
+        end (datetime.date, optional): Last day. Defaults to last day stored.
+        dates (list, optional): Only read these days. Defaults to every day between start and end.
+        k (int, optional): Keep the k largest flows of each day, see top_k. Defaults to None, keeping every flow.
+        per_origin (bool, optional): Keep the k largest flows of each origin instead. Defaults to False.
+        min_flux (float, optional): Only keep flows with at least these trips. Defaults to None.
+        root (Path, optional): Folder containing the store. Defaults to PATHS.processed.
+
+    Raises:
+        FileNotFoundError: Error if there is no data stored for the requested period
+
+    Returns:
+        pd.DataFrame: flows with FLOW_COLUMNS sorted by time
+    """
+    dates = store.select_dates(store.list_dates(root, store_name(level), ext='npz'), start, end, dates)
+    if not dates:
+        raise FileNotFoundError(f'No {level} OD matrices stored in {store.store_dir(root, store_name(level))} '
+                                f'for the period {start} - {end}')
+    size = len(zone_index(level, root))
+    days = []
+    for date in dates:
+        matrix = read_day(date, level, root, size)
+        if min_flux is not None:
+            matrix = threshold(matrix, min_flux)
+        if k is not None:
+            matrix = top_k(matrix, k, per_origin)
+        days.append(to_flows(matrix, date))
+    return pd.concat(days, ignore_index=True)
+
+
+def clear(root=None):
+    """Remove the OD matrices and zone index of every level
+
+    Args:
+        root (Path, optional): Folder containing the stores. Defaults to PATHS.processed.
+    """
+    for level in LEVELS:
+        store.clear(root, store_name(level))
+        fpath = zones_path(level, root)
+        if fpath.exists():
+            os.remove(fpath)
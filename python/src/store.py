@@ -0,0 +1,244 @@
+"""
+Store.py file manage the columnar store of processed province flux.
+
+Data is stored as one Parquet file per day, partitioned by month:
+
+    processed/province_flux/month=2020-06/20200601.parquet
+
+so appending new days only writes new files and readers only open the
+files of the date range they need.
+"""
+import datetime
+import os
+import shutil
+
+import pandas as pd
+
+from utils import PATHS, in_period, isin_days
+
+STORE_NAME = 'province_flux'
+FLUX_COLUMNS = ['date', 'province origin', 'province id origin',
+                'province destination', 'province id destination', 'flux']
+CATEGORY_COLUMNS = ['province origin', 'province id origin',
+                    'province destination', 'province id destination']
+# Origin and destination columns sharing the same categories
+CATEGORY_PAIRS = [('province origin', 'province destination'),
+                  ('province id origin', 'province id destination')]
+
+
+def store_dir(root=None, name=STORE_NAME):
+    """Path to the root folder of the store
+
+    Args:
+        root (Path, optional): Folder containing the store. Defaults to PATHS.processed.
+        name (str, optional): Name of the store. Defaults to STORE_NAME.
+
+    Returns:
+        Path: path to the store
+    """
+    root = PATHS.processed if root is None else root
+    return root / name
+
+
+def day_path(date, root=None, name=STORE_NAME, ext='parquet'):
+    """Path to the partition file of a given day
+
+    Args:
+        date (datetime.date): day of the partition
+        root (Path, optional): Folder containing the store. Defaults to PATHS.processed.
+        name (str, optional): Name of the store. Defaults to STORE_NAME.
+        ext (str, optional): Extension of the partition files. Defaults to 'parquet'.
+
+    Returns:
+        Path: path to the partition file
+    """
+    return store_dir(root, name) / f'month={date:%Y-%m}' / f'{date:%Y%m%d}.{ext}'
+
+
+def list_dates(root=None, name=STORE_NAME, ext='parquet') -> list:
+    """List the days stored
+
+    Args:
+        root (Path, optional): Folder containing the store. Defaults to PATHS.processed.
+        name (str, optional): Name of the store. Defaults to STORE_NAME.
+        ext (str, optional): Extension of the partition files. Defaults to 'parquet'.
+
+    Returns:
+        list: sorted list of datetime.date stored
+    """
+    path = store_dir(root, name)
+    if not path.exists():
+        return []
+    dates = []
+    for month in os.listdir(path):
+        for f in os.listdir(path / month):
+            if f.endswith(f'.{ext}'):
+                dates.append(datetime.datetime.strptime(f[:8], '%Y%m%d').date())
+    return sorted(dates)
+
+
+def select_dates(stored: list, start=None, end=None, dates=None) -> list:
+    """Select the stored days of a period
+
+    Args:
+        stored (list): datetime.date stored
+        start (datetime.date, optional): First day. Defaults to no lower bound.
+        end (datetime.date, optional): Last day. Defaults to no upper bound.
+        dates (list, optional): Only select these days. Defaults to every day between start and end.
+
+    Returns:
+        list: selected datetime.date
+    """
+    mask = in_period(stored, start, end)
+    if dates is not None:
+        mask &= isin_days(stored, dates)
+    return [d for d, selected in zip(stored, mask) if selected]
+
+
+def clear(root=None, name=STORE_NAME):
+    """Remove every day stored
+
+    Args:
+        root (Path, optional): Folder containing the store. Defaults to PATHS.processed.
+        name (str, optional): Name of the store. Defaults to STORE_NAME.
+    """
+    path = store_dir(root, name)
+    if path.exists():
+        shutil.rmtree(path)
+
+
+def write_days(df: pd.DataFrame, root=None) -> list:
+    """Write a partition file for each day of the dataframe, replacing existing ones
+
+    Args:
+        df (pd.DataFrame): province flux with FLUX_COLUMNS
+        root (Path, optional): Folder containing the store. Defaults to PATHS.processed.
+
+    Returns:
+        list: paths to the written partition files
+    """
+    df = df[FLUX_COLUMNS].copy()
+    df['date'] = pd.to_datetime(df['date'])
+    for col in CATEGORY_COLUMNS:
+        df[col] = df[col].astype('category')
+
+    files = []
+    for date, day in df.groupby('date', sort=True):
+        fpath = day_path(date, root)
+        write_partition(day, fpath)
+        files.append(fpath)
+    return files
+
+
+def write_partition(df: pd.DataFrame, fpath, row_group_size: int = None):
+    """Write a partition file atomically, so readers never see a half written day
+
+    Args:
+        df (pd.DataFrame): rows of the partition
+        fpath (Path): path to the partition file
+        row_group_size (int, optional): Rows of each row group. Defaults to None, pyarrow default.
+    """
+    fpath.parent.exists() or os.makedirs(fpath.parent)
+    tmp = fpath.with_name(fpath.name + '.tmp')
+    df.to_parquet(tmp, index=False, row_group_size=row_group_size)
+    os.replace(tmp, fpath)
+
+
+def read_flux(columns=None, start=None, end=None, dates=None, root=None, filters=None) -> pd.DataFrame:
+    """Read the province flux stored
+
+    Args:
+        columns (list, optional): Columns to read. Defaults to all columns.
+        start (datetime.date, optional): First day to read. Defaults to first day stored.
+        end (datetime.date, optional): Last day to read. Defaults to last day stored.
+        dates (list, optional): Only read these days. Defaults to every day between start and end.
+        root (Path, optional): Folder containing the store. Defaults to PATHS.processed.
+        filters (list, optional): Row filters applied while reading each partition, in the
+            format of pyarrow (e.g. [('province id origin', 'in', ['28'])]). Defaults to None.
+
+    Raises:
+        FileNotFoundError: Error if there is no data stored for the requested period
+
+    Returns:
+        pd.DataFrame: province flux sorted by date
+    """
+    dates = select_dates(list_dates(root), start, end, dates)
+    if not dates:
+        raise FileNotFoundError(f'No province flux stored in {store_dir(root)} for the period {start} - {end}')
+
+    df = pd.concat([pd.read_parquet(day_path(d, root), columns=columns, filters=filters) for d in dates],
+                   ignore_index=True)
+    for origin, dest in CATEGORY_PAIRS:
+        cols = [c for c in (origin, dest) if c in df.columns]
+        if not cols:
+            continue
+        categories = pd.unique(pd.concat([df[c].astype('string') for c in cols]).dropna())
+        dtype = pd.CategoricalDtype(sorted(categories))
+        for col in cols:
+            df[col] = df[col].astype('string').astype(dtype)
+    return df
+
+
+def export_csv(fpath=None, root=None):
+    """Export the whole store to the csv file read by the R dashboard
+
+    Args:
+        fpath (Path, optional): Path of the csv file. Defaults to PATHS.processed / 'province_flux.csv'.
+        root (Path, optional): Folder containing the store. Defaults to PATHS.processed.
+    """
+    fpath = PATHS.processed / 'province_flux.csv' if fpath is None else fpath
+    df = read_flux(root=root)
+    df.to_csv(
+        fpath,
+        index=False,
+        sep=";",
+        encoding='latin1'
+    )
+
+
+def read_table(fpath) -> pd.DataFrame:
+    """Read a processed csv or parquet table, depending on its extension
+
+    Args:
+        fpath (Path): path of the table
+
+    Returns:
+        pd.DataFrame: table read, csv columns are read as text
+    """
+    if fpath.suffix == '.parquet':
+        return pd.read_parquet(fpath)
+    return pd.read_csv(fpath, sep=";", encoding='latin1', dtype=str, keep_default_na=False)
+
+
+def write_table(df: pd.DataFrame, fpath, dates=None, date_col: str = 'time', row_group_size: int = None):
+    """Write a processed csv or parquet table, replacing only some dates if requested
+
+    Args:
+        df (pd.DataFrame): data to write
+        fpath (Path): path of the table, its extension selects the format
+        dates (list, optional): Dates contained in df. If given and the file exists,
+            only the rows of these dates are replaced. Defaults to None, writing the whole file.
+        date_col (str, optional): Column with the dates. Defaults to 'time'.
+        row_group_size (int, optional): Rows of each row group of parquet files, smaller groups
+            let readers skip more data when filtering. Defaults to None, pyarrow default.
+    """
+    df = df.copy()
+    parquet = fpath.suffix == '.parquet'
+    if not parquet and date_col in df and pd.api.types.is_datetime64_any_dtype(df[date_col]):
+        df[date_col] = df[date_col].dt.strftime('%Y-%m-%d')
+    if dates is not None and fpath.exists():
+        # Previous rows of csv files are kept as text so they are written back unchanged
+        previous = read_table(fpath)
+        if parquet:
+            previous = previous[~previous[date_col].isin(pd.to_datetime(dates))]
+        else:
+            previous = previous[~previous[date_col].isin({f'{pd.Timestamp(d):%Y-%m-%d}' for d in dates})]
+        df = pd.concat([previous, df], ignore_index=True)
+        df = df.sort_values(date_col, kind='stable')
+    if parquet:
+        df.to_parquet(fpath, index=False, row_group_size=row_group_size)
+    else:
+        df.to_csv(
+            fpath,
+            index=False, encoding='latin1', sep=";"
+        )
@@ -2,13 +2,23 @@
 Utils.py file define a Paths object to manage paths to different folders in the project.
 """
 
+import functools
+import hashlib
 import pathlib
 import os
+import tempfile
+
+import numpy as np
 
 MAESTRA_VALID_VALUES = ('maestra1', 'maestra2')
 LOCATION_VALID_VALUES = ('distritos', 'municipios')
 BASE_URL = 'https://opendata-movilidad.mitma.es'
 
+# Reference table of the province names, relative to the raw folder
+INE_CODES = pathlib.Path('codigos_ine') / '20_cod_prov.xls'
+# Parquet caches of the reference tables, in the shared processed folder
+CACHE_DIR = 'cache'
+
 class Paths():
     def __init__(self):
         # Detect parent path
@@ -21,6 +31,8 @@ class Paths():
         self._notebooks = b.parents[1] / 'notebooks'
         # Define path to reports folder
         self._reports = b.parents[1] / 'reports'
+        # Dataset whose outputs are written in its own processed subfolder
+        self._dataset = None
 
     @property
     def data(self):
@@ -54,19 +66,35 @@ class Paths():
     def reports(self, val):
         self._reports = pathlib.Path(val)
         
+    @property
+    def dataset(self):
+        return self._dataset
+
+    @dataset.setter
+    def dataset(self, val):
+        self._dataset = val
+
     @property
     def raw(self):
         return self.data / "raw"
 
     @property
-    def processed(self):
+    def processed_root(self):
+        # Reference and lookup tables shared by every dataset
         return self.data / "processed"
+
+    @property
+    def processed(self):
+        if self._dataset is None:
+            return self.processed_root
+        return self.processed_root / self._dataset
     
     def __str__(self):
         return f"""
                 Data path:                {self.data}
                 INE data download path:   {self.raw}
                 Processed data path:      {self.processed}
+                Shared processed path:    {self.processed_root}
                 Reports directory path:   {self.reports}
                 Source directory path:    {self.src}
                 Notebooks directory path: {self.notebooks}
@@ -75,6 +103,11 @@ class Paths():
 
 PATHS = Paths()
 
+# Bundled table of the CCAA of each province, computed from the provinces geojson by geo.py
+CCAA_TABLE = PATHS.raw / 'codigos_ine' / 'ccaa_prov.csv'
+# Integer province and CCAA codes index the lookup arrays, -1 (last) for unknown ones
+N_CODES = 100
+
 
 def check_dirs():
     """Function to check project directories, create not detected folders.
@@ -84,13 +117,12 @@ def check_dirs():
     """
     print("Checking directories...")
         
-    for attr, path in vars(PATHS).items():
-        if not attr.startswith('__'):
-            if not path.exists():
-                print(f"{path} folder not detected, creating it.")
-                os.makedirs(path)
-            else:
-                print(f"{path} folder detected.")
+    for path in (PATHS.data, PATHS.src, PATHS.notebooks, PATHS.reports):
+        if not path.exists():
+            print(f"{path} folder not detected, creating it.")
+            os.makedirs(path)
+        else:
+            print(f"{path} folder detected.")
     if not PATHS.processed.exists():
         print(f"{PATHS.processed} folder not detected, creating it.")
         os.makedirs(PATHS.processed)
@@ -105,5 +137,193 @@ def check_dirs():
     
     return True
 
+
+def dataset_name(maestra_version: str, location: str) -> str:
+    """Name of the processed subfolder of a dataset, e.g. 'maestra1_municipios'"""
+    return f'{maestra_version}_{location}'
+
+
+def ints_to_days(dates) -> np.ndarray:
+    """Convert YYYYMMDD integers to days with integer arithmetic, without parsing text
+
+    Args:
+        dates (np.ndarray): dates as YYYYMMDD integers
+
+    Returns:
+        np.ndarray: datetime64[D] array
+    """
+    dates = np.asarray(dates, dtype='int64')
+    months = (dates // 10000 - 1970) * 12 + dates // 100 % 100 - 1
+    return months.astype('datetime64[M]').astype('datetime64[D]') + (dates % 100 - 1)
+
+
+def to_days(dates) -> np.ndarray:
+    """Convert dates to a datetime64[D] array
+
+    Args:
+        dates (array-like): datetime64 values, pd.Timestamp, datetime.date,
+            ISO formatted strings or YYYYMMDD integers
+
+    Returns:
+        np.ndarray: datetime64[D] array
+    """
+    dates = np.asarray(dates)
+    if dates.dtype.kind in 'iu':
+        return ints_to_days(dates)
+    return dates.astype('datetime64[D]')
+
+
+def weekday(dates) -> np.ndarray:
+    """Day of the week of dates, Monday being 0 and Sunday 6
+
+    Args:
+        dates (array-like): dates accepted by to_days
+
+    Returns:
+        np.ndarray: int8 array of weekdays
+    """
+    # 1970-01-01 was a Thursday
+    return ((to_days(dates).astype('int64') + 3) % 7).astype('int8')
+
+
+def isin_days(dates, days) -> np.ndarray:
+    """Check which dates are in a set of days
+
+    Args:
+        dates (array-like): dates accepted by to_days
+        days (array-like): days of the set, accepted by to_days
+
+    Returns:
+        np.ndarray: boolean mask
+    """
+    return np.isin(to_days(dates), to_days(days))
+
+
+def in_period(dates, start=None, end=None) -> np.ndarray:
+    """Check which dates are inside a period
+
+    Args:
+        dates (array-like): dates accepted by to_days
+        start (datetime.date, optional): First day of the period. Defaults to no lower bound.
+        end (datetime.date, optional): Last day of the period. Defaults to no upper bound.
+
+    Returns:
+        np.ndarray: boolean mask
+    """
+    dates = to_days(dates)
+    mask = np.ones(dates.shape, dtype=bool)
+    if start is not None:
+        mask &= dates >= to_days([start])[0]
+    if end is not None:
+        mask &= dates <= to_days([end])[0]
+    return mask
+
+
+def cache_path(fpath) -> pathlib.Path:
+    """Path of the parquet cache of a reference table, in the cache folder of the shared
+    processed folder so raw and reference folders only hold source files"""
+    key = hashlib.sha1(str(pathlib.Path(fpath).resolve()).encode()).hexdigest()[:8]
+    return PATHS.processed_root / CACHE_DIR / f'{fpath.stem}.{key}.parquet'
+
+
+@functools.lru_cache(maxsize=32)
+def _read_reference(fpath, mtime_ns: int, read):
+    # pandas is imported when needed, so commands only reading paths start fast
+    import pandas as pd
+    cache = cache_path(fpath)
+    if cache.exists() and os.stat(cache).st_mtime_ns >= mtime_ns:
+        return pd.read_parquet(cache)
+    df = read(fpath)
+    cache.parent.exists() or os.makedirs(cache.parent, exist_ok=True)
+    # Unique temporary file, several processes of a batch may rebuild the same cache
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', prefix=cache.name, dir=cache.parent)
+    os.close(fd)
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, cache)
+    return df
+
+
+def read_reference(fpath, read):
+    """Read a reference table through its parquet cache
+
+    The source is only parsed with `read` when it has been modified after its
+    cache was written, and the table is kept in memory while the source does
+    not change, so repeated runs and stages share a single parse. Each source
+    must always be read with the same function.
+
+    Args:
+        fpath (Path): path to the source of the table
+        read (callable): function parsing the source into a dataframe
+
+    Raises:
+        FileNotFoundError: Error if the source does not exist
+
+    Returns:
+        pd.DataFrame: copy of the table
+    """
+    fpath = pathlib.Path(fpath)
+    return _read_reference(fpath, os.stat(fpath).st_mtime_ns, read).copy()
+
+
+def _read_ine_codes(fpath):
+    import pandas as pd
+    return pd.read_excel(fpath, dtype={'Codigo': 'string'})[['Codigo', 'Literal']]
+
+
+def _read_ccaa(fpath):
+    import pandas as pd
+    return pd.read_csv(fpath, sep=';', dtype={'Codigo': 'string', 'cod_ccaa': 'string'})
+
+
+def ine_codes():
+    """INE codes ('Codigo') and names ('Literal') of the provinces, from the raw folder"""
+    return read_reference(PATHS.raw / INE_CODES, _read_ine_codes)
+
+
+@functools.lru_cache(maxsize=8)
+def _province_names(fpath, mtime_ns: int) -> np.ndarray:
+    codes = read_reference(fpath, _read_ine_codes)
+    names = np.full(N_CODES + 1, None, dtype=object)
+    names[codes.Codigo.astype(int).to_numpy()] = codes.Literal.to_numpy(dtype=object)
+    # Shared by every caller
+    names.flags.writeable = False
+    return names
+
+
+@functools.lru_cache(maxsize=8)
+def _ccaa_lookup(fpath, mtime_ns: int) -> tuple:
+    table = read_reference(fpath, _read_ccaa)
+    province_ccaa = np.full(N_CODES + 1, -1, dtype='int8')
+    province_ccaa[table.Codigo.astype(int).to_numpy()] = table.cod_ccaa.astype(int).to_numpy()
+    names = np.full(N_CODES + 1, None, dtype=object)
+    names[table.cod_ccaa.astype(int).to_numpy()] = table.CCAA.to_numpy(dtype=object)
+    province_ccaa.flags.writeable = names.flags.writeable = False
+    return province_ccaa, names
+
+
+def province_names() -> np.ndarray:
+    """Lookup array of province names by integer INE code, None for unknown codes
+
+    The array is loaded once per process and reloaded when the INE code map changes.
+    """
+    fpath = PATHS.raw / INE_CODES
+    return _province_names(fpath, os.stat(fpath).st_mtime_ns)
+
+
+def province_ccaa() -> np.ndarray:
+    """Lookup array of the integer CCAA code of each integer province code, -1 for unknown provinces"""
+    return _ccaa_lookup(CCAA_TABLE, os.stat(CCAA_TABLE).st_mtime_ns)[0]
+
+
+def ccaa_names() -> np.ndarray:
+    """Lookup array of CCAA names by integer CCAA code, None for unknown codes"""
+    return _ccaa_lookup(CCAA_TABLE, os.stat(CCAA_TABLE).st_mtime_ns)[1]
+
+
+def cod_map() -> dict:
+    """INE code to province name"""
+    return {f'{code:02d}': name for code, name in enumerate(province_names()[:N_CODES]) if name is not None}
+
+
 if __name__ == '__main__':
     check_dirs()
\ No newline at end of file
@@ -0,0 +1,166 @@
+"""
+Zones.py file define the hierarchy of zones of the opendata-movilidad files.
+
+District and municipality codes start with the INE code of their municipality
+(5 characters) and province (2 digits), and provinces belong to a CCAA given by
+the CCAA table bundled in raw/codigos_ine, see utils.province_ccaa:
+
+    district -> municipality -> province -> ccaa
+
+Zone codes of a file are factorized once and only their unique values are
+mapped to each level, so rows are aggregated with integer array indexing
+instead of slicing the code of every row.
+
+Trips aggregated to levels other than province are stored in their own
+partitioned store, e.g. processed/ccaa_flux/month=2020-06/20200601.parquet
+"""
+import functools
+
+import numpy as np
+import pandas as pd
+
+import store
+import utils
+
+LEVELS = ('district', 'municipality', 'province', 'ccaa')
+# Levels of each type of location files, from the finest one
+LOCATION_LEVELS = {'distritos': LEVELS, 'municipios': LEVELS[1:]}
+LEVEL_COLUMNS = ['date', 'origin', 'dest', 'flux']
+# Two digits code of each integer province or CCAA code, -1 (last) for unknown ones
+CODE_LABELS = np.array([f'{i:02d}' for i in range(100)] + ['-1'], dtype=object)
+
+
+class ZoneHierarchy():
+    """Mapping of zone codes to the codes of each level of the hierarchy
+
+    Provinces and CCAA are integer coded: `province_ccaa[p]` is the code of the
+    CCAA of province p, -1 for unknown provinces. The CCAA table is only read
+    when the CCAA of a zone is looked up.
+    """
+    @property
+    def province_ccaa(self) -> np.ndarray:
+        return utils.province_ccaa()
+
+    @property
+    def ccaa_names(self) -> np.ndarray:
+        return utils.ccaa_names()
+
+    @staticmethod
+    def province(zones) -> np.ndarray:
+        """Integer province code of zone codes
+
+        Zones not starting with a two digits province code, e.g. foreign or
+        aggregated zones, have an unknown province.
+
+        Args:
+            zones (pd.Index): unique zone codes
+
+        Returns:
+            np.ndarray: int8 province code of each zone, -1 for unknown ones
+        """
+        prefix = pd.Index(zones).astype('string').str.slice(0, 2)
+        province = pd.to_numeric(prefix.where(prefix.str.fullmatch(r'\d\d', na=False)), errors='coerce')
+        return np.nan_to_num(np.asarray(province, dtype='float64'), nan=-1).astype('int8')
+
+    def labels(self, zones, level: str) -> np.ndarray:
+        """Code of the zone of a level containing each zone
+
+        Args:
+            zones (pd.Index): unique zone codes, of districts or municipalities
+            level (str): one of LEVELS
+
+        Raises:
+            ValueError: level must be one of the valid levels.
+
+        Returns:
+            np.ndarray: codes of the level, as strings
+        """
+        if level not in LEVELS:
+            raise ValueError(f'level {level} is not a valid input. Valid levels are: {", ".join(LEVELS)}')
+        zones = pd.Index(zones).astype('string')
+        if level == 'district':
+            return zones.to_numpy(dtype=object)
+        if level == 'municipality':
+            # Municipalities, including aggregations of municipalities (_AM), are kept,
+            # districts are mapped to the municipality given by their first 5 digits
+            municipality = (zones.str.len() == 5) | zones.str.endswith('_AM')
+            return np.where(municipality, zones, zones.str.slice(0, 5)).astype(object)
+        province = self.province(zones)
+        if level == 'province':
+            return CODE_LABELS[province]
+        return CODE_LABELS[self.province_ccaa[province]]
+
+
+@functools.lru_cache(maxsize=None)
+def hierarchy() -> ZoneHierarchy:
+    """Zone hierarchy loaded once per process"""
+    return ZoneHierarchy()
+
+
+def store_name(level: str) -> str:
+    """Name of the store of trips aggregated to a level"""
+    return f'{level}_flux'
+
+
+def write_days(flux: pd.DataFrame, level: str, root=None) -> list:
+    """Write a partition file for each day of the flux of a level, replacing existing ones
+
+    Args:
+        flux (pd.DataFrame): flux with LEVEL_COLUMNS
+        level (str): one of LEVELS
+        root (Path, optional): Folder containing the store. Defaults to PATHS.processed.
+
+    Returns:
+        list: paths to the written partition files
+    """
+    flux = flux[LEVEL_COLUMNS].copy()
+    flux['date'] = pd.to_datetime(flux['date'])
+    codes = pd.CategoricalDtype(sorted(pd.unique(pd.concat([flux['origin'], flux['dest']]))))
+    flux['origin'] = flux['origin'].astype(codes)
+    flux['dest'] = flux['dest'].astype(codes)
+
+    files = []
+    for date, day in flux.groupby('date', sort=True):
+        fpath = store.day_path(date, root, store_name(level))
+        store.write_partition(day, fpath)
+        files.append(fpath)
+    return files
+
+
+def read_flux(level: str, start=None, end=None, dates=None, root=None) -> pd.DataFrame:
+    """Read the flux aggregated to a level
+
+    Args:
+        level (str): one of LEVELS
+        start (datetime.date, optional): First day to read. Defaults to first day stored.
+        end (datetime.date, optional): Last day to read. Defaults to last day stored.
+        dates (list, optional): Only read these days. Defaults to every day between start and end.
+        root (Path, optional): Folder containing the store. Defaults to PATHS.processed.
+
+    Raises:
+        FileNotFoundError: Error if there is no data stored for the requested period
+
+    Returns:
+        pd.DataFrame: flux with LEVEL_COLUMNS sorted by date
+    """
+    dates = store.select_dates(store.list_dates(root, store_name(level)), start, end, dates)
+    if not dates:
+        raise FileNotFoundError(f'No {level} flux stored in {store.store_dir(root, store_name(level))} for the period {start} - {end}')
+
+    flux = pd.concat([pd.read_parquet(store.day_path(d, root, store_name(level))) for d in dates],
+                     ignore_index=True)
+    codes = pd.CategoricalDtype(sorted(pd.unique(pd.concat([flux['origin'], flux['dest']]).astype('string'))))
+    flux['origin'] = flux['origin'].astype('string').astype(codes)
+    flux['dest'] = flux['dest'].astype('string').astype(codes)
+    return flux
+
+
+def clear(root=None):
+    """Remove the stores of every level other than province
+
+    Args:
+        root (Path, optional): Folder containing the stores. Defaults to PATHS.processed.
+    """
+    for level in LEVELS:
+        if level != 'province':
+            store.clear(root, store_name(level))
@@ -0,0 +1,10 @@
+"""
+Make the modules of src importable by the tests, as they import each other by name.
+"""
+import pathlib
+import sys
+
+SRC = pathlib.Path(__file__).resolve().parents[1] / 'src'
+sys.path.insert(0, str(SRC))
+# Synthetic day files of the benchmarks are also used by the tests
+sys.path.insert(0, str(SRC.parent / 'benchmarks'))
@@ -0,0 +1,142 @@
+"""
+Tests of the aliased days of corrections on synthetic day files.
+
+An aliased day missing in the raw folder is read from the file of its source
+day with its own date, and a file published afterwards by the server takes
+precedence over the alias. Downloads only fall back to the alias when the
+server answers the day is missing.
+"""
+import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+
+from synthetic import generate
+from utils import PATHS
+from manifest import Manifest
+import corrections
+import download
+import process
+import store
+
+MAESTRA, LOCATION = 'maestra1', 'municipios'
+ALIAS = datetime.date(2020, 7, 12)
+SOURCE = corrections.aliases(MAESTRA, LOCATION)[ALIAS]
+
+
+@pytest.fixture
+def raw_dir(tmp_path, monkeypatch):
+    """Raw folder of a dataset with the week of the source and the aliased days, without the aliased day"""
+    monkeypatch.setattr(PATHS, '_data', tmp_path)
+    files = generate(tmp_path, days=9, zones=60, start=SOURCE, destinations=4, periods=2)
+    raw_dir = files[0].parent
+    (raw_dir / corrections.file_name(ALIAS, MAESTRA, LOCATION)).unlink()
+    return raw_dir
+
+
+def flux_of(date: datetime.date) -> pd.DataFrame:
+    df = store.read_flux(dates=[date])
+    df = df.drop(columns='date').astype({c: 'string' for c in store.CATEGORY_COLUMNS})
+    return df.sort_values(list(df.columns[:-1]), ignore_index=True)
+
+
+def test_aliased_day_resolves_to_source(raw_dir):
+    files = corrections.day_files(raw_dir, MAESTRA, LOCATION)
+    aliased = raw_dir / corrections.file_name(ALIAS, MAESTRA, LOCATION)
+    assert aliased in files and not aliased.exists()
+    assert files == sorted(files)
+    assert corrections.resolve(aliased) == (raw_dir / corrections.file_name(SOURCE, MAESTRA, LOCATION), 20200712)
+    assert corrections.source(files[0]) == files[0]
+    # Other datasets have no alias for the day
+    assert corrections.day_files(raw_dir, 'maestra2', LOCATION) == [f for f in files if f != aliased]
+
+
+def test_alias_needs_its_source(raw_dir):
+    (raw_dir / corrections.file_name(SOURCE, MAESTRA, LOCATION)).unlink()
+    names = [f.name for f in corrections.day_files(raw_dir, MAESTRA, LOCATION)]
+    assert corrections.file_name(ALIAS, MAESTRA, LOCATION) not in names
+
+
+def test_process_reads_aliased_day(raw_dir):
+    process.process(exp=MAESTRA, res=LOCATION, workers=1)
+    assert ALIAS in store.list_dates()
+    pd.testing.assert_frame_equal(flux_of(ALIAS), flux_of(SOURCE))
+
+
+def test_published_day_takes_precedence(raw_dir, tmp_path):
+    process.process(exp=MAESTRA, res=LOCATION, workers=1)
+    published = generate(tmp_path / 'published', days=1, zones=60, start=ALIAS, destinations=4, periods=2, seed=1)[0]
+    aliased = raw_dir / published.name
+    published.replace(aliased)
+    assert corrections.resolve(aliased) == (aliased, None)
+    assert Manifest().changed(corrections.day_files(raw_dir, MAESTRA, LOCATION)) == [aliased]
+
+    process.process(exp=MAESTRA, res=LOCATION, workers=1, update=True)
+    updated = flux_of(ALIAS)
+    assert not updated.equals(flux_of(SOURCE))
+    process.process(exp=MAESTRA, res=LOCATION, workers=1)
+    pd.testing.assert_frame_equal(updated, flux_of(ALIAS))
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serve the day files of a folder, answering the aliased day with the status scripted"""
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        name = self.path.rsplit('/', 1)[-1]
+        fpath = self.server.files / name
+        if name == corrections.file_name(ALIAS, MAESTRA, LOCATION):
+            self._send(self.server.alias_status, b'not found')
+        elif fpath.exists():
+            self._send(200, fpath.read_bytes(), 'application/gzip')
+        else:
+            self._send(404, b'not found')
+
+    def _send(self, status, body, content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server(raw_dir, tmp_path):
+    """Server publishing the day files of raw_dir, which is emptied"""
+    files = tmp_path / 'server'
+    raw_dir.rename(files)
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.files, httpd.alias_status = files, 404
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def fetch_days(server) -> list:
+    return download.download.callback(maestra_version=MAESTRA, location=LOCATION, workers=2, retries=0,
+                                      start=SOURCE, end=SOURCE + datetime.timedelta(days=8),
+                                      base_url=f'http://127.0.0.1:{server.server_address[1]}')
+
+
+def test_download_missing_day_falls_back_to_alias(server, capsys):
+    files = fetch_days(server)
+    assert len(files) == 8
+    assert f'{ALIAS} not available, read from {SOURCE}' in capsys.readouterr().out
+    raw_dir = files[0].parent
+    aliased = raw_dir / corrections.file_name(ALIAS, MAESTRA, LOCATION)
+    assert aliased in corrections.day_files(raw_dir, MAESTRA, LOCATION)
+    assert not aliased.exists()
+
+
+def test_download_error_is_not_aliased(server, capsys):
+    server.alias_status = 500
+    files = fetch_days(server)
+    assert len(files) == 8
+    out = capsys.readouterr().out
+    assert 'Error downloading' in out and corrections.file_name(ALIAS, MAESTRA, LOCATION) in out
+    assert 'see corrections.py' not in out
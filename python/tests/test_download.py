@@ -0,0 +1,157 @@
+"""
+Tests of download.fetch_file against a local HTTP server standing in for opendata-movilidad.
+
+Each test scripts the responses of the server and checks the requests sent
+by the downloader and the files it leaves in the raw folder.
+"""
+import datetime
+import gzip
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from requests import Session
+
+from download import download_dates, fetch_file
+from raw_store import RawStore, HEADER_PREFIX
+from utils import PATHS
+
+# Random trips, so the file does not compress and a truncated response leaves several chunks written
+RNG = random.Random(0)
+PAYLOAD = gzip.compress(HEADER_PREFIX + b'origen|destino|viajes\n' + b''.join(
+    b'20200501|28079|28079|%d\n' % RNG.randrange(10 ** 9) for _ in range(20000)))
+ETAG = '"day-1"'
+LAST_MODIFIED = 'Fri, 01 May 2020 00:00:00 GMT'
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Answer GET requests with the next scripted response of the server"""
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        action = server.script.pop(0) if server.script else 'ok'
+        if action == 'error':
+            self._send(503, b'unavailable', 'text/plain')
+        elif action == 'forbidden':
+            self._send(403, b'forbidden', 'text/plain')
+        elif action == 'html':
+            self._send(200, b'<html>maintenance</html>', 'text/html')
+        elif action == 'truncate':
+            # Announce the whole file but only send half of it
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/gzip')
+            self.send_header('Content-Length', str(len(PAYLOAD)))
+            self.end_headers()
+            self.wfile.write(PAYLOAD[:len(PAYLOAD) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+        elif self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.end_headers()
+        elif self.headers.get('Range'):
+            offset = int(self.headers['Range'][len('bytes='):].rstrip('-'))
+            self._send(206, PAYLOAD[offset:], 'application/gzip',
+                       {'Content-Range': f'bytes {offset}-{len(PAYLOAD) - 1}/{len(PAYLOAD)}'})
+        else:
+            self._send(200, PAYLOAD, 'application/gzip')
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', ETAG)
+        self.send_header('Last-Modified', LAST_MODIFIED)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.script, httpd.requests = [], []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def fpath(tmp_path, monkeypatch):
+    # Objects of the raw store are written under PATHS.raw
+    monkeypatch.setattr(PATHS, '_data', tmp_path)
+    return PATHS.raw / '20200501_maestra_1_mitma_municipio.txt.gz'
+
+
+def fetch(server, fpath, retries=3, raw=None):
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    url = f'http://127.0.0.1:{server.server_address[1]}/{fpath.name}'
+    with Session() as session:
+        return fetch_file(session, url, fpath, retries=retries, backoff=0, chunk_size=1024, raw=raw)
+
+
+def test_resume_after_truncation(server, fpath):
+    server.script = ['truncate']
+    assert fetch(server, fpath) == 'downloaded'
+    assert fpath.read_bytes() == PAYLOAD
+    assert 'Range' not in server.requests[0]
+    offset = int(server.requests[1]['Range'][len('bytes='):].rstrip('-'))
+    assert 0 < offset < len(PAYLOAD)
+    assert not fpath.with_name(fpath.name + '.part').exists()
+
+
+def test_retry_server_error(server, fpath):
+    server.script = ['error', 'error']
+    assert fetch(server, fpath) == 'downloaded'
+    assert len(server.requests) == 3
+    assert fpath.read_bytes() == PAYLOAD
+
+
+def test_server_error_gives_up(server, fpath):
+    server.script = ['error'] * 3
+    with pytest.raises(Exception, match='3 attempts failed'):
+        fetch(server, fpath, retries=2)
+    assert not fpath.exists()
+
+
+def test_reject_html(server, fpath):
+    server.script = ['html'] * 4
+    with pytest.raises(Exception, match='unexpected response'):
+        fetch(server, fpath)
+    assert len(server.requests) == 1
+    assert not fpath.exists()
+    assert not fpath.with_name(fpath.name + '.part').exists()
+
+
+def test_client_error_not_retried(server, fpath):
+    server.script = ['forbidden'] * 4
+    with pytest.raises(Exception, match='unexpected response 403'):
+        fetch(server, fpath)
+    assert len(server.requests) == 1
+    assert not fpath.exists()
+
+
+def test_not_modified(server, fpath):
+    fpath.parent.mkdir(parents=True)
+    raw = RawStore(fpath.parent)
+    assert fetch(server, fpath, raw=raw) == 'downloaded'
+    raw.save()
+    assert fetch(server, fpath, raw=RawStore(fpath.parent)) == 'not modified'
+    assert server.requests[1].get('If-None-Match') == ETAG
+    assert server.requests[1].get('If-Modified-Since') == LAST_MODIFIED
+    assert fpath.read_bytes() == PAYLOAD
+
+
+def test_update_dates_until_end(fpath):
+    fpath.parent.mkdir(parents=True)
+    fpath.write_bytes(PAYLOAD)
+    dates = download_dates(fpath.parent, update=True, end=datetime.date(2020, 5, 4))
+    assert dates == [datetime.date(2020, 5, 2), datetime.date(2020, 5, 3), datetime.date(2020, 5, 4)]
+    future = datetime.date.today() + datetime.timedelta(days=10)
+    assert download_dates(fpath.parent, update=True, end=future)[-1] == datetime.date.today()
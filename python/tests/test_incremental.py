@@ -0,0 +1,146 @@
+"""
+Tests of the update mode of process, flowmap and generate_index on synthetic day files.
+
+A dataset updated with new and changed day files must end with the same
+outputs as the same dataset processed from scratch.
+"""
+import datetime
+import shutil
+
+import pandas as pd
+import pytest
+
+from synthetic import generate
+from utils import PATHS
+from manifest import Manifest
+import process
+import flowmap
+import generate_index
+import store
+
+# Days around the May reference week of generate_index
+START = datetime.date(2020, 4, 27)
+DAYS = 24
+FIRST_RUN = 17
+# Day changed in the server after the first run, inside the rolling window of the reference week
+CHANGED = datetime.date(2020, 4, 29)
+REFERENCE = 'ref_flowmap_flows_location.csv'
+FLOWMAP_FILES = ('flows', 'locations', 'flows_location')
+
+
+@pytest.fixture(scope='module')
+def source(tmp_path_factory):
+    """Day files of the dataset and a second version of the changed day"""
+    root = tmp_path_factory.mktemp('source')
+    files = generate(root / 'v1', days=DAYS, zones=80, start=START, destinations=6, periods=2)
+    changed = generate(root / 'v2', days=1, zones=80, start=CHANGED, destinations=6, periods=2, seed=1)[0]
+    return files, changed
+
+
+@pytest.fixture
+def data(tmp_path, monkeypatch):
+    """Point PATHS to an empty data folder, returning a function creating new ones"""
+    def use(name):
+        path = tmp_path / name
+        (path / 'raw').mkdir(parents=True)
+        monkeypatch.setattr(PATHS, '_data', path)
+        return path
+    return use
+
+
+def add_files(files, data_dir):
+    raw_dir = data_dir / 'raw' / 'maestra1' / 'municipios'
+    raw_dir.mkdir(parents=True, exist_ok=True)
+    ine_dir = data_dir / 'raw' / 'codigos_ine'
+    ine_dir.mkdir(exist_ok=True)
+    shutil.copy(files[0].parents[2] / 'codigos_ine' / '20_cod_prov.xls', ine_dir)
+    for f in files:
+        shutil.copy(f, raw_dir / f.name)
+
+
+def write_reference(days: int = 7):
+    """Use the first week of flows as reference of INDEX_FEB, as benchmarks/bench_pipeline.py"""
+    flows = pd.read_csv(PATHS.processed / 'flowmap_flows_location.csv', sep=';', encoding='latin1')
+    first = sorted(flows['time'].unique())[:days]
+    flows[flows['time'].isin(first)].to_csv(PATHS.processed_root / REFERENCE, index=False, sep=';', encoding='latin1')
+
+
+def run(update: bool, sharded: bool = False):
+    process.process(workers=1, update=update)
+    flowmap.generate_flowmap_data(update=update)
+    if not (PATHS.processed_root / REFERENCE).exists():
+        write_reference()
+    generate_index.generate_index(update=update, sharded=sharded, workers=1)
+
+
+def outputs() -> dict:
+    """Outputs of every stage, sorted so row order does not matter"""
+    flux = store.read_flux()
+    tables = {'flux': flux.sort_values(list(flux.columns[:-1]), ignore_index=True)}
+    for table in FLOWMAP_FILES:
+        df = pd.read_csv(flowmap.flowmap_path(table), sep=';', encoding='latin1')
+        tables[table] = df.sort_values(list(df.columns), ignore_index=True)
+    index = generate_index.read_index()
+    tables['index'] = index.sort_values(['time', 'origin_name', 'index'], ignore_index=True)
+    return tables
+
+
+def assert_same_outputs(expected: dict, actual: dict):
+    assert expected.keys() == actual.keys()
+    for name in expected:
+        pd.testing.assert_frame_equal(expected[name], actual[name], check_dtype=False, obj=name)
+
+
+def full_outputs(files, data, name='full') -> dict:
+    add_files(files, data(name))
+    run(update=False)
+    return outputs()
+
+
+@pytest.mark.parametrize('sharded', [False, True])
+def test_update_equals_full_run(source, data, sharded):
+    files, changed = source
+    final = [changed if f.name == changed.name else f for f in files]
+    expected = full_outputs(final, data)
+    reference = PATHS.processed_root / REFERENCE
+
+    updated = data('update')
+    add_files(files[:FIRST_RUN], updated)
+    PATHS.processed_root.mkdir()
+    shutil.copy(reference, PATHS.processed_root / REFERENCE)
+    run(update=False)
+    assert Manifest().stale('index') == []
+
+    add_files(files[FIRST_RUN:] + [changed], updated)
+    raw_files = sorted((updated / 'raw' / 'maestra1' / 'municipios').glob('*.txt.gz'))
+    assert [f.name for f in Manifest().changed(raw_files)] == [changed.name] + [f.name for f in files[FIRST_RUN:]]
+    run(update=True, sharded=sharded)
+    assert_same_outputs(expected, outputs())
+    assert all(Manifest().stale(stage) == [] for stage in ('flowmap:wide', 'index'))
+
+
+def test_stale_dates_of_changed_file(source, data):
+    files, changed = source
+    add_files(files, data('stale'))
+    run(update=False)
+    add_files([changed], PATHS.data)
+    process.process(workers=1, update=True)
+    assert Manifest().stale('index') == [CHANGED]
+    assert Manifest().stale('flowmap:wide') == [CHANGED]
+
+
+def test_baseline_change_regenerates_index(source, data):
+    files, _ = source
+    before = full_outputs(files, data, 'before')['index']
+    reference = pd.read_csv(PATHS.processed_root / REFERENCE, sep=';', encoding='latin1')
+    reference['count'] *= 2
+    reference.to_csv(PATHS.processed_root / REFERENCE, index=False, sep=';', encoding='latin1')
+    generate_index.generate_index(update=True)
+    updated = generate_index.read_index()
+
+    generate_index.generate_index(update=False)
+    rebuilt = generate_index.read_index()
+    pd.testing.assert_frame_equal(updated, rebuilt)
+    updated = updated.sort_values(['time', 'origin_name', 'index'], ignore_index=True)
+    pd.testing.assert_series_equal(updated['INDEX_FEB'] * 2, before['INDEX_FEB'])
+    assert Manifest().config('index') == generate_index.index_config(generate_index.BASELINES)
@@ -0,0 +1,90 @@
+"""
+Tests of the rolling metrics of generate_index, COUNT_MA7 and COUNT_WOW.
+
+Metrics are checked against values computed by hand on a small index, and
+the metrics of an update, computed from the ROLLING_DAYS days before each
+day, against those of the whole history.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import to_days
+from generate_index import ROLLING_COLUMNS, ROLLING_DAYS, add_rolling_metrics, rolling_dates
+
+DAYS = pd.date_range('2020-05-01', periods=20, freq='D')
+KEYS = [('Madrid', 'INTERNAL'), ('Madrid', 'OUTWARD'), ('Toledo', 'INTERNAL')]
+
+
+def make_index(days=DAYS, keys=KEYS, seed=0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    rows = [(day, name, kind) for name, kind in keys for day in days]
+    index = pd.DataFrame(rows, columns=['time', 'origin_name', 'index'])
+    index['count'] = rng.integers(1, 1000, len(index)).astype('float64')
+    return index
+
+
+def series(index: pd.DataFrame, name: str, kind: str, column: str) -> pd.Series:
+    rows = index[(index['origin_name'] == name) & (index['index'] == kind)]
+    return rows.set_index('time')[column]
+
+
+def test_moving_average_and_week_over_week():
+    index = make_index()
+    result = add_rolling_metrics(index)
+    assert list(result.columns) == list(index.columns) + ROLLING_COLUMNS
+    pd.testing.assert_frame_equal(result[index.columns], index)
+    for name, kind in KEYS:
+        counts = series(index, name, kind, 'count').to_numpy()
+        ma7 = series(result, name, kind, 'COUNT_MA7').to_numpy()
+        wow = series(result, name, kind, 'COUNT_WOW').to_numpy()
+        assert np.isnan(ma7[:ROLLING_DAYS - 1]).all()
+        assert np.isnan(wow[:ROLLING_DAYS]).all()
+        for i in range(ROLLING_DAYS - 1, len(DAYS)):
+            assert ma7[i] == pytest.approx(counts[i - ROLLING_DAYS + 1:i + 1].mean())
+        for i in range(ROLLING_DAYS, len(DAYS)):
+            assert wow[i] == pytest.approx(counts[i] / counts[i - ROLLING_DAYS] - 1)
+
+
+def test_missing_day_leaves_its_windows_empty():
+    index = make_index()
+    gap = DAYS[10]
+    index = index[~((index['time'] == gap) & (index['origin_name'] == 'Toledo'))]
+    result = add_rolling_metrics(index)
+    assert len(result) == len(index)
+
+    ma7 = series(result, 'Toledo', 'INTERNAL', 'COUNT_MA7')
+    wow = series(result, 'Toledo', 'INTERNAL', 'COUNT_WOW')
+    window = (ma7.index > gap) & (ma7.index < gap + pd.Timedelta(days=ROLLING_DAYS))
+    assert ma7[window].isna().all()
+    assert ma7[ma7.index >= gap + pd.Timedelta(days=ROLLING_DAYS)].notna().all()
+    assert wow[wow.index == gap + pd.Timedelta(days=ROLLING_DAYS)].isna().all()
+    assert wow[(wow.index >= DAYS[ROLLING_DAYS]) & (wow.index != gap + pd.Timedelta(days=ROLLING_DAYS))].notna().all()
+    # Other origins keep every metric
+    expected = add_rolling_metrics(make_index())
+    madrid = result['origin_name'] == 'Madrid'
+    pd.testing.assert_frame_equal(result[madrid].reset_index(drop=True),
+                                  expected[expected['origin_name'] == 'Madrid'].reset_index(drop=True))
+
+
+def test_rolling_dates():
+    changed = [DAYS[3], DAYS[5]]
+    expected = pd.date_range(DAYS[3], DAYS[5] + pd.Timedelta(days=ROLLING_DAYS), freq='D')
+    pd.testing.assert_index_equal(rolling_dates(changed), expected, exact=False, check_exact=True)
+
+
+def test_update_equals_full_history():
+    # As generate_index(update=True): recompute the days depending on a changed day,
+    # from the ROLLING_DAYS days before each of them
+    index = make_index()
+    changed = make_index(seed=1)
+    day = DAYS[9]
+    index.loc[index['time'] == day, 'count'] = changed.loc[changed['time'] == day, 'count']
+    full = add_rolling_metrics(index)
+
+    dates = rolling_dates([day])
+    lookback = pd.DatetimeIndex(np.unique((to_days(dates)[:, None] - np.arange(ROLLING_DAYS + 1)).ravel()))
+    updated = add_rolling_metrics(index[index['time'].isin(lookback)])
+    updated = updated[updated['time'].isin(dates)].reset_index(drop=True)
+    expected = full[full['time'].isin(dates)].reset_index(drop=True)
+    pd.testing.assert_frame_equal(updated, expected)
@@ -0,0 +1,93 @@
+"""
+Tests of the filters of the sparse OD matrices, top_k and threshold.
+
+Filtered matrices are checked against the same selection made on dense
+arrays, and flows read from a small store against filtering every flow row.
+"""
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+import sparse_od
+
+ZONES = 40
+
+
+def random_matrix(seed=0, density=0.2) -> sparse.csr_matrix:
+    """OD matrix with distinct trips, so the largest flows are not tied"""
+    rng = np.random.default_rng(seed)
+    matrix = sparse.random(ZONES, ZONES, density=density, format='csr', random_state=rng)
+    matrix.data = rng.permutation(matrix.nnz) + 1.0
+    return matrix
+
+
+def dense_top_k(dense: np.ndarray, k: int) -> np.ndarray:
+    values = np.sort(dense[dense > 0])[::-1]
+    if k < len(values):
+        dense = np.where(dense >= values[k - 1], dense, 0)
+    return dense
+
+
+@pytest.mark.parametrize('k', [1, 10, 50, 10 ** 6])
+def test_top_k(k):
+    matrix = random_matrix()
+    kept = sparse_od.top_k(matrix, k)
+    assert kept.nnz == min(k, matrix.nnz)
+    np.testing.assert_array_equal(kept.toarray(), dense_top_k(matrix.toarray(), k))
+
+
+@pytest.mark.parametrize('k', [1, 3, ZONES])
+def test_top_k_per_origin(k):
+    matrix = random_matrix()
+    kept = sparse_od.top_k(matrix, k, per_origin=True)
+    expected = np.array([dense_top_k(row, k) for row in matrix.toarray()])
+    np.testing.assert_array_equal(kept.toarray(), expected)
+
+
+def test_top_k_sums_duplicated_pairs():
+    matrix = sparse.coo_matrix(([5.0, 4.0, 3.0], ([0, 1, 1], [0, 1, 1])), shape=(2, 2))
+    np.testing.assert_array_equal(sparse_od.top_k(matrix, 1).toarray(), [[0, 0], [0, 7]])
+
+
+def test_threshold():
+    matrix = random_matrix()
+    kept = sparse_od.threshold(matrix, 100)
+    dense = matrix.toarray()
+    np.testing.assert_array_equal(kept.toarray(), np.where(dense >= 100, dense, 0))
+    assert kept.nnz == (dense >= 100).sum()
+    # The matrix read is not modified
+    np.testing.assert_array_equal(matrix.toarray(), dense)
+
+
+def write_store(root) -> pd.DataFrame:
+    """Store two days, the second one with zones not seen the first day, returning the flux written"""
+    days = []
+    for i, (date, zones) in enumerate([(datetime.date(2020, 5, 1), 20), (datetime.date(2020, 5, 2), ZONES)]):
+        coo = random_matrix(seed=i)[:zones, :zones].tocoo()
+        days.append(pd.DataFrame({'date': pd.Timestamp(date), 'origin': [f'z{r:02d}' for r in coo.row],
+                                  'dest': [f'z{c:02d}' for c in coo.col], 'flux': coo.data}))
+        sparse_od.write_days(days[-1], 'municipality', root)
+    return pd.concat(days, ignore_index=True)
+
+
+@pytest.mark.parametrize('k, per_origin, min_flux', [(None, False, None), (15, False, None),
+                                                     (2, True, None), (None, False, 150), (2, True, 150)])
+def test_flows(tmp_path, k, per_origin, min_flux):
+    flux = write_store(tmp_path)
+    flows = sparse_od.flows('municipality', k=k, per_origin=per_origin, min_flux=min_flux, root=tmp_path)
+    index = sparse_od.zone_index('municipality', tmp_path)
+    flows = flows.assign(origin=index[flows['origin']], dest=index[flows['dest']])
+
+    expected = flux.rename(columns={'flux': 'count', 'date': 'time'})[sparse_od.FLOW_COLUMNS]
+    if min_flux is not None:
+        expected = expected[expected['count'] >= min_flux]
+    if k is not None:
+        groups = ['time', 'origin'] if per_origin else ['time']
+        expected = expected.sort_values('count', ascending=False).groupby(groups).head(k)
+    columns = ['time', 'origin', 'dest']
+    pd.testing.assert_frame_equal(flows.sort_values(columns, ignore_index=True),
+                                  expected.sort_values(columns, ignore_index=True),
+                                  check_dtype=False, check_index_type=False)